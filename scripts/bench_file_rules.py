@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Benchmark the compiled filename rules against the per-rule loops
+
+Builds a synthetic tree of FreeSurfer-like paths (100k files by default,
+spread over as many subjects as needed) and classifies every file the way
+create_entity and iter_fs_files used to (a substring test per fs_file_map
+entry and per ignore_list entry) and with file_rules.FileClassifier. The
+results of both are compared, and the rules are round-tripped through a
+JSON rule file.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from file_rules import FileClassifier, dump_rules, load_rules
+import fs_upload_to_triplesore as fs_upload
+from synthetic_subjects import subject_template
+
+
+def synthetic_paths(n_files, basedir='/data/subjects'):
+    """Return n_files absolute paths of FreeSurfer-like subject trees
+    """
+    paths = []
+    subject = 0
+    while len(paths) < n_files:
+        subject += 1
+        for relpath in subject_template:
+            paths.append(os.path.join(basedir, 'SUBJ%05d' % subject, relpath))
+            if len(paths) == n_files:
+                break
+    return paths
+
+
+def legacy_classify(path):
+    """Tags and annotations as found by the former loops over the rules
+    """
+    for key in fs_upload.ignore_list:
+        if key in path:
+            return None
+    filename = os.path.basename(path)
+    found = []
+    for key, uris in fs_upload.fs_file_map:
+        if key in filename:
+            found.append((key.rstrip('.').lstrip('.'), uris))
+    return found
+
+
+def classify(classifier, path):
+    if classifier.is_ignored(path):
+        return None
+    return classifier.match(os.path.basename(path))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog='bench_file_rules.py',
+                                     description=__doc__)
+    parser.add_argument('-n', '--n_files', type=int, default=100000,
+                        help='Number of files in the synthetic tree')
+    args = parser.parse_args()
+
+    paths = synthetic_paths(args.n_files)
+    t0 = time.time()
+    legacy = [legacy_classify(path) for path in paths]
+    t_legacy = time.time() - t0
+
+    classifier = FileClassifier(fs_upload.fs_file_map, fs_upload.ignore_list)
+    t0 = time.time()
+    compiled = [classify(classifier, path) for path in paths]
+    t_compiled = time.time() - t0
+    # a second pass only hits the memo, like later batches of subjects
+    t0 = time.time()
+    for path in paths:
+        classify(classifier, path)
+    t_warm = time.time() - t0
+
+    if legacy != compiled:
+        raise AssertionError('compiled rules differ from the rule loops')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'rules.json')
+        dump_rules(fs_upload.fs_file_map, fs_upload.ignore_list, filename)
+        namespaces = dict((ns.get_prefix(), ns) for ns in
+                          [fs_upload.prov.PROV, fs_upload.fs, fs_upload.nidm,
+                           fs_upload.obo, fs_upload.nif])
+        loaded = FileClassifier(*load_rules(filename, namespaces))
+        if [classify(loaded, path) for path in paths] != legacy:
+            raise AssertionError('rules read from JSON differ')
+    finally:
+        shutil.rmtree(tmpdir)
+
+    n_ignored = sum(1 for found in legacy if found is None)
+    print('%d files (%d ignored), %d distinct basenames' % (
+        len(paths), n_ignored, len(set(map(os.path.basename, paths)))))
+    print('%-24s %10s %12s' % ('', 'seconds', 'files/sec'))
+    for name, seconds in [('rule loops', t_legacy),
+                          ('compiled (cold memo)', t_compiled),
+                          ('compiled (warm memo)', t_warm)]:
+        print('%-24s %10.3f %12.0f' % (name, seconds, len(paths) / seconds))
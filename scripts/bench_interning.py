@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Measure the memory of subject graphs with and without value interning
+
+Each subject directory is encoded into a bundle (as to_graph does, without
+writing outputs) and the bundles are kept in memory. This is done twice in
+fresh processes, with fs_upload_to_triplesore.interner disabled and
+enabled. For each run, the script prints the peak RSS growth, the
+attribute values held by the records (the total and the distinct objects)
+and the bytes those objects take (sys.getsizeof, with the instance
+dictionary of prov.Literal objects). Without arguments, synthetic subjects
+are used.
+"""
+
+from multiprocessing import Process, Queue
+import os
+import resource
+import shutil
+import sys
+import tempfile
+
+import prov.model as prov
+
+import fs_upload_to_triplesore as fs_upload
+from interning import Interner
+from measure_registry import MeasureRegistry
+from synthetic_subjects import make_subjects
+
+
+def value_sizes(bundles):
+    """Return the number of attribute values, of distinct value objects and
+    the bytes of the distinct objects
+    """
+    seen = {}
+    n_values = 0
+    for bundle in bundles:
+        for record in bundle.get_records():
+            _, extra_attributes = record.get_attributes()
+            for _, value in extra_attributes or ():
+                n_values += 1
+                if id(value) in seen:
+                    continue
+                size = sys.getsizeof(value)
+                if isinstance(value, prov.Literal):
+                    size += sys.getsizeof(value.__dict__) + \
+                        sys.getsizeof(value.get_value())
+                seen[id(value)] = size
+    return n_values, len(seen), sum(seen.values())
+
+
+def encode(subject_dirs, interning, queue):
+    fs_upload.interner = Interner(max_entries=200000 if interning else 0)
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    registry = MeasureRegistry(os.devnull)
+    bundles = []
+    for subject_dir in subject_dirs:
+        basedir = os.path.abspath(subject_dir)
+        bundles.append(fs_upload.encode_fs_directory(
+            fs_upload._new_bundle(), basedir, 'bench',
+            os.path.basename(basedir.rstrip(os.path.sep)),
+            registry=registry))
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss0
+    n_values, n_objects, n_bytes = value_sizes(bundles)
+    queue.put({'rss_kb': rss, 'values': n_values, 'objects': n_objects,
+               'bytes': n_bytes, 'records': sum(len(bundle.get_records())
+                                                for bundle in bundles),
+               'interner': fs_upload.interner.stats()})
+
+
+def measure(subject_dirs, interning):
+    """Encode the subjects in a new process; return its measurements
+    """
+    queue = Queue()
+    process = Process(target=encode, args=(subject_dirs, interning, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog='bench_interning.py',
+                                     description=__doc__)
+    parser.add_argument('subject_dirs', nargs='*',
+                        help='Subject directories to encode')
+    parser.add_argument('-n', '--n_subjects', type=int, default=3,
+                        help='Number of synthetic subjects')
+    parser.add_argument('--work_dir', type=str, default=os.getcwd(),
+                        help=('Directory for the synthetic subjects (its '
+                              'path must not contain a name ignored by the '
+                              'encoder, e.g. tmp)'))
+    args = parser.parse_args()
+
+    work_dir = None
+    subject_dirs = args.subject_dirs
+    if not subject_dirs:
+        work_dir = tempfile.mkdtemp(prefix='fsintern-', dir=args.work_dir)
+        subject_dirs = make_subjects(work_dir, args.n_subjects,
+                                     file_size=1024)
+    try:
+        results = [('plain', measure(subject_dirs, False)),
+                   ('interned', measure(subject_dirs, True))]
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir)
+    print('%-10s %8s %10s %10s %12s %10s' % ('mode', 'records', 'values',
+                                             'objects', 'value bytes',
+                                             'RSS (kB)'))
+    for name, result in results:
+        print('%-10s %8d %10d %10d %12d %10d' % (
+            name, result['records'], result['values'], result['objects'],
+            result['bytes'], result['rss_kb']))
+    plain, interned = results[0][1], results[1][1]
+    print('value bytes saved: %.1f%%, RSS saved: %.1f%% (interner: '
+          '%d hits, %d misses)' % (
+              100. * (plain['bytes'] - interned['bytes']) / plain['bytes'],
+              100. * (plain['rss_kb'] - interned['rss_kb']) /
+              max(1, plain['rss_kb']),
+              interned['interner']['hits'], interned['interner']['misses']))
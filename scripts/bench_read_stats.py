@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""Benchmark fs_stats.read_stats against the previous per-cell stats reader
+
+Times reading (and converting values of) FreeSurfer .stats files with the
+line-by-line reader the upload scripts used to copy, and with the columnar
+reader in fs_stats. Without arguments, synthetic aseg- and aparc-like tables
+are generated.
+"""
+
+import os
+import shutil
+import tempfile
+import timeit
+
+from fs_stats import load_stats, read_stats
+from synthetic_subjects import aparc_columns, aseg_columns, \
+    write_synthetic_stats
+
+unknown_units = set(('unitless', 'NA'))
+
+
+def legacy_read_stats(filename):
+    """The reader previously copied in fs_upload_to_triplesore.py and
+    query_convert_fs_stats.py, plus the per-cell conversion of parse_stats
+    """
+    header = {}
+    tableinfo = {}
+    measures = []
+    with open(filename, 'rt') as fp:
+        lines = fp.readlines()
+        for line in lines:
+            if line == line[0]:
+                continue
+            if line.startswith('#'):
+                fields = line.split()[1:]
+                if len(fields) < 2:
+                    continue
+                tag = fields[0]
+                if tag == 'TableCol':
+                    col_idx = int(fields[1])
+                    if col_idx not in tableinfo:
+                        tableinfo[col_idx] = {}
+                    tableinfo[col_idx][fields[2]] = ' '.join(fields[3:])
+                    if tableinfo[col_idx][fields[2]] == "StructName":
+                        struct_idx = col_idx
+                elif tag == "Measure":
+                    fields = ' '.join(fields[1:]).split(', ')
+                    measures.append({'structure': fields[0],
+                                     'name': fields[1],
+                                     'description': fields[2],
+                                     'value': fields[3],
+                                     'units': fields[4],
+                                     'source': 'Header'})
+                elif tag == "ColHeaders":
+                    continue
+                else:
+                    header[tag] = ' '.join(fields[1:])
+            else:
+                row = line.split()
+                measures.append({'structure': row[struct_idx-1],
+                                 'items': [],
+                                 'source': 'Table'}),
+                for idx, value in enumerate(row):
+                    if idx + 1 == struct_idx:
+                        continue
+                    measures[-1]['items'].append({
+                        'name': tableinfo[idx + 1]['ColHeader'],
+                        'description': tableinfo[idx + 1]['FieldName'],
+                        'value': value,
+                        'units': tableinfo[idx + 1]['Units'],
+                        })
+    for measure in measures:
+        for item in measure.get('items', [measure]):
+            if item['units'] in unknown_units and '.' not in item['value']:
+                item['value'] = int(item['value'])
+            else:
+                item['value'] = float(item['value'])
+    return header, tableinfo, measures
+
+
+def benchmark(filename, repeat=5, number=None):
+    """Return the best time per call of both readers for a file
+    """
+    if number is None:
+        number = max(1, 20000 // max(1, len(load_stats(filename))))
+    results = {}
+    for name, reader in [('legacy', legacy_read_stats),
+                         ('read_stats', read_stats),
+                         ('load_stats', load_stats)]:
+        timer = timeit.Timer(lambda: reader(filename))
+        results[name] = min(timer.repeat(repeat, number)) / number
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog='bench_read_stats.py',
+                                     description=__doc__)
+    parser.add_argument('stats_files', nargs='*',
+                        help='FreeSurfer .stats files to read')
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[45, 35, 75, 5000],
+                        help='Rows of the synthetic tables')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+
+    tmpdir = None
+    stats_files = args.stats_files
+    if not stats_files:
+        tmpdir = tempfile.mkdtemp()
+        for n_rows in args.rows:
+            for name, columns in [('aseg', aseg_columns),
+                                  ('aparc', aparc_columns)]:
+                filename = os.path.join(tmpdir, '%s_%d.stats' % (name,
+                                                                 n_rows))
+                write_synthetic_stats(filename, columns, n_rows)
+                stats_files.append(filename)
+    try:
+        print('%-30s %12s %12s %12s %8s' % ('file', 'legacy (ms)',
+                                           'read_stats', 'load_stats',
+                                           'speedup'))
+        for filename in stats_files:
+            result = benchmark(filename, repeat=args.repeat)
+            print('%-30s %12.3f %12.3f %12.3f %7.1fx' % (
+                os.path.basename(filename), result['legacy'] * 1e3,
+                result['read_stats'] * 1e3, result['load_stats'] * 1e3,
+                result['legacy'] / result['load_stats']))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Time the direct stats triple emitter against parse_stats
+
+For each .stats file, N-Triples are produced from the bundle parse_stats
+builds and directly by stats_triples. test_stats_triples checks that both
+give the same graph. Without arguments, synthetic aseg- and aparc-like tables
+are used.
+"""
+
+import os
+import shutil
+import tempfile
+import timeit
+
+import fs_upload_to_triplesore as fs_upload
+from rdf_stream import iter_ntriples
+from stats_triples import ntriples, stats_triples
+from synthetic_subjects import aparc_columns, aseg_columns, \
+    write_synthetic_stats
+
+
+def benchmark(filename, repeat=3, number=None):
+    """Return the number of triples and the best time per file of both
+    ways to N-Triples
+    """
+    entity_uri = fs_upload.niiri['stats-file-entity']
+
+    def with_prov():
+        bundle = fs_upload._new_bundle()
+        entity = bundle.entity(entity_uri)
+        fs_upload.parse_stats(bundle, filename, entity)
+        return list(iter_ntriples(bundle))
+
+    def direct():
+        records, _ = stats_triples(filename, entity_uri.get_uri(),
+                                   fs_upload.stats_terms)
+        return [line for _, triples in records for line in ntriples(triples)]
+    n_triples = len(direct())
+    if number is None:
+        number = max(1, 2000 // max(1, n_triples))
+    results = {'triples': n_triples}
+    for name, func in [('parse_stats', with_prov), ('direct', direct)]:
+        timer = timeit.Timer(func)
+        results[name] = min(timer.repeat(repeat, number)) / number
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog='bench_stats_triples.py',
+                                     description=__doc__)
+    parser.add_argument('stats_files', nargs='*',
+                        help='FreeSurfer .stats files to convert')
+    parser.add_argument('--rows', type=int, nargs='+', default=[45, 35, 500],
+                        help='Rows of the synthetic tables')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+
+    tmpdir = None
+    stats_files = args.stats_files
+    if not stats_files:
+        tmpdir = tempfile.mkdtemp()
+        for n_rows in args.rows:
+            for name, columns in [('aseg', aseg_columns),
+                                  ('aparc', aparc_columns)]:
+                filename = os.path.join(tmpdir, '%s_%d.stats' % (name,
+                                                                 n_rows))
+                write_synthetic_stats(filename, columns, n_rows)
+                stats_files.append(filename)
+    try:
+        print('%-30s %8s %16s %12s %8s' % ('file', 'triples',
+                                          'parse_stats (ms)', 'direct',
+                                          'speedup'))
+        for filename in stats_files:
+            result = benchmark(filename, repeat=args.repeat)
+            print('%-30s %8d %16.2f %12.2f %7.1fx' % (
+                os.path.basename(filename), result['triples'],
+                result['parse_stats'] * 1e3, result['direct'] * 1e3,
+                result['parse_stats'] / result['direct']))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+"""Throughput benchmarks of the encoding and upload scripts
+
+Generates synthetic subjects (see synthetic_subjects) in a scratch
+directory and times:
+
+  to_graph        encoding subject directories to .provn/.ttl outputs
+  read_stats      reading the .stats files of a subject
+  parse_stats     encoding them as PROV stats collections
+  csv2provgraph   encoding a synthetic participant CSV file
+  upload_graph    uploading an encoded subject to a stub SPARQL endpoint
+  stats_job       fetching and encoding .stats files through a stub of the
+                  serve_files.py API (query_convert_fs_stats.job)
+  collection      fetching, encoding and uploading the .stats files of a
+                  collection from the stub servers
+                  (query_convert_fs_stats.process_collection)
+  collections     the same for one collection per subject, with the files
+                  of many collections queried together
+                  (query_convert_fs_stats.process_collections)
+
+Every result is a rate (items per second). Results are appended to a JSON
+file together with the git revision and parameters, and compared with the
+previous run of the file: rates that dropped by more than --tolerance are
+reported as regressions.
+"""
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import csv2prov
+import fs_upload_to_triplesore as fs_upload
+from fs_stats import read_stats
+from hash_cache import hash_file
+from measure_registry import MeasureRegistry
+import query_convert_fs_stats as query_convert
+from stub_file_server import StubFileServer
+from sparql_upload import SparqlUploader
+from stub_sparql_endpoint import StubSparqlServer
+from synthetic_subjects import make_subjects
+
+
+def _timed(func, repeat=1, number=1):
+    """Return the result of func and its best wall time per call over
+    repeat runs of number calls
+    """
+    best = None
+    for _ in range(repeat):
+        t0 = time.time()
+        for _ in range(number):
+            result = func()
+        seconds = (time.time() - t0) / number
+        if best is None or seconds < best:
+            best = seconds
+    return result, best
+
+
+def _result(n_items, unit, seconds):
+    return {'items': n_items, 'unit': unit, 'seconds': seconds,
+            'rate': n_items / seconds if seconds else 0.}
+
+
+def stats_files(subject_dir):
+    """Return the table .stats files of a subject
+    """
+    stats_dir = os.path.join(subject_dir, 'stats')
+    return [os.path.join(stats_dir, name)
+            for name in sorted(os.listdir(stats_dir))
+            if name.endswith('.stats') and 'curv' not in name]
+
+
+def bench_to_graph(subject_dirs, work_dir):
+    output_dir = os.path.join(work_dir, 'out')
+    os.mkdir(output_dir)
+    registry = MeasureRegistry(os.path.join(work_dir, 'fsterms.ttl'))
+
+    def encode():
+        n_files = 0
+        for subject_dir in subject_dirs:
+            graph, _ = fs_upload.to_graph(subject_dir, 'bench', output_dir,
+                                          registry=registry)
+            n_files += sum(1 for _ in fs_upload.iter_fs_files(subject_dir))
+        registry.flush()
+        return n_files
+    n_files, seconds = _timed(encode)
+    return {'to_graph': _result(len(subject_dirs), 'subjects', seconds),
+            'to_graph_files': _result(n_files, 'files', seconds)}
+
+
+def bench_stats(subject_dir, repeat=5):
+    filenames = stats_files(subject_dir)
+
+    def read():
+        return sum(len(read_stats(filename)[2]) for filename in filenames)
+
+    def parse():
+        bundle = fs_upload._new_bundle()
+        for filename in filenames:
+            entity = bundle.entity(fs_upload.niiri['bench-entity'])
+            fs_upload.parse_stats(bundle, filename, entity)
+        return len(bundle.get_records())
+    n_measures, t_read = _timed(read, repeat, number=20)
+    _, t_parse = _timed(parse, repeat, number=3)
+    return {'read_stats': _result(n_measures, 'measures', t_read),
+            'parse_stats': _result(n_measures, 'measures', t_parse)}
+
+
+def write_csv(filename, n_rows, n_cols, seed=0):
+    """Write a participant CSV file with numeric columns
+    """
+    rng = random.Random(seed)
+    with open(filename, 'wt') as fp:
+        fp.write(','.join(['participant_id'] +
+                          ['measure_%d' % col for col in range(n_cols)]) +
+                 '\n')
+        for row in range(n_rows):
+            values = ['%d' % (row + 1)]
+            for col in range(n_cols):
+                # some missing values, as in real phenotypic files
+                if rng.random() < 0.05:
+                    values.append('N/A')
+                else:
+                    values.append('%.3f' % rng.uniform(0, 100))
+            fp.write(','.join(values) + '\n')
+
+
+def bench_csv(work_dir, n_rows=1000, n_cols=20):
+    filename = os.path.join(work_dir, 'participants.csv')
+    write_csv(filename, n_rows, n_cols)
+    _, seconds = _timed(lambda: csv2prov.csv2provgraph('file://' + filename))
+    return {'csv2provgraph': _result(n_rows, 'rows', seconds)}
+
+
+def bench_upload(subject_dir, work_dir, max_stmts=100, max_in_flight=4,
+                 latency=0.):
+    output_dir = os.path.join(work_dir, 'upload')
+    os.mkdir(output_dir)
+    graph, _ = fs_upload.to_graph(
+        subject_dir, 'bench', output_dir,
+        registry=MeasureRegistry(os.path.join(work_dir, 'fsterms.ttl')))
+    server = StubSparqlServer(latency=latency).start()
+    try:
+        stats, seconds = _timed(lambda: fs_upload.upload_graph(
+            graph, endpoint=server.url, uri='http://bench.nidm.org',
+            max_stmts=max_stmts, max_in_flight=max_in_flight))
+        if server.n_triples() != stats['statements']:
+            raise AssertionError('%d statements sent, %d stored' % (
+                stats['statements'], server.n_triples()))
+        result = _result(stats['statements'], 'statements', seconds)
+        result['requests'] = stats['requests']
+    finally:
+        server.stop()
+    return {'upload_graph': result}
+
+
+def bench_stats_job(subject_dirs, root, latency=0.):
+    server = StubFileServer(root, latency=latency).start()
+    # (entity, relpath, md5, url) rows, as returned by get_urls
+    rows = [(fs_upload.niiri['bench-%d' % idx].get_uri(),
+             os.path.relpath(filename, subject_dir),
+             hash_file(filename)['md5'], server.file_url(filename))
+            for subject_dir in subject_dirs
+            for idx, filename in enumerate(stats_files(subject_dir))]
+    try:
+        results, seconds = _timed(lambda: [query_convert.job(row)
+                                           for row in rows])
+        if any(result is None for result in results):
+            raise AssertionError('md5 mismatch reported by job')
+    finally:
+        server.stop()
+    return {'stats_job': _result(len(rows), 'files', seconds)}
+
+
+def collection_lines(collection, subject_dirs, server, first=0):
+    """Return the N-Triples statements get_urls queries for the stats files
+    of subject_dirs in a collection, and the number of files
+    """
+    lines = ['<%s> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> '
+             '<http://www.w3.org/ns/prov#Collection> .' % collection]
+    n_files = 0
+    for subject_dir in subject_dirs:
+        for filename in stats_files(subject_dir):
+            entity = fs_upload.niiri['bench-%d' % (first + n_files)].get_uri()
+            n_files += 1
+            lines.extend([
+                '<%s> <http://www.w3.org/ns/prov#hadMember> <%s> .' % (
+                    collection, entity),
+                '<%s> <http://freesurfer.net/fswiki/terms/FileType> '
+                '<http://freesurfer.net/fswiki/terms/statistic_file> .' %
+                entity,
+                '<%s> <http://freesurfer.net/fswiki/terms/relative_path> '
+                '"%s" .' % (entity, os.path.relpath(filename, subject_dir)),
+                '<%s> <http://www.w3.org/2000/10/swap/crypto#md5> "%s" .' % (
+                    entity, hash_file(filename)['md5']),
+                '<%s> <http://www.w3.org/ns/prov#location> "%s" .' % (
+                    entity, server.file_url(filename))])
+    return lines, n_files
+
+
+def bench_collection(subject_dirs, root, latency=0., n_downloads=4,
+                     n_parsers=2):
+    server = StubFileServer(root, latency=latency).start()
+    endpoint = StubSparqlServer(latency=latency).start()
+    collection = 'http://bench.nidm.org/collection'
+    # the statements get_urls queries, in a graph of their own
+    lines, n_files = collection_lines(collection, subject_dirs, server)
+    try:
+        SparqlUploader(endpoint.url, 'http://bench.nidm.org/files').upload(
+            [[line] for line in lines])
+        registry = MeasureRegistry(os.devnull)
+        graph_iri = 'http://bench.nidm.org/stats'
+        counts, seconds = _timed(lambda: query_convert.process_collection(
+            endpoint.url, collection, graph_iri, registry=registry,
+            n_downloads=n_downloads, n_parsers=n_parsers))
+        if counts['files'] != n_files or \
+                endpoint.n_triples(graph_iri) != \
+                counts['upload']['statements']:
+            raise AssertionError('%d of %d files converted, %d of %d '
+                                 'statements stored' % (
+                                     counts['files'], n_files,
+                                     endpoint.n_triples(graph_iri),
+                                     counts['upload']['statements']))
+    finally:
+        endpoint.stop()
+        server.stop()
+    return {'collection': _result(n_files, 'files', seconds)}
+
+
+def bench_collections(subject_dirs, root, latency=0., values_size=50,
+                      n_downloads=4, n_parsers=2):
+    """Convert the files of one collection per subject, the files of
+    values_size collections at a time
+    (query_convert_fs_stats.process_collections)
+    """
+    server = StubFileServer(root, latency=latency).start()
+    endpoint = StubSparqlServer(latency=latency).start()
+    collections = []
+    lines = []
+    n_files = 0
+    for idx, subject_dir in enumerate(subject_dirs):
+        collections.append('http://bench.nidm.org/collection-%d' % idx)
+        subject_lines, n_subject = collection_lines(
+            collections[-1], [subject_dir], server, first=n_files)
+        lines.extend(subject_lines)
+        n_files += n_subject
+    try:
+        SparqlUploader(endpoint.url, 'http://bench.nidm.org/files').upload(
+            [[line] for line in lines])
+        registry = MeasureRegistry(os.devnull)
+        graph_iri = 'http://bench.nidm.org/stats'
+        n_requests = endpoint.n_requests
+        counts, seconds = _timed(lambda: query_convert.process_collections(
+            endpoint.url, collections, graph_iri, values_size=values_size,
+            registry=registry, n_downloads=n_downloads, n_parsers=n_parsers))
+        if counts['files'] != n_files:
+            raise AssertionError('%d of %d files converted' % (
+                counts['files'], n_files))
+        result = _result(len(collections), 'collections', seconds)
+        result['requests'] = endpoint.n_requests - n_requests
+    finally:
+        endpoint.stop()
+        server.stop()
+    return {'collections': result}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, results, tolerance=0.2):
+    """Print the rates next to those of a previous run; return the names of
+    the benchmarks that got slower by more than tolerance
+    """
+    regressions = []
+    print('%-16s %14s %14s %8s' % ('benchmark', 'previous', 'rate',
+                                   'ratio'))
+    for name in sorted(results):
+        rate = results[name]['rate']
+        old = previous.get(name)
+        if old is None or not old['rate']:
+            print('%-16s %14s %14.1f %8s' % (name, '-', rate, '-'))
+            continue
+        ratio = rate / old['rate']
+        flag = ''
+        if ratio < 1 - tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-16s %14.1f %14.1f %7.2fx%s' % (name, old['rate'], rate,
+                                                ratio, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog='bench_suite.py',
+                                     description=__doc__)
+    parser.add_argument('-n', '--n_subjects', type=int, default=5,
+                        help='Number of synthetic subjects to encode')
+    parser.add_argument('--file_size', type=int, default=65536,
+                        help='Bytes of each synthetic volume/surface file')
+    parser.add_argument('--csv_rows', type=int, default=1000,
+                        help='Rows of the synthetic CSV file')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='Latency of the stub servers (seconds)')
+    parser.add_argument('--work_dir', type=str, default=os.getcwd(),
+                        help=('Directory for the scratch data (its path must '
+                              'not contain a name ignored by the encoder, '
+                              'e.g. tmp)'))
+    parser.add_argument('--results', type=str, default='bench_results.json',
+                        help='JSON file the results are appended to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative rate drop reported as a regression')
+    parser.add_argument('--strict', action='store_true',
+                        help='Exit with status 1 on regressions')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the scratch directory')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='fsbench-', dir=args.work_dir)
+    if fs_upload.file_classifier.is_ignored(os.path.join(work_dir, 'x')):
+        shutil.rmtree(work_dir)
+        parser.error('%s contains a path ignored by the encoder' % work_dir)
+    try:
+        subjects_dir = os.path.join(work_dir, 'subjects')
+        subject_dirs = make_subjects(subjects_dir, args.n_subjects,
+                                     file_size=args.file_size)
+        results = {}
+        results.update(bench_to_graph(subject_dirs, work_dir))
+        results.update(bench_stats(subject_dirs[0]))
+        results.update(bench_csv(work_dir, n_rows=args.csv_rows))
+        results.update(bench_upload(subject_dirs[0], work_dir,
+                                    latency=args.latency))
+        results.update(bench_stats_job(subject_dirs, subjects_dir,
+                                       latency=args.latency))
+        results.update(bench_collection(subject_dirs, subjects_dir,
+                                        latency=args.latency))
+        results.update(bench_collections(subject_dirs, subjects_dir,
+                                         latency=args.latency))
+    finally:
+        if args.keep:
+            print('Scratch data kept in %s' % work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+    runs = []
+    if os.path.exists(args.results):
+        with open(args.results, 'rt') as fp:
+            runs = json.load(fp)
+    regressions = compare(runs[-1]['results'] if runs else {}, results,
+                          tolerance=args.tolerance)
+    runs.append({'time': time.time(), 'revision': git_revision(),
+                 'params': vars(args), 'results': results})
+    with open(args.results, 'wt') as fp:
+        json.dump(runs, fp, indent=2, sort_keys=True)
+    if regressions and args.strict:
+        raise SystemExit(1)
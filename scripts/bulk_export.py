@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""Export N-Triples groups as gzipped N-Quads shards for bulk loaders
+
+Triplestores load files from a directory much faster than they accept
+INSERT DATA requests (e.g., Virtuoso's ld_dir('<dir>', '*.nq.gz', ...) and
+rdf_loader_run(), or the bulk loaders of Blazegraph and Jena). ShardWriter
+writes groups of N-Triples lines (see rdf_stream) as N-Quads in the named
+graph given, to <prefix>-00000.nq.gz, <prefix>-00001.nq.gz, ... and starts a
+new shard once `max_bytes` of N-Quads were written. The lines of one group
+(a PROV record) are never split across shards, so the blank nodes of a
+qualified relation stay in one file.
+
+Every export directory has a manifest.json listing its shards:
+
+    {"shards": {<file>: {"graph": ..., "triples": ..., "bytes": ...,
+                         "md5": <digest of the .nq.gz file>}},
+     "triples": <total>}
+
+Run this script on an export directory to load the shards into an rdflib
+Dataset and check the number of triples of each shard and graph.
+"""
+
+import fcntl
+import gzip
+import json
+import os
+import re
+import tempfile
+
+from hash_cache import hash_file
+import profiling
+
+manifest_name = 'manifest.json'
+shard_pattern = '%s-%05d.nq.gz'
+
+
+def nquad(line, graph_iri):
+    """Return the N-Quads line of an N-Triples line in a named graph
+    """
+    line = line.rstrip()
+    if not line.endswith('.'):
+        raise ValueError('Not an N-Triples statement: %s' % line)
+    return '%s <%s> .\n' % (line[:-1].rstrip(), graph_iri)
+
+
+class ShardWriter(object):
+    """Write groups of N-Triples lines to gzipped N-Quads shards
+
+    export_dir: directory the shards are written to
+    graph_iri: named graph of the quads
+    prefix: shard filename prefix (shards of an earlier export with the same
+        prefix are removed)
+    max_bytes: uncompressed size after which a new shard is started
+    """
+
+    def __init__(self, export_dir, graph_iri, prefix, max_bytes=256 << 20,
+                 compresslevel=6):
+        if not graph_iri:
+            raise ValueError('A graph IRI is required for N-Quads shards')
+        self.export_dir = export_dir
+        self.graph_iri = graph_iri
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+        self.shards = {}
+        self.n_triples = 0
+        self._fp = None
+        self._name = None
+        shard_re = re.compile(r'%s-\d{5}\.nq\.gz$' % re.escape(prefix))
+        for name in os.listdir(export_dir):
+            if shard_re.match(name):
+                os.unlink(os.path.join(export_dir, name))
+
+    def _open(self):
+        self._name = shard_pattern % (self.prefix, len(self.shards))
+        self._fp = gzip.open(os.path.join(self.export_dir, self._name), 'wb',
+                             self.compresslevel)
+        self.shards[self._name] = {'graph': self.graph_iri, 'triples': 0,
+                                   'bytes': 0}
+
+    def _close_shard(self):
+        if self._fp is None:
+            return
+        self._fp.close()
+        self._fp = None
+        self.shards[self._name]['md5'] = hash_file(
+            os.path.join(self.export_dir, self._name))['md5']
+
+    def write_group(self, lines):
+        """Write a list of N-Triples lines to the current shard
+        """
+        if not lines:
+            return
+        quads = ''.join(nquad(line, self.graph_iri) for line in lines)
+        if self._fp is not None and \
+                self.shards[self._name]['bytes'] + len(quads) > self.max_bytes:
+            self._close_shard()
+        if self._fp is None:
+            self._open()
+        self._fp.write(quads)
+        info = self.shards[self._name]
+        info['triples'] += len(lines)
+        info['bytes'] += len(quads)
+        self.n_triples += len(lines)
+
+    def write_groups(self, groups):
+        for lines in groups:
+            self.write_group(lines)
+        return self
+
+    def close(self):
+        """Close the last shard; return the {file: info} entries written
+        """
+        self._close_shard()
+        return self.shards
+
+
+def export_groups(groups, export_dir, graph_iri, prefix, max_bytes=256 << 20):
+    """Write groups of N-Triples lines to shards; return their entries
+    """
+    with profiling.stage('export'):
+        writer = ShardWriter(export_dir, graph_iri, prefix,
+                             max_bytes=max_bytes)
+        shards = writer.write_groups(groups).close()
+    profiling.count('export', triples=writer.n_triples, shards=len(shards))
+    return shards
+
+
+def load_manifest(export_dir):
+    filename = os.path.join(export_dir, manifest_name)
+    if not os.path.exists(filename):
+        return {'shards': {}, 'triples': 0}
+    with open(filename, 'rt') as fp:
+        return json.load(fp)
+
+
+def write_manifest(export_dir, shards):
+    """Add shard entries to the manifest of an export directory
+
+    Entries of shards that no longer exist (e.g., the last shards of a
+    subject that got smaller since the previous export) are dropped. The
+    manifest is read and replaced under an exclusive lock
+    (manifest.json.lock), so concurrent exports keep each other's entries.
+    """
+    filename = os.path.join(export_dir, manifest_name)
+    with open(filename + '.lock', 'a') as lock_fp:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+        try:
+            manifest = load_manifest(export_dir)
+            manifest['shards'].update(shards)
+            for name in list(manifest['shards']):
+                if not os.path.exists(os.path.join(export_dir, name)):
+                    del manifest['shards'][name]
+            manifest['triples'] = sum(info['triples']
+                                      for info in manifest['shards'].values())
+            fd, tmp_file = tempfile.mkstemp(dir=export_dir,
+                                            suffix='.json.tmp')
+            try:
+                with os.fdopen(fd, 'wt') as fp:
+                    json.dump(manifest, fp, indent=1, sort_keys=True)
+                os.chmod(tmp_file, 0o644)
+                os.rename(tmp_file, filename)
+            except:
+                os.unlink(tmp_file)
+                raise
+        finally:
+            fcntl.flock(lock_fp, fcntl.LOCK_UN)
+    return manifest
+
+
+def verify_export(export_dir):
+    """Load the shards of an export into an rdflib Dataset and compare the
+    triple counts with the manifest
+
+    Returns a list of error messages (empty if the export is consistent).
+    """
+    import rdflib
+    manifest = load_manifest(export_dir)
+    dataset = rdflib.Dataset()
+    errors = []
+    expected = {}
+    statements = {}
+    for name, info in sorted(manifest['shards'].items()):
+        filename = os.path.join(export_dir, name)
+        if hash_file(filename)['md5'] != info['md5']:
+            errors.append('%s: md5 mismatch' % name)
+        keys = statements.setdefault(info['graph'], set())
+        n_lines = 0
+        with gzip.open(filename, 'rb') as fp:
+            for line in fp:
+                if line.strip():
+                    n_lines += 1
+                    keys.add(line.strip())
+        if n_lines != info['triples']:
+            errors.append('%s: %d statements, %d in the manifest' % (
+                name, n_lines, info['triples']))
+        shard = rdflib.Dataset()
+        with gzip.open(filename, 'rb') as fp:
+            shard.parse(fp, format='nquads')
+        for quad in shard.quads((None, None, None, None)):
+            dataset.add(quad)
+        expected[info['graph']] = expected.get(info['graph'], 0) + \
+            info['triples']
+    if manifest['triples'] != sum(expected.values()):
+        errors.append('%d triples in the manifest, %d in its shards' % (
+            manifest['triples'], sum(expected.values())))
+    for graph_iri, n_triples in sorted(expected.items()):
+        n_loaded = len(dataset.graph(rdflib.URIRef(graph_iri)))
+        # statements repeated across shards (e.g., the agent of several
+        # subjects) are stored once; blank node labels are unique across
+        # shards, as rdflib makes them
+        n_distinct = len(statements[graph_iri])
+        if n_loaded != n_distinct:
+            errors.append('%s: %d triples loaded, %d distinct statements '
+                          'in the shards' % (graph_iri, n_loaded, n_distinct))
+        print('%s: %d triples loaded (%d written, %d distinct)' % (
+            graph_iri, n_loaded, n_triples, n_distinct))
+    return errors
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog='bulk_export.py',
+                                     description=__doc__)
+    parser.add_argument('export_dir', type=str,
+                        help='Directory with the shards and manifest.json')
+    args = parser.parse_args()
+
+    errors = verify_export(args.export_dir)
+    for error in errors:
+        print(error)
+    raise SystemExit(1 if errors else 0)
@@ -8,12 +8,15 @@ from hashlib import sha512
 import os
 import pwd
 import urllib2
-from uuid import uuid1
 
 import pandas as pd
-import numpy as np
 import prov.model as prov
 
+from bulk_export import export_groups, write_manifest
+from identifiers import id_function, random_id
+import profiling
+from rdf_stream import iter_ntriples_batches, iter_record_ntriples
+
 def safe_encode(x):
     """Encodes a python value for prov
     """
@@ -33,19 +36,45 @@ def get_url_hash(url):
     remote = urllib2.urlopen(url)
     urlhash = sha512()
     total_read = 0
-    while True:
-        data = remote.read(4096)
-        total_read += 4096
-        if not data:
-            break
-        urlhash.update(data)
+    with profiling.stage('hash'):
+        while True:
+            data = remote.read(4096)
+            if not data:
+                break
+            total_read += len(data)
+            urlhash.update(data)
+    profiling.count('hash', files=1, bytes_read=total_read)
     return urlhash.hexdigest()
 
-def csv2provgraph(filename, n_rows=None):
+def column_literals(values):
+    """Encode a column (pandas Series) for prov, as safe_encode would each
+    of its values, with None for the missing ones
+
+    The datatype is decided once from the dtype of the column and missing
+    values are found for the whole column, instead of testing every cell.
+    """
+    missing = pd.isnull(values).values
+    kind = values.dtype.kind
+    if kind in 'iub':
+        datatype = prov.XSD['integer']
+        values = [int(value) for value in values.values.tolist()]
+    elif kind == 'f':
+        datatype = prov.XSD['float']
+        values = values.values
+    else:
+        return [None if is_missing else safe_encode(value)
+                for value, is_missing in zip(values.values, missing)]
+    return [None if is_missing else prov.Literal(value, datatype)
+            for value, is_missing in zip(values, missing)]
+
+def csv2provgraph(filename, n_rows=None, make_id=random_id, batch_size=1000):
     """
     filename: path to file
     namespace: prov.Namespace instance to map column names to
     n_rows: number of rows to process
+    make_id: identifier function (see identifiers); content-derived
+        identifiers are based on the sha512 of the file and the row number
+    batch_size: number of rows whose columns are encoded at once
     """
     nidm = prov.Namespace('nidm', 'http://nidm.nidash.org/terms/')
     niiri = prov.Namespace('niiri', 'http://nidm.nidash.org/iri/')
@@ -57,25 +86,27 @@ def csv2provgraph(filename, n_rows=None):
     g.add_namespace(niiri)
     g.add_namespace(foaf)
 
-    # uuid method
-    get_id = lambda : uuid1().hex
+    url_hash = get_url_hash(filename)
+    username = pwd.getpwuid(os.geteuid()).pw_name
+    get_id = lambda *parts: make_id(url_hash, *parts)
 
     # url prov:entity
-    url_entity = g.entity(niiri[get_id()])
+    url_entity = g.entity(niiri[make_id('file', filename, url_hash)])
     url_entity.add_extra_attributes({prov.PROV['type']: nidm['csv_file'],
-                                     nidm['sha512']: get_url_hash(filename),
+                                     nidm['sha512']: url_hash,
                                      prov.PROV["location"]:
                                          prov.Literal(filename,
                                                       prov.XSD['AnyURI'])})
     # csv prov:collection
-    csv_id = get_id()
+    csv_id = get_id('collection')
     csv_collection = g.collection(niiri[csv_id])
     csv_collection.add_extra_attributes({prov.PROV['type']: nidm['csv_collection'],
                                          prov.PROV['label']: filename}
                                        )
     g.wasDerivedFrom(csv_collection, url_entity)
-    a0 = g.activity(niiri[get_id()], startTime=dt.isoformat(dt.utcnow()))
-    user_agent = g.agent(niiri[get_id()],
+    a0 = g.activity(niiri[get_id('activity')],
+                    startTime=dt.isoformat(dt.utcnow()))
+    user_agent = g.agent(niiri[make_id('agent', username)],
                          {prov.PROV["type"]: prov.PROV["Person"],
                           prov.PROV["label"]: pwd.getpwuid(os.geteuid()).pw_name,
                           foaf["name"]: pwd.getpwuid(os.geteuid()).pw_name})
@@ -83,10 +114,11 @@ def csv2provgraph(filename, n_rows=None):
                         {prov.PROV["Role"]: "LoggedInUser"})
     g.wasGeneratedBy(csv_collection, a0)
 
-    data = pd.read_csv(filename, na_values=["N/A", "pending", -999])
+    with profiling.stage('read_csv'):
+        data = pd.read_csv(filename, na_values=["N/A", "pending", -999])
 
     columns = data.keys()
-    column_collection = g.collection(niiri[get_id()])
+    column_collection = g.collection(niiri[get_id('columns')])
     column_collection.add_extra_attributes({prov.PROV['type']: nidm['column_headers']})
     g.hadMember(csv_collection, column_collection)
 
@@ -99,21 +131,27 @@ def csv2provgraph(filename, n_rows=None):
                                             prov.PROV['location']: col_id})
         g.hadMember(column_collection, column_entity)
 
+    if n_rows:
+        data = data.iloc[:n_rows]
     row_count = 0
-    for row in data.iterrows():
-        if n_rows and row_count >= n_rows:
-            break
-        row_count +=1
-        row_id = niiri[get_id()]
-        # each row is an entity
-        row_entity = g.entity(row_id)
-        attr = {prov.PROV['type']: nidm['csv_row'],
-                prov.PROV['location']: row_count}
-        g.hadMember(csv_collection, row_id)
-        for column in columns:
-            if not np.isnan(row[1][column]):
-                attr[column_uri[column]] = safe_encode(row[1][column])
-        row_entity.add_extra_attributes(attr)
+    for start in range(0, len(data), batch_size):
+        with profiling.stage('rows'):
+            batch = data.iloc[start:start + batch_size]
+            cells = [[(column_uri[column], value) for value in
+                      column_literals(batch[column])]
+                     for column in columns]
+            for row_cells in zip(*cells):
+                row_count += 1
+                row_id = niiri[get_id('row', row_count)]
+                # each row is an entity
+                row_entity = g.entity(row_id)
+                attr = [(prov.PROV['type'], nidm['csv_row']),
+                        (prov.PROV['location'], row_count)]
+                attr.extend(cell for cell in row_cells
+                            if cell[1] is not None)
+                g.hadMember(csv_collection, row_id)
+                row_entity.add_extra_attributes(attr)
+        profiling.count('rows', rows=len(batch))
     return g
 
 def upload_graph(graph, endpoint=None, uri='http://test.nidm.org'):
@@ -128,24 +166,34 @@ def upload_graph(graph, endpoint=None, uri='http://test.nidm.org'):
     session = requests.Session()
     session.headers = {'Accept': 'text/html'}  # HTML from SELECT queries
 
-    counter = 0
     max_stmts = 1000
-    stmts = graph.rdf().serialize(format='nt').splitlines()
-    N = len(stmts)
-    while (counter < N):
-        endcounter = min(N, counter + max_stmts)
+    N = 0
+    for stmts in profiling.timed('rdf', iter_ntriples_batches(
+            graph, max_stmts=max_stmts), 'batches'):
         query = """
         INSERT IN GRAPH <%s>
         {
         %s
         }
-        """ % (uri, '\n'.join(stmts[counter:endcounter]))
+        """ % (uri, '\n'.join(stmts))
         data = {'query': query}
-        result = session.post(endpoint, data=data)
+        with profiling.stage('upload'):
+            result = session.post(endpoint, data=data)
+        profiling.count('upload', requests=1, triples=len(stmts))
         print(result)
-        counter = endcounter
+        N += len(stmts)
     print('Submitted %d statemnts' % N)
 
+def export_graph(graph, export_dir, uri, prefix, max_bytes=256 << 20):
+    """Write the graph as gzipped N-Quads shards for a bulk loader and
+    add them to the manifest of export_dir (see bulk_export)
+    """
+    shards = export_groups(iter_record_ntriples(graph), export_dir, uri,
+                           prefix, max_bytes=max_bytes)
+    write_manifest(export_dir, shards)
+    print('Exported %d statements to %d shards' % (
+        sum(info['triples'] for info in shards.values()), len(shards)))
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(prog='csv2prov.py',
@@ -156,8 +204,39 @@ if __name__ == "__main__":
                         help='SPARQL endpoint to use for update')
     parser.add_argument('-g', '--graph_iri', type=str,
                         help='Graph IRI to store the triples')
+    parser.add_argument('--deterministic_ids', dest="deterministic_ids",
+                        action="store_true",
+                        help=('Derive record identifiers from the file '
+                              'digest and row numbers instead of random '
+                              'uuids, so re-runs give the same IRIs'))
+    parser.add_argument('--export_dir', dest="export_dir", type=str,
+                        help=('Write gzipped N-Quads shards in --graph_iri '
+                              'and a manifest.json to this directory for '
+                              'bulk loading instead of uploading'))
+    parser.add_argument('--shard_mb', dest="shard_mb", type=int, default=256,
+                        help='Uncompressed size of the N-Quads shards (MB)')
+    parser.add_argument('--profile', dest="profile", type=str,
+                        help=('Write the time and counters of each stage to '
+                              'this JSON file'))
+    parser.add_argument('--cprofile', dest="cprofile", action="store_true",
+                        help=('With --profile, also write a cProfile dump '
+                              'of the run to <profile>.prof'))
 
     args = parser.parse_args()
-
-    graph = csv2provgraph(args.url)
-    upload_graph(graph, endpoint=args.endpoint, uri=args.graph_iri)
+    if args.export_dir and args.graph_iri is None:
+        parser.error('--export_dir requires --graph_iri')
+    if args.profile:
+        profiling.enable(cprofile=args.cprofile)
+
+    graph = csv2provgraph(args.url,
+                          make_id=id_function(args.deterministic_ids))
+    if args.export_dir:
+        if not os.path.isdir(args.export_dir):
+            os.makedirs(args.export_dir)
+        prefix = os.path.splitext(os.path.basename(args.url.rstrip('/')))[0]
+        export_graph(graph, args.export_dir, args.graph_iri,
+                     prefix or 'csv', max_bytes=args.shard_mb << 20)
+    else:
+        upload_graph(graph, endpoint=args.endpoint, uri=args.graph_iri)
+    if args.profile:
+        profiling.print_report(profiling.write_report(args.profile))
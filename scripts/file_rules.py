@@ -0,0 +1,146 @@
+"""Match FreeSurfer filenames against the tagging and ignore rules
+
+A rule is a (key, uris) pair like the entries of fs_file_map in
+fs_upload_to_triplesore.py: a file whose name contains `key` is tagged with
+the key (without leading/trailing dots) and annotated with `uris`, each
+either a type or an (attribute, value) pair. FileClassifier compiles all
+keys into one Aho-Corasick automaton, so the matching keys of a name are
+found in a single pass, and memoizes the result per basename. The ignore
+substrings are compiled into one regular expression.
+
+Rules can be written (dump_rules) to and loaded from a JSON file:
+
+    {"ignore": ["bak", "src", "tmp", "trash", "touch"],
+     "rules": [["T1", ["nif:nlx_inv_20090243"]],
+               ["lh", [["nidm:anatomicalAnnotation", "obo:UBERON_0002812"]]],
+               ...]}
+
+where prefixed names are resolved against the given namespaces.
+"""
+
+import json
+import re
+
+
+class FileClassifier(object):
+    """Find the rules matching a filename
+
+    rules: list of (key, uris) in the order results are returned
+    ignore: substrings of paths that should not be encoded
+    max_cache: number of basenames memoized (the memo is cleared when full)
+    """
+
+    def __init__(self, rules, ignore=(), max_cache=100000):
+        self.rules = [(key, key.rstrip('.').lstrip('.'), list(uris))
+                      for key, uris in rules]
+        self.ignore = list(ignore)
+        if self.ignore:
+            self._ignore_re = re.compile('|'.join(re.escape(key)
+                                                  for key in self.ignore))
+        else:
+            self._ignore_re = None
+        self.max_cache = max_cache
+        self._cache = {}
+        self._build([key for key, _, _ in self.rules])
+
+    def _build(self, keys):
+        """Build the goto, fail and output tables of the automaton
+        """
+        goto = [{}]
+        output = [[]]
+        for idx, key in enumerate(keys):
+            state = 0
+            for char in key:
+                if char not in goto[state]:
+                    goto.append({})
+                    output.append([])
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            output[state].append(idx)
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for char, child in goto[state].items():
+                queue.append(child)
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[child] = goto[fallback].get(char, 0)
+                if fail[child] == child:
+                    fail[child] = 0
+                output[child] = output[child] + output[fail[child]]
+        self._goto = goto
+        self._fail = fail
+        self._output = output
+
+    def matching_rules(self, filename):
+        """Return the indices of all rules whose key occurs in filename
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set()
+        state = 0
+        for char in filename:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return sorted(found)
+
+    def match(self, filename):
+        """Return [(tag, uris)] of the rules matching a basename (memoized)
+        """
+        try:
+            return self._cache[filename]
+        except KeyError:
+            pass
+        result = [self.rules[idx][1:] for idx in self.matching_rules(filename)]
+        if len(self._cache) >= self.max_cache:
+            self._cache.clear()
+        self._cache[filename] = result
+        return result
+
+    def is_ignored(self, path):
+        """Whether a path contains one of the ignore substrings
+        """
+        return self._ignore_re is not None and \
+            self._ignore_re.search(path) is not None
+
+
+def _resolve(name, namespaces):
+    prefix, local_part = name.split(':', 1)
+    return namespaces[prefix][local_part]
+
+
+def load_rules(filename, namespaces):
+    """Read (rules, ignore) from a JSON rule file
+
+    namespaces: dict of prefix to prov.Namespace used to resolve the
+        prefixed names of the file
+    """
+    with open(filename, 'rt') as fp:
+        table = json.load(fp)
+    rules = []
+    for key, uris in table.get('rules', []):
+        resolved = []
+        for uri in uris:
+            if isinstance(uri, list):
+                resolved.append((_resolve(uri[0], namespaces),
+                                 _resolve(uri[1], namespaces)))
+            else:
+                resolved.append(_resolve(uri, namespaces))
+        rules.append((key, resolved))
+    return rules, table.get('ignore', [])
+
+
+def dump_rules(rules, ignore, filename):
+    """Write rules with prov QName values as a JSON rule file
+    """
+    table = {'ignore': list(ignore),
+             'rules': [[key, [[unicode(uri[0]), unicode(uri[1])]
+                              if isinstance(uri, tuple) else unicode(uri)
+                              for uri in uris]]
+                       for key, uris in rules]}
+    with open(filename, 'wt') as fp:
+        json.dump(table, fp, indent=1)
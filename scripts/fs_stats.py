@@ -0,0 +1,247 @@
+"""Reader for FreeSurfer .stats files shared by the upload scripts
+
+The table body is parsed in one pass into typed NumPy column arrays; the
+commented header (`Measure` lines and `TableCol` metadata) is kept
+separately. Columns whose units are unitless/NA and hold no decimal point are
+integers, all other numeric columns are floats, the structure name column
+stays a string array.
+
+read_stats returns the (header, tableinfo, measures) structure that
+parse_stats consumes, with typed values; iter_stats yields the table
+measures lazily, one row at a time.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+unknown_units = set(('unitless', 'NA'))
+
+
+def typed_value(value, units):
+    """Convert a header measure value the way table columns are converted
+    """
+    if str(units) in unknown_units and '.' not in value:
+        return int(value)
+    return float(value)
+
+
+def typed_column(values, units):
+    """Convert a column of value strings to an int, float or string array
+    """
+    values = np.asarray(values, dtype=str)
+    try:
+        if units in unknown_units and \
+                not (np.char.find(values, '.') >= 0).any():
+            return values.astype(np.int64)
+        return values.astype(np.float64)
+    except ValueError:
+        return values
+
+
+class StatsTable(object):
+    """Contents of a .stats file
+
+    header: dict of commented header fields (e.g., subjectname)
+    tableinfo: dict of column index (1-based) to ColHeader/FieldName/Units
+    measures: list of the header `Measure` dicts
+    columns: OrderedDict of ColHeader to column array
+    struct_idx: index (1-based) of the StructName column
+    """
+
+    def __init__(self):
+        self.header = {}
+        self.tableinfo = {}
+        self.measures = []
+        self.columns = OrderedDict()
+        self.struct_idx = None
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(self.columns.values()[0])
+
+    @property
+    def structures(self):
+        return self.columns[self.tableinfo[self.struct_idx]['ColHeader']]
+
+    def _parse_header_line(self, line):
+        fields = line.split()[1:]
+        if len(fields) < 2:
+            return
+        tag = fields[0]
+        tableinfo = self.tableinfo
+        if tag == 'TableCol':
+            col_idx = int(fields[1])
+            if col_idx not in tableinfo:
+                tableinfo[col_idx] = {}
+            tableinfo[col_idx][fields[2]] = ' '.join(fields[3:])
+            if tableinfo[col_idx][fields[2]] == "StructName":
+                self.struct_idx = col_idx
+        elif tag == "Measure":
+            fields = ' '.join(fields[1:]).split(', ')
+            self.measures.append({'structure': fields[0],
+                                  'name': fields[1],
+                                  'description': fields[2],
+                                  'value': typed_value(fields[3], fields[4]),
+                                  'units': fields[4],
+                                  'source': 'Header'})
+        elif tag == "ColHeaders":
+            if len(fields) != len(tableinfo):
+                for idx, fieldname in enumerate(fields[1:]):
+                    if idx + 1 in tableinfo:
+                        continue
+                    tableinfo[idx + 1] = {'ColHeader': fieldname,
+                                          'Units': 'unknown',
+                                          'FieldName': fieldname}
+                    if fieldname == 'StructName':
+                        self.struct_idx = idx + 1
+        else:
+            self.header[tag] = ' '.join(fields[1:])
+
+    def _set_columns(self, tokens, n_rows):
+        n_cols = len(self.tableinfo)
+        if n_rows and len(tokens) != n_rows * n_cols:
+            raise ValueError('Stats table rows do not have %d columns' %
+                             n_cols)
+        structures = None
+        if self.struct_idx is not None:
+            structures = np.array(tokens[self.struct_idx - 1::n_cols],
+                                  dtype=str)
+            del tokens[self.struct_idx - 1::n_cols]
+            n_cols -= 1
+        # parse all numeric cells at once; fall back to per-column conversion
+        # if a column does not hold numbers
+        values = np.fromstring(' '.join(tokens), sep=' ')
+        numeric = values.size == len(tokens)
+        if numeric:
+            values = values.reshape(n_rows, n_cols)
+        pos = 0
+        for col_idx in sorted(self.tableinfo):
+            info = self.tableinfo[col_idx]
+            if col_idx == self.struct_idx:
+                self.columns[info['ColHeader']] = structures
+                continue
+            raw = tokens[pos::n_cols]
+            if not numeric:
+                column = typed_column(raw, info['Units'])
+            elif info['Units'] in unknown_units and '.' not in ''.join(raw):
+                column = values[:, pos].astype(np.int64)
+            else:
+                column = np.ascontiguousarray(values[:, pos])
+            self.columns[info['ColHeader']] = column
+            pos += 1
+
+    def row_measure(self, structure, values):
+        """Return the measure dict of one table row
+        """
+        items = []
+        for idx, value in enumerate(values):
+            if idx + 1 == self.struct_idx:
+                continue
+            info = self.tableinfo[idx + 1]
+            items.append({'name': info['ColHeader'],
+                          'description': info['FieldName'],
+                          'value': value,
+                          'units': info['Units']})
+        return {'structure': structure,
+                'items': items,
+                'source': 'Table'}
+
+    def table_measures(self):
+        """Yield the measure dicts of all table rows
+        """
+        names = [(self.tableinfo[col_idx]['ColHeader'],
+                  self.tableinfo[col_idx]['FieldName'],
+                  self.tableinfo[col_idx]['Units'])
+                 for col_idx in sorted(self.tableinfo)
+                 if col_idx != self.struct_idx]
+        columns = [self.columns[name].tolist() for name, _, _ in names]
+        for structure, values in zip(self.structures.tolist(),
+                                     zip(*columns)):
+            yield {'structure': structure,
+                   'items': [{'name': name,
+                              'description': description,
+                              'value': value,
+                              'units': units}
+                             for (name, description, units), value
+                             in zip(names, values)],
+                   'source': 'Table'}
+
+
+def load_stats(filename):
+    """Parse a .stats file into a StatsTable with typed column arrays
+
+    filename can also be an open file (e.g., a StringIO of a downloaded
+    file).
+    """
+    if not isinstance(filename, basestring):
+        return _parse_lines(filename)
+    with open(filename, 'rt') as fp:
+        return _parse_lines(fp)
+
+
+def _parse_lines(lines):
+    table = StatsTable()
+    tokens = []
+    n_rows = 0
+    for line in lines:
+        if line == line[0]:
+            continue
+        #parse commented header
+        if line.startswith('#'):
+            table._parse_header_line(line)
+        else:
+            row = line.split()
+            if row:
+                tokens.extend(row)
+                n_rows += 1
+    table._set_columns(tokens, n_rows)
+    return table
+
+
+def read_stats(filename):
+    """Convert stats file to a structure
+    """
+    table = load_stats(filename)
+    measures = table.measures + list(table.table_measures())
+    return table.header, table.tableinfo, measures
+
+
+def iter_stats(filename):
+    """Parse the header of a stats file and iterate over its table lazily
+
+    Returns the StatsTable holding the header, tableinfo and header measures
+    (but no columns), and a generator of the table row measure dicts with
+    values converted per cell like typed_value.
+    """
+    table = StatsTable()
+    fp = open(filename, 'rt')
+    first_row = None
+    for line in fp:
+        if line == line[0]:
+            continue
+        if line.startswith('#'):
+            table._parse_header_line(line)
+            continue
+        first_row = line.split()
+        if first_row:
+            break
+
+    def typed_row(row):
+        values = [value if idx + 1 == table.struct_idx
+                  else typed_value(value, table.tableinfo[idx + 1]['Units'])
+                  for idx, value in enumerate(row)]
+        return table.row_measure(row[table.struct_idx - 1], values)
+
+    def rows():
+        try:
+            if first_row:
+                yield typed_row(first_row)
+            for line in fp:
+                row = line.split()
+                if row and not line.startswith('#'):
+                    yield typed_row(row)
+        finally:
+            fp.close()
+    return table, rows()
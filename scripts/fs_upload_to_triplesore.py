@@ -3,32 +3,46 @@
 """
 
 # standard library
+from collections import deque
 from cPickle import dumps
 from datetime import datetime as dt
 import hashlib
+from itertools import chain
 import os
 import pwd
 from socket import getfqdn
-import uuid
 
 import prov.model as prov
 import rdflib
 
+from bulk_export import export_groups, write_manifest
+from file_rules import FileClassifier, load_rules
+from fs_stats import read_stats
+from hash_cache import HashCache, hash_file
+from id_map import IdMap, id_rewriter, write_mapper
+from identifiers import id_function, random_id
+from interning import Interner, PathCache
+from measure_registry import MeasureRegistry
+import profiling
+from progress_journal import ProgressJournal
+from rdf_stream import (RecordWriter, iter_record_ntriples, iter_ttl_groups,
+                        write_ttl_groups)
+from sparql_upload import SparqlUploader
+from stats_triples import ntriples, stats_triples, stats_vocabulary
+from subject_manifest import (file_state, is_unchanged, load_manifest,
+                              manifest_filename, new_manifest, save_manifest)
 
-def hash_infile(afile, crypto=hashlib.md5, chunk_len=8192):
+
+def hash_infile(afile, crypto=hashlib.md5, chunk_len=8192, cache=None):
     """ Computes hash of a file using 'crypto' module"""
-    hex = None
-    if os.path.isfile(afile):
-        crypto_obj = crypto()
-        fp = file(afile, 'rb')
-        while True:
-            data = fp.read(chunk_len)
-            if not data:
-                break
-            crypto_obj.update(data)
-        fp.close()
-        hex = crypto_obj.hexdigest()
-    return hex
+    name = crypto().name
+    if cache is not None:
+        digests = cache.hash_file(afile, (name,))
+    else:
+        digests = hash_file(afile, (name,), chunk_len=chunk_len)
+    if digests is None:
+        return None
+    return digests[name]
 
 # create namespace references to terms used
 foaf = prov.Namespace("foaf", "http://xmlns.com/foaf/0.1/")
@@ -43,6 +57,18 @@ crypto = prov.Namespace("crypto",
                         ("http://id.loc.gov/vocabulary/preservation/"
                          "cryptographicHashFunctions/"))
 
+# terms of the stats collections written directly by stats_triples, matching
+# those of parse_stats
+stats_terms = stats_vocabulary(
+    fs.get_uri(), nidm.get_uri(), niiri.get_uri(),
+    fs['FreeSurferStatsCollection'].get_uri(), fs['StatFileHeader'].get_uri(),
+    nidm['anatomicalAnnotation'].get_uri(), nidm['unitsLabel'].get_uri(),
+    header_key=lambda key: key.replace('.c', '-c'),
+    structure_key=lambda name: name.replace('.', '-'),
+    namespaces=dict((ns.get_prefix(), ns.get_uri())
+                    for ns in [prov.PROV, prov.XSD, foaf, dcterms, fs, nidm,
+                               niiri, obo, nif, crypto]))
+
 # map FreeSurfer filename parts
 fs_file_map = [('T1', [nif["nlx_inv_20090243"]]),  # 3d T1 weighted scan
                ('lh', [(nidm["anatomicalAnnotation"], obo["UBERON_0002812"])]),  # left cerebral hemisphere
@@ -78,8 +104,27 @@ fs_file_map = [('T1', [nif["nlx_inv_20090243"]]),  # 3d T1 weighted scan
 # files or directories that should be ignored
 ignore_list = ['bak', 'src', 'tmp', 'trash', 'touch']
 
+# fs_file_map and ignore_list compiled into one matcher (see use_file_rules)
+file_classifier = FileClassifier(fs_file_map, ignore_list)
+
+
+def use_file_rules(filename):
+    """Replace fs_file_map and ignore_list by the rules of a JSON file (see
+    file_rules.load_rules)
+    """
+    global file_classifier
+    namespaces = dict((ns.get_prefix(), ns)
+                      for ns in [prov.PROV, foaf, dcterms, fs, nidm, niiri,
+                                 obo, nif, crypto])
+    rules, ignore = load_rules(filename, namespaces)
+    file_classifier = FileClassifier(rules, ignore)
+
 max_text_len = 1024000
 
+# shared attribute values and os.path.exists results (see interning)
+interner = Interner()
+path_cache = PathCache()
+
 def safe_encode(x, as_literal=True):
     """Encodes a python value for prov
     """
@@ -91,7 +136,7 @@ def safe_encode(x, as_literal=True):
             return value
     try:
         if isinstance(x, (str, unicode)):
-            if os.path.exists(x):
+            if path_cache.exists(x):
                 value = 'file://%s%s' % (getfqdn(), x)
                 if not as_literal:
                     return value
@@ -125,98 +170,43 @@ def safe_encode(x, as_literal=True):
         return prov.Literal(value, prov.XSD['string'])
 
 
-def read_stats(filename):
-    """Convert stats file to a structure
-    """
-    header = {}
-    tableinfo = {}
-    measures = []
-    rowmeasures = []
-    with open(filename, 'rt') as fp:
-        lines = fp.readlines()
-        for line in lines:
-            if line == line[0]:
-                continue
-            #parse commented header
-            if line.startswith('#'):
-                fields = line.split()[1:]
-                if len(fields) < 2:
-                    continue
-                tag = fields[0]
-                if tag == 'TableCol':
-                    col_idx = int(fields[1])
-                    if col_idx not in tableinfo:
-                        tableinfo[col_idx] = {}
-                    tableinfo[col_idx][fields[2]] = ' '.join(fields[3:])
-                    if tableinfo[col_idx][fields[2]] == "StructName":
-                        struct_idx = col_idx
-                elif tag == "Measure":
-                    fields = ' '.join(fields[1:]).split(', ')
-                    measures.append({'structure': fields[0],
-                                     'name': fields[1],
-                                     'description': fields[2],
-                                     'value': fields[3],
-                                     'units': fields[4],
-                                     'source': 'Header'})
-                elif tag == "ColHeaders":
-                    if len(fields) != len(tableinfo):
-                        for idx, fieldname in enumerate(fields[1:]):
-                            if idx + 1 in tableinfo:
-                                continue
-                            tableinfo[idx + 1] = {'ColHeader': fieldname,
-                                                  'Units': 'unknown',
-                                                  'FieldName': fieldname}
-                    else:
-                        continue
-                else:
-                    header[tag] = ' '.join(fields[1:])
-            else:
-                #read values
-                row = line.split()
-                values = {}
-                measures.append({'structure': row[struct_idx-1],
-                                 'items': [],
-                                 'source': 'Table'}),
-                for idx, value in enumerate(row):
-                    if idx + 1 == struct_idx:
-                        continue
-                    measures[-1]['items'].append({
-                        'name': tableinfo[idx + 1]['ColHeader'],
-                        'description': tableinfo[idx + 1]['FieldName'],
-                        'value': value,
-                        'units': tableinfo[idx + 1]['Units'],
-                        })
-    return header, tableinfo, measures
-
-def parse_stats(g, fs_stat_file, entity_uri):
+def parse_stats(g, fs_stat_file, entity_uri, rewrite=None, make_id=random_id):
     """Convert stats file to a nidm object
+
+    rewrite: function applied to the header values (see id_map.id_rewriter)
+    make_id: identifier function (see identifiers); content-derived
+        identifiers are based on the IRI of the file entity
     """
 
     header, tableinfo, measures = read_stats(fs_stat_file)
 
-    get_id = lambda : niiri[uuid.uuid1().hex]
-    a0 = g.activity(get_id(), startTime=dt.isoformat(dt.utcnow()))
-    user_agent = g.agent(get_id(),
+    entity_iri = entity_uri.get_identifier().get_uri()
+    get_id = lambda *parts: niiri[make_id(entity_iri, *parts)]
+    username = interner.text(pwd.getpwuid(os.geteuid()).pw_name)
+    a0 = g.activity(get_id('activity'), startTime=dt.isoformat(dt.utcnow()))
+    user_agent = g.agent(niiri[make_id('agent', username)],
                          {prov.PROV["type"]: prov.PROV["Person"],
-                          prov.PROV["label"]: pwd.getpwuid(os.geteuid()).pw_name,
-                          foaf["name"]: pwd.getpwuid(os.geteuid()).pw_name})
+                          prov.PROV["label"]: username,
+                          foaf["name"]: username})
     g.wasAssociatedWith(a0, user_agent, None, None,
                         {prov.PROV["Role"]: "LoggedInUser"})
-    stat_collection = g.collection(get_id())
+    stat_collection = g.collection(get_id('collection'))
     stat_collection.add_extra_attributes({prov.PROV['type']: fs['FreeSurferStatsCollection']})
     # header elements
-    statheader_collection = g.entity(get_id())
+    statheader_collection = g.entity(get_id('header'))
     attributes = {prov.PROV['type']: fs['StatFileHeader']}
     for key, value in header.items():
-        attributes[fs[key.replace('.c', '-c')]] = value
+        if rewrite is not None:
+            value = rewrite(value)
+        attributes[fs[key.replace('.c', '-c')]] = interner.text(value)
     statheader_collection.add_extra_attributes(attributes)
     # measures
     struct_info = {}
+    struct_count = {}
     measure_list = []
     measure_graph = rdflib.ConjunctiveGraph()
     measure_graph.namespace_manager.bind('fs', fs.get_uri())
     measure_graph.namespace_manager.bind('nidm', nidm.get_uri())
-    unknown_units = set(('unitless', 'NA'))
     for measure in measures:
         obj_attr = []
         struct_uri = fs[measure['structure'].replace('.', '-')]
@@ -235,23 +225,23 @@ def parse_stats(g, fs_stat_file, entity_uri):
                                    nidm['unitsLabel'].rdf_representation(),
                                    rdflib.Literal(measure['units'])))
             obj_attr.append((nidm["anatomicalAnnotation"], struct_uri))
-            if str(measure['units']) in unknown_units and \
-                    '.' not in measure['value']:
-                valref = prov.Literal(int(measure['value']), prov.XSD['integer'])
+            # values are already typed by fs_stats.read_stats
+            if isinstance(measure['value'], (int, long)):
+                valref = interner.literal(measure['value'],
+                                          prov.XSD['integer'])
             else:
-                valref= prov.Literal(float(measure['value']), prov.XSD['float'])
+                valref = interner.literal(measure['value'], prov.XSD['float'])
             obj_attr.append((fs[measure_name], valref))
         elif measure['source'] == 'Table':
             obj_attr.append((nidm["anatomicalAnnotation"], struct_uri))
             for column_info in measure['items']:
                 measure_name = column_info['name']
-                if column_info['units'] in unknown_units and \
-                   '.' not in column_info['value']:
-                    valref = prov.Literal(int(column_info['value']),
-                                          prov.XSD['integer'])
+                if isinstance(column_info['value'], (int, long)):
+                    valref = interner.literal(column_info['value'],
+                                              prov.XSD['integer'])
                 else:
-                    valref= prov.Literal(float(column_info['value']),
-                                         prov.XSD['float'])
+                    valref = interner.literal(column_info['value'],
+                                              prov.XSD['float'])
                 obj_attr.append((fs[measure_name], valref))
                 if measure_name not in measure_list:
                     measure_list.append(measure_name)
@@ -265,7 +255,11 @@ def parse_stats(g, fs_stat_file, entity_uri):
                     measure_graph.add((measure_uri,
                                        nidm['unitsLabel'].rdf_representation(),
                                        rdflib.Literal(column_info['units'])))
-        id = get_id()
+        # a repeated structure gets a new member id (its values are added to
+        # the first entity)
+        struct_count[struct_uri] = struct_count.get(struct_uri, -1) + 1
+        id = get_id('structure', struct_uri._localpart,
+                    struct_count[struct_uri])
         if struct_uri in struct_info:
             euri = struct_info[struct_uri]
             euri.add_extra_attributes(obj_attr)
@@ -278,125 +272,378 @@ def parse_stats(g, fs_stat_file, entity_uri):
     g.wasGeneratedBy(stat_collection, a0)
     return g, measure_graph
 
-def create_entity(graph, fs_subject_id, filepath, hostname):
+def hash_digests(filepath, hash_cache=None):
+    """Return the md5 and sha512 digests of a file (None if not a file)
+    """
+    profiling.count('hash', files=1)
+    with profiling.stage('hash'):
+        if hash_cache is not None:
+            return hash_cache.hash_file(filepath, ('md5', 'sha512'))
+        return hash_file(filepath, ('md5', 'sha512'))
+
+
+def create_entity(graph, fs_subject_id, filepath, hostname, hash_cache=None,
+                  digests=None, rewrite=None, make_id=random_id):
     """ Create a PROV entity for a file in a FreeSurfer directory
+
+    rewrite: function applied to the path and names of the file before they
+        are encoded (see id_map.id_rewriter)
+    make_id: identifier function (see identifiers); content-derived
+        identifiers are based on the subject, relative path and md5
     """
     # identify FreeSurfer terms based on directory and file names
-    _, filename = os.path.split(filepath)
     relpath = filepath.split(fs_subject_id)[1].lstrip(os.path.sep)
+    if digests is None:
+        digests = hash_digests(filepath, hash_cache=hash_cache)
+    if rewrite is not None:
+        filepath = rewrite(filepath)
+        relpath = rewrite(relpath)
+    _, filename = os.path.split(filepath)
     fstypes = relpath.split('/')[:-1]
     additional_types = relpath.split('/')[-1].split('.')
 
-    file_md5_hash = hash_infile(filepath, crypto=hashlib.md5)
-    file_sha512_hash = hash_infile(filepath, crypto=hashlib.sha512)
-    if file_md5_hash is None:
+    # digests (from hash_digests or iter_hashed_files) are None for
+    # anything that is not a regular file
+    if digests is None:
         print('Empty file: %s' % filepath)
-
+        digests = {'md5': None, 'sha512': None}
+    file_md5_hash = digests['md5']
+    file_sha512_hash = digests['sha512']
     url = "file://%s%s" % (hostname, filepath)
-    obj_attr = [(prov.PROV["label"], filename),
-                (fs["relative_path"], "%s" % relpath),
+    obj_attr = [(prov.PROV["label"], interner.text(filename)),
+                (fs["relative_path"], interner.text(relpath)),
                 (prov.PROV["location"], prov.URIRef(url)),
                 (crypto["md5"], "%s" % file_md5_hash),
                 (crypto["sha512"], "%s" % file_sha512_hash)
                 ]
 
     for key in fstypes:
-        obj_attr.append((nidm["tag"], key))
+        obj_attr.append((nidm["tag"], interner.text(key)))
     for key in additional_types:
-        obj_attr.append((nidm["tag"], key))
-
-    for key, uris in fs_file_map:
-        if key in filename:
-            if key.rstrip('.').lstrip('.') not in fstypes + additional_types:
-                obj_attr.append((nidm["tag"], key.rstrip('.').lstrip('.')))
-            for uri in uris:
-                if isinstance(uri, tuple):
-                    obj_attr.append((uri[0], uri[1]))
-                else:
-                    obj_attr.append((prov.PROV["type"], uri))
-    id = uuid.uuid1().hex
+        obj_attr.append((nidm["tag"], interner.text(key)))
+
+    tags = set(fstypes).union(additional_types)
+    for tag, uris in file_classifier.match(filename):
+        if tag not in tags:
+            obj_attr.append((nidm["tag"], interner.text(tag)))
+        for uri in uris:
+            if isinstance(uri, tuple):
+                obj_attr.append((uri[0], uri[1]))
+            else:
+                obj_attr.append((prov.PROV["type"], uri))
+    id = make_id('file', rewrite(fs_subject_id) if rewrite else fs_subject_id,
+                 relpath, file_md5_hash)
     return graph.entity(niiri[id], obj_attr)
 
 
-def encode_fs_directory(g, basedir, project_id, subject_id, n_items=100000):
+def _hash_or_error(filepath, hash_cache=None):
+    try:
+        return hash_digests(filepath, hash_cache=hash_cache), None
+    except IOError, e:
+        return None, e
+
+
+def iter_hashed_files(files, hash_cache=None, n_threads=4, prefetch=None):
+    """Yield (file, digests, error) for files, hashed ahead by a pool of
+    threads
+
+    Files are yielded in the order given, while up to `prefetch` (default:
+    4 per thread) of the next ones are read and hashed in the background;
+    hashlib releases the GIL, so this overlaps disk or network I/O with the
+    encoding of the previous files. error is the IOError raised while
+    hashing (digests is then None).
+    """
+    if n_threads <= 1:
+        for filepath in files:
+            digests, error = _hash_or_error(filepath, hash_cache=hash_cache)
+            yield filepath, digests, error
+        return
+    from multiprocessing.pool import ThreadPool
+    prefetch = prefetch or 4 * n_threads
+    pool = ThreadPool(n_threads)
+    pending = deque()
+    try:
+        for filepath in files:
+            pending.append((filepath, pool.apply_async(
+                _hash_or_error, (filepath,), {'hash_cache': hash_cache})))
+            if len(pending) >= prefetch:
+                filepath, result = pending.popleft()
+                yield (filepath,) + result.get()
+        while pending:
+            filepath, result = pending.popleft()
+            yield (filepath,) + result.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def is_stats_table(entity):
+    """Return whether a file entity is a .stats file with a measure table
+    (curvature stats are tagged 'curv' and have none)
+    """
+    _, attributes = entity.get_attributes()
+    values = [value for _, value in attributes or ()]
+    return fs['StatisticFile'] in values and \
+        u'curv' not in entity.get_attribute(nidm['tag'])
+
+
+def iter_fs_files(basedir, n_items=100000):
+    """Yield the files of a FreeSurfer directory that should be encoded
+    """
+    i = 0
+    for dirpath, dirnames, filenames in os.walk(os.path.realpath(basedir)):
+        for filename in sorted(filenames):
+            if filename.startswith('.'):
+                continue
+            i += 1
+            if i > n_items:
+                break
+            file2encode = os.path.realpath(os.path.join(dirpath, filename))
+            if not os.path.isfile(file2encode):
+                print "%s not a file" % file2encode
+                continue
+            if file_classifier.is_ignored(file2encode):
+                continue
+            yield file2encode
+
+
+def encode_fs_file(g, fsdir_collection, subject_id, file2encode, hostname,
+                   registry, hash_cache=None, digests=None, stats_records=None,
+                   rewrite=None, make_id=random_id):
+    """Encode a file (and its measures, for .stats files) as a member of the
+    subject directory collection
+
+    If a `stats_records` list is given, the stats collection is not added to
+    the bundle; its (identifier, triples) records from stats_triples are
+    appended to the list instead.
+    """
+    with profiling.stage('entity'):
+        entity = create_entity(g, subject_id, file2encode, hostname,
+                               hash_cache=hash_cache, digests=digests,
+                               rewrite=rewrite, make_id=make_id)
+    g.hadMember(fsdir_collection, entity.get_identifier())
+    with profiling.stage('type_check'):
+        is_stats = is_stats_table(entity)
+    if is_stats:
+        profiling.count('stats', files=1)
+        if stats_records is None:
+            with profiling.stage('stats'):
+                g, measure_graph = parse_stats(g, file2encode, entity,
+                                               rewrite=rewrite,
+                                               make_id=make_id)
+            registry.add(measure_graph)
+        else:
+            with profiling.stage('stats'):
+                records, terms = stats_triples(
+                    file2encode, entity.get_identifier().get_uri(),
+                    stats_terms, rewrite=rewrite, make_id=make_id)
+            stats_records.extend(records)
+            registry.add_triples(terms, namespaces=[('fs', fs.get_uri()),
+                                                    ('nidm', nidm.get_uri())])
+    return entity
+
+
+def record_fs_file(g, fsdir_collection, subject_id, file2encode, hostname,
+                   registry, hash_cache=None, digests=None, stats_records=None,
+                   rewrite=None, make_id=random_id):
+    """Encode a file and return its manifest entry
+
+    The entry lists the IRIs of every element created for the file, so they
+    can be deleted from the triplestore if the file changes later.
+    """
+    if digests is None:
+        digests = hash_digests(file2encode, hash_cache=hash_cache)
+    digests = digests or {}
+    n_records = len(g.get_records())
+    n_stats_records = len(stats_records or [])
+    encode_fs_file(g, fsdir_collection, subject_id, file2encode, hostname,
+                   registry, hash_cache=hash_cache, digests=digests or None,
+                   stats_records=stats_records, rewrite=rewrite,
+                   make_id=make_id)
+    iris = [record.get_identifier().get_uri()
+            for record in g.get_records()[n_records:]
+            if record.is_element() and record.get_identifier() is not None]
+    if stats_records:
+        iris.extend(unicode(identifier) for identifier, _
+                    in stats_records[n_stats_records:]
+                    if identifier is not None)
+    # a content-derived user agent is shared by the whole graph
+    agent_iri = niiri[make_id('agent',
+                              pwd.getpwuid(os.geteuid()).pw_name)].get_uri()
+    iris = [iri for iri in iris if iri != agent_iri]
+    entry = file_state(file2encode)
+    entry.update(md5=digests.get('md5'), sha512=digests.get('sha512'),
+                 iris=iris)
+    return entry
+
+
+def encode_fs_directory(g, basedir, project_id, subject_id, n_items=100000,
+                        hash_cache=None, registry=None, manifest=None,
+                        stats_records=None, new_id=None, make_id=random_id,
+                        writer=None, hash_threads=4):
     """ Convert a FreeSurfer directory to a PROV graph
+
+    Measure definitions are collected in `registry`; if none is given they
+    are merged into fsterms.ttl once the directory has been encoded. If a
+    `manifest` dict is given, the state and IRIs of every encoded file are
+    recorded in it (see subject_manifest). If a `stats_records` list is
+    given, stats collections are emitted into it directly (see
+    encode_fs_file). With a `new_id`, the subject id is replaced by it in
+    every value written. `make_id` makes the local names of the records (see
+    identifiers). With a rdf_stream.RecordWriter, the records of each file
+    are written out once it is encoded and the following ones go to a new
+    bundle (see _flush_records).
+    Files are hashed ahead by `hash_threads` threads (see iter_hashed_files)
+    and encoded in walk order.
     """
+    flush_registry = registry is None
+    if flush_registry:
+        registry = MeasureRegistry()
+    rewrite = id_rewriter(subject_id, new_id)
     # directory collection/catalog
-    collection_hash = uuid.uuid1().hex
+    subject = rewrite(subject_id)
+    collection_hash = make_id(project_id, subject, 'collection')
     fsdir_collection = g.collection(niiri[collection_hash])
     fsdir_collection.add_extra_attributes({prov.PROV['type']: fs['SubjectDirectory'],
                                            nidm['tag']: project_id,
-                                           fs['subjectID']: subject_id})
-    directory_id = g.entity(niiri[uuid.uuid1().hex])
+                                           fs['subjectID']: subject})
+    directory_id = g.entity(niiri[make_id(project_id, subject, 'directory')])
     hostname = getfqdn()
-    url = "file://%s%s" % (hostname, os.path.abspath(basedir))
+    url = "file://%s%s" % (hostname, rewrite(os.path.abspath(basedir)))
     directory_id.add_extra_attributes({prov.PROV['location']: prov.URIRef(url)})
     g.wasDerivedFrom(fsdir_collection, directory_id)
 
-    a0 = g.activity(niiri[uuid.uuid1().hex], startTime=dt.isoformat(dt.utcnow()))
-    user_agent = g.agent(niiri[uuid.uuid1().hex],
+    a0 = g.activity(niiri[make_id(project_id, subject, 'activity')],
+                    startTime=dt.isoformat(dt.utcnow()))
+    username = pwd.getpwuid(os.geteuid()).pw_name
+    user_agent = g.agent(niiri[make_id('agent', username)],
                          {prov.PROV["type"]: prov.PROV["Person"],
                           prov.PROV["label"]: pwd.getpwuid(os.geteuid()).pw_name,
                           foaf["name"]: pwd.getpwuid(os.geteuid()).pw_name})
     g.wasAssociatedWith(a0, user_agent, None, None,
                         {prov.PROV["Role"]: "LoggedInUser"})
     g.wasGeneratedBy(fsdir_collection, a0)
+    if manifest is not None:
+        manifest['collection'] = fsdir_collection.get_identifier().get_uri()
 
-    i = 0
-    for dirpath, dirnames, filenames in os.walk(os.path.realpath(basedir)):
-        for filename in sorted(filenames):
-            if filename.startswith('.'):
-                continue
-            i += 1
-            if i > n_items:
-                break
-            file2encode = os.path.realpath(os.path.join(dirpath, filename))
-            if not os.path.isfile(file2encode):
-                print "%s not a file" % file2encode
-                continue
-            ignore_key_found = False
-            for key in ignore_list:
-                if key in file2encode:
-                    ignore_key_found = True
-                    continue
-            if ignore_key_found:
-                continue
-            try:
-                entity = create_entity(g, subject_id, file2encode, hostname)
-                g.hadMember(fsdir_collection, entity.get_identifier())
-                rdf_g = entity.rdf().serialize(format='turtle')
-                '''
-                query = """
-                PREFIX prov: <http://www.w3.org/ns/prov#>
-                PREFIX fs: <http://www.incf.org/ns/nidash/fs#>
-                PREFIX crypto: <http://www.w3.org/2000/10/swap/crypto#>
-                PREFIX nidm: <http://www.incf.org/ns/nidash/nidm#>
-                select ?e ?relpath ?path where
-                {?e fs:fileType fs:StatisticFile;
-                    fs:relativePath ?relpath;
-                    prov:atLocation ?path .
-                 FILTER NOT EXISTS {
-                  ?e nidm:tag "curv" .
-                 }
-                 }
-                 """
-                results = rdf_g.query(query)
-                '''
-                if 'StatisticFile' in rdf_g and 'curv' not in rdf_g:
-                    g, measure_graph = parse_stats(g, file2encode, entity)
-                    if os.path.exists('fsterms.ttl'):
-                        measure_graph.parse('fsterms.ttl', format='turtle')
-                    measure_graph.serialize('fsterms.ttl', format='turtle')
-            except IOError, e:
-                print e
+    files = profiling.timed('walk', iter_fs_files(basedir, n_items=n_items),
+                            'files')
+    for file2encode, digests, error in iter_hashed_files(
+            files, hash_cache=hash_cache, n_threads=hash_threads):
+        try:
+            if error is not None:
+                raise error
+            if manifest is None:
+                encode_fs_file(g, fsdir_collection, subject_id, file2encode,
+                               hostname, registry, hash_cache=hash_cache,
+                               digests=digests, stats_records=stats_records,
+                               rewrite=rewrite, make_id=make_id)
+            else:
+                relpath = file2encode.split(subject_id)[1].lstrip(os.path.sep)
+                manifest['files'][relpath] = record_fs_file(
+                    g, fsdir_collection, subject_id, file2encode, hostname,
+                    registry, hash_cache=hash_cache, digests=digests,
+                    stats_records=stats_records, rewrite=rewrite,
+                    make_id=make_id)
+        except IOError, e:
+            print e
+        g = _flush_records(g, writer, stats_records)
+    if flush_registry:
+        registry.flush()
     return g
 
 
-def to_graph(subject_specific_dir, project_id, output_dir, new_id=None):
-    # location of FreeSurfer $SUBJECTS_DIR
-    basedir = os.path.abspath(subject_specific_dir)
-    subject_id = basedir.rstrip(os.path.sep).split(os.path.sep)[-1]
+def _flush_records(g, writer, stats_records):
+    """Write the records encoded so far with a RecordWriter (if any),
+    including directly emitted stats records
+
+    Returns the bundle to add the following records to.
+    """
+    if writer is None:
+        return g
+    with profiling.stage('write'):
+        g = writer.flush()
+        if stats_records:
+            for _, triples in stats_records:
+                writer.write_group(ntriples(triples))
+            del stats_records[:]
+    return g
 
+
+def update_fs_directory(g, basedir, subject_id, manifest, n_items=100000,
+                        hash_cache=None, registry=None, stats_records=None,
+                        make_id=random_id, writer=None, hash_threads=4):
+    """Encode only the files added or changed since `manifest` was written
+
+    Files whose size and mtime (or, failing that, md5) match the manifest
+    are skipped; their existing entities and stats collections are reused.
+    The manifest is updated in place. `writer` and `hash_threads` are used
+    as in encode_fs_directory; only new and touched files are hashed.
+
+    Returns the graph of new records and the IRIs of resources generated for
+    changed or removed files, which should be deleted from the triplestore.
+    """
+    flush_registry = registry is None
+    if flush_registry:
+        registry = MeasureRegistry()
+    rewrite = id_rewriter(subject_id, manifest.get('new_id'))
+    collection_uri = manifest['collection']
+    if collection_uri.startswith(niiri.get_uri()):
+        fsdir_collection = niiri[collection_uri[len(niiri.get_uri()):]]
+    else:
+        fsdir_collection = prov.Identifier(collection_uri)
+    hostname = getfqdn()
+    old_files = manifest['files']
+    files = {}
+    seen = set()
+    deleted = []
+
+    def touched_files():
+        for file2encode in profiling.timed('walk', iter_fs_files(
+                basedir, n_items=n_items), 'files'):
+            relpath = file2encode.split(subject_id)[1].lstrip(os.path.sep)
+            seen.add(relpath)
+            entry = old_files.get(relpath)
+            if entry is not None and is_unchanged(entry,
+                                                  file_state(file2encode)):
+                files[relpath] = entry
+                continue
+            yield file2encode
+
+    for file2encode, digests, error in iter_hashed_files(
+            touched_files(), hash_cache=hash_cache, n_threads=hash_threads):
+        relpath = file2encode.split(subject_id)[1].lstrip(os.path.sep)
+        entry = old_files.get(relpath)
+        if error is not None:
+            print error
+            if entry is not None:
+                files[relpath] = entry
+            continue
+        if entry is not None:
+            if digests and digests['md5'] == entry['md5']:
+                entry.update(file_state(file2encode))
+                files[relpath] = entry
+                continue
+            deleted.extend(entry['iris'])
+        try:
+            files[relpath] = record_fs_file(g, fsdir_collection, subject_id,
+                                            file2encode, hostname, registry,
+                                            hash_cache=hash_cache,
+                                            digests=digests,
+                                            stats_records=stats_records,
+                                            rewrite=rewrite, make_id=make_id)
+        except IOError, e:
+            print e
+        g = _flush_records(g, writer, stats_records)
+    for relpath in set(old_files) - seen:
+        deleted.extend(old_files[relpath]['iris'])
+    manifest['files'] = files
+    if flush_registry:
+        registry.flush()
+    return g, deleted
+
+
+def _new_bundle():
     graph = prov.ProvBundle()
     graph.add_namespace(foaf)
     graph.add_namespace(dcterms)
@@ -406,81 +653,530 @@ def to_graph(subject_specific_dir, project_id, output_dir, new_id=None):
     graph.add_namespace(obo)
     graph.add_namespace(nif)
     graph.add_namespace(crypto)
+    return graph
 
-    graph = encode_fs_directory(graph, basedir, project_id, subject_id)
-    provn = graph.get_provn()
+
+def _output_files(output_dir, subject_id, project_id, new_id=None,
+                  suffix=''):
+    """Return the .provn and .ttl output filenames of a subject
+    """
+    basename = os.path.join(output_dir, '%s_%s%s' % (new_id or subject_id,
+                                                     project_id, suffix))
+    return basename + '.provn', basename + '.ttl'
+
+
+def _write_graph(graph, output_dir, subject_id, project_id, new_id=None,
+                 suffix='', stats_records=None):
+    """Write the .provn and .ttl outputs of a subject graph
+
+    The outputs are named after new_id if given. Directly emitted
+    `stats_records` are only written to the .ttl output.
+    """
+    with profiling.stage('provn'):
+        provn = graph.get_provn()
+    filename, filename_ttl = _output_files(output_dir, subject_id, project_id,
+                                           new_id=new_id, suffix=suffix)
+    with profiling.stage('provn'):
+        with open(filename, 'wt') as fp:
+            fp.writelines(provn)
+    with profiling.stage('rdf'):
+        rdf_graph = graph.rdf()
+        for _, triples in stats_records or []:
+            for triple in triples:
+                rdf_graph.add(triple)
+    with profiling.stage('turtle'):
+        rdf_graph.serialize(filename_ttl, format='turtle')
+    profiling.count('turtle', triples=len(rdf_graph))
+
+
+def to_graph(subject_specific_dir, project_id, output_dir, new_id=None,
+             hash_cache=None, registry=None, manifest=None,
+             stats_records=None, mapper='mapper.ttl', make_id=random_id,
+             stream=False, hash_threads=4):
+    """Encode a subject directory and write its .provn and .ttl outputs
+
+    With a new_id, the subject is anonymized while it is encoded and the
+    mapping is merged into `mapper` (skipped if None, e.g., when the caller
+    writes the mappings of a batch at once).
+
+    With stream, records are written to the outputs file by file while the
+    directory is walked, so memory does not grow with the number of files;
+    the .ttl output then holds N-Triples and its filename is returned in
+    place of the graph (upload_graph accepts either).
+    """
+    # location of FreeSurfer $SUBJECTS_DIR
+    basedir = os.path.abspath(subject_specific_dir)
+    subject_id = basedir.rstrip(os.path.sep).split(os.path.sep)[-1]
+
+    graph = _new_bundle()
+    writer = None
+    if stream:
+        writer = RecordWriter(graph, *_output_files(output_dir, subject_id,
+                                                    project_id,
+                                                    new_id=new_id))
+    with profiling.stage('encode'):
+        graph = encode_fs_directory(graph, basedir, project_id, subject_id,
+                                    hash_cache=hash_cache, registry=registry,
+                                    manifest=manifest,
+                                    stats_records=stats_records,
+                                    new_id=new_id, make_id=make_id,
+                                    writer=writer, hash_threads=hash_threads)
     old_id = subject_id
-    if new_id:
-        provn = provn.replace(subject_id, new_id)
-        subject_id = new_id
-    filename = os.path.join(output_dir, '%s_%s.provn' % (subject_id,
-                                                         project_id))
-    with open(filename, 'wt') as fp:
-        fp.writelines(provn)
-    filename_ttl = os.path.join(output_dir, '%s_%s.ttl' % (subject_id,
-                                                           project_id))
-    graph.rdf().serialize(filename_ttl, format='turtle')
-    if new_id:
-        map_graph = rdflib.Graph()
-        map_graph.namespace_manager.bind('fs', fs.get_uri())
-        map_graph.namespace_manager.bind('nidm', nidm.get_uri())
-        map_graph.add((fs[new_id].rdf_representation(),
-                       nidm['sameSubjectAs'].rdf_representation(),
-                       fs[old_id].rdf_representation()))
-        if os.path.exists('mapper.ttl'):
-            map_graph.parse('mapper.ttl', format='turtle')
-        map_graph.serialize('mapper.ttl', format='turtle')
+    if writer is None:
+        _write_graph(graph, output_dir, subject_id, project_id,
+                     new_id=new_id, stats_records=stats_records)
+    else:
+        with profiling.stage('write'):
+            writer.close()
+        profiling.count('write', triples=writer.n_triples)
+        graph = writer.ttl_file
+    if new_id and mapper:
+        write_mapper([(old_id, new_id)], fs.get_uri(), nidm.get_uri(),
+                     filename=mapper)
     return graph, old_id
 
-def upload_graph(graph, endpoint=None, uri=None, old_id=None, new_id=None,
-                 max_stmts=100):
-    import requests
-    from time import sleep
-    from requests.auth import HTTPDigestAuth
 
+def to_delta_graph(subject_specific_dir, project_id, output_dir, manifest,
+                   hash_cache=None, registry=None, stats_records=None,
+                   make_id=random_id, stream=False, hash_threads=4):
+    """Encode the changes of a subject directory since its last manifest
+
+    Writes <subject>_<project>_delta.provn/.ttl with the new records and
+    <subject>_<project>_delta.deleted with the IRIs to remove. An anonymized
+    subject keeps the id stored in the manifest. `stream` and
+    `hash_threads` are used as in to_graph.
+
+    Returns the delta graph (or .ttl filename), the deleted IRIs and the
+    subject id.
+    """
+    basedir = os.path.abspath(subject_specific_dir)
+    subject_id = basedir.rstrip(os.path.sep).split(os.path.sep)[-1]
+    new_id = manifest.get('new_id')
+
+    graph = _new_bundle()
+    writer = None
+    if stream:
+        writer = RecordWriter(graph, *_output_files(output_dir, subject_id,
+                                                    project_id, new_id=new_id,
+                                                    suffix='_delta'))
+    with profiling.stage('encode'):
+        graph, deleted = update_fs_directory(graph, basedir,
+                                             subject_id, manifest,
+                                             hash_cache=hash_cache,
+                                             registry=registry,
+                                             stats_records=stats_records,
+                                             make_id=make_id, writer=writer,
+                                             hash_threads=hash_threads)
+    if writer is None:
+        _write_graph(graph, output_dir, subject_id, project_id,
+                     new_id=new_id, suffix='_delta',
+                     stats_records=stats_records)
+    else:
+        with profiling.stage('write'):
+            writer.close()
+        profiling.count('write', triples=writer.n_triples)
+        graph = writer.ttl_file
+    filename = os.path.join(output_dir, '%s_%s_delta.deleted' % (
+        new_id or subject_id, project_id))
+    with open(filename, 'wt') as fp:
+        fp.writelines('%s\n' % iri for iri in deleted)
+    return graph, deleted, subject_id
+
+
+def incremental_to_graph(subject_specific_dir, project_id, output_dir,
+                         new_id=None, hash_cache=None, registry=None,
+                         stats_records=None, mapper='mapper.ttl',
+                         make_id=random_id, stream=False, hash_threads=4):
+    """Encode a subject fully the first time and only its changes afterwards
+
+    The per-subject manifest is kept in output_dir.
+
+    Returns the graph, the IRIs to delete, the subject id and the id used in
+    the outputs (new_id of the first run for anonymized subjects).
+    """
+    basedir = os.path.abspath(subject_specific_dir)
+    subject_id = basedir.rstrip(os.path.sep).split(os.path.sep)[-1]
+    filename = manifest_filename(output_dir, subject_id, project_id)
+    if os.path.exists(filename):
+        manifest = load_manifest(filename)
+        graph, deleted, old_id = to_delta_graph(basedir, project_id,
+                                                output_dir, manifest,
+                                                hash_cache=hash_cache,
+                                                registry=registry,
+                                                stats_records=stats_records,
+                                                make_id=make_id, stream=stream,
+                                                hash_threads=hash_threads)
+        new_id = manifest.get('new_id')
+    else:
+        manifest = new_manifest(subject_id, project_id, new_id=new_id)
+        graph, old_id = to_graph(basedir, project_id, output_dir,
+                                 new_id=new_id, hash_cache=hash_cache,
+                                 registry=registry, manifest=manifest,
+                                 stats_records=stats_records, mapper=mapper,
+                                 make_id=make_id, stream=stream,
+                                 hash_threads=hash_threads)
+        deleted = []
+    save_manifest(manifest, filename)
+    return graph, deleted, old_id, new_id
+
+def _ntriples_groups(graph, stats_records=None):
+    """Yield the N-Triples lines of each record of a graph (or streamed .ttl
+    output) and of the directly emitted stats records
+    """
+    if isinstance(graph, basestring):
+        groups = iter_ttl_groups(graph)
+    else:
+        groups = iter_record_ntriples(graph)
+    if stats_records:
+        groups = chain(groups, (ntriples(triples)
+                                for _, triples in stats_records))
+    return groups
+
+
+def upload_graph(graph, endpoint=None, uri=None, max_stmts=100,
+                 max_in_flight=4, compress=False, deleted=None,
+                 stats_records=None, skip_existing=False, journal=None,
+                 scope=None):
+    """Upload a graph with concurrent, adaptively sized INSERT DATA requests
+
+    max_stmts is the initial number of statements per request. Resources
+    listed in `deleted` (see to_delta_graph) are removed from the graph
+    before the upload. Directly emitted `stats_records` are uploaded after
+    the records of the graph. With skip_existing, batches already in the
+    graph are not sent again (see sparql_upload). `graph` can also be the
+    .ttl output of a streamed encoding (see to_graph), whose N-Triples are
+    uploaded as they were written. With a ProgressJournal, the ranges of
+    records stored are recorded under `scope` (see upload_scope) and those
+    recorded by an interrupted upload are not sent again.
+    """
     # connection params for secure endpoint
     if endpoint is None:
         endpoint = 'http://metadata.incf.net:8890/sparql'
 
-    # session defaults
-    session = requests.Session()
-    session.headers = {'Accept': 'text/html'}  # HTML from SELECT queries
-
-    counter = 0
-    stmts = graph.rdf().serialize(format='nt').splitlines()
-    N = len(stmts)
-    max_tries = 10
-    while (counter < N):
-        endcounter = min(N, counter + max_stmts)
-        query = """
-        INSERT DATA
-        {GRAPH <%s>
-        {
-        %s
-        }
-        }
-        """ % (uri, '\n'.join(stmts[counter:endcounter]))
-        if new_id is not None:
-            query = query.replace(old_id, new_id)
-        data = {'query': query}
-        result = session.post(endpoint, data=data)
-        num_tries = 0
-        while result.status_code != requests.codes.ok and num_tries < max_tries:
-            sleep(5)
-            result = session.post(endpoint, data=data)
-            num_tries += 1
-        if num_tries == max_tries:
-            raise IOError('Could not upload some statements: %s' %
-                          result.status_code)
-        counter = endcounter
-    print('Submitted %d statemnts' % N)
+    groups = _ntriples_groups(graph, stats_records)
+    uploader = SparqlUploader(endpoint, uri, batch_size=max_stmts,
+                              max_in_flight=max_in_flight, compress=compress,
+                              skip_existing=skip_existing)
+    done = on_uploaded = None
+    if journal is not None:
+        done = journal.ranges(scope)
+        if done:
+            print('Resuming upload, %d records already stored' %
+                  sum(end - start for start, end in done))
+        on_uploaded = lambda start, end: journal.add_range(scope, start, end)
+    with profiling.stage('upload'):
+        if deleted:
+            print('Deleted %d resources' % uploader.delete(deleted))
+        N = uploader.upload(groups, done=done, on_uploaded=on_uploaded)
+    stats = uploader.stats()
+    profiling.count('upload', triples=stats['statements'],
+                    requests=stats['requests'], retries=stats['retries'],
+                    skipped=stats['skipped'])
+    print('Submitted %d statemnts (%.1f statements/sec)' %
+          (N, stats['statements_per_sec']))
+    if skip_existing:
+        print('Skipped %d statements already stored' % stats['skipped'])
+    return stats
+
+
+def upload_scope(graph_iri, subject_dir, upload_file):
+    """Return the journal scope of the upload of a subject
+
+    upload_file is the file of N-Triples groups uploaded (see
+    journal_output). A restarted run uploads the same file, so its digest
+    identifies the records whose ranges were stored; the scope only
+    changes if the file was removed or modified, and the upload then
+    starts over.
+    """
+    return 'upload %s %s %s' % (graph_iri, subject_dir,
+                                hash_file(upload_file)['md5'])
+
+
+def journal_output(journal, subject_dir, graph, stats_records, ttl_file):
+    """Record the upload source of an encoded subject in the journal and
+    return it
+
+    A streamed .ttl output is recorded as is. Otherwise the N-Triples
+    groups of the graph and of the directly emitted `stats_records` are
+    written to <output>.nt (ttl_file with an .nt extension), since encoding
+    the subject again gives different records (activity start time, random
+    identifiers) and the ranges stored by an interrupted upload would not
+    apply to them.
+    """
+    if not isinstance(graph, basestring):
+        filename = os.path.splitext(ttl_file)[0] + '.nt'
+        with profiling.stage('write'):
+            write_ttl_groups(_ntriples_groups(graph, stats_records), filename)
+        graph = filename
+    journal.mark_done('encoded', subject_dir, ttl=graph,
+                      md5=hash_file(graph)['md5'])
+    return graph
+
+
+def reusable_output(journal, subject_dir):
+    """Return the upload source of a subject recorded in the journal by an
+    interrupted run (see journal_output), or None if it is missing or
+    changed
+    """
+    info = journal.info('encoded', subject_dir)
+    if info and (hash_file(info['ttl']) or {}).get('md5') == info['md5']:
+        return info['ttl']
+    return None
+
+
+def export_graph(graph, export_dir, graph_iri, prefix, stats_records=None,
+                 max_bytes=256 << 20):
+    """Write a graph (or streamed .ttl output) as gzipped N-Quads shards
+
+    The shards are named <prefix>-00000.nq.gz, ... (see bulk_export) and
+    their manifest entries are returned; the caller adds them to the
+    manifest of export_dir with write_manifest.
+    """
+    shards = export_groups(_ntriples_groups(graph, stats_records), export_dir,
+                           graph_iri, prefix, max_bytes=max_bytes)
+    print('Exported %d statements to %d shards' % (
+        sum(info['triples'] for info in shards.values()), len(shards)))
+    return shards
+
+
+def find_subject_dirs(subjects_dir=None, subject_list=None):
+    """Return the subject directories to encode in batch mode
+
+    subjects_dir: FreeSurfer $SUBJECTS_DIR; every subdirectory containing an
+        'mri' or 'stats' directory is treated as a subject
+    subject_list: file with one subject directory per line (relative entries
+        are resolved against subjects_dir)
+    """
+    subject_dirs = []
+    if subject_list:
+        with open(subject_list, 'rt') as fp:
+            for line in fp:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if subjects_dir and not os.path.isabs(line):
+                    line = os.path.join(subjects_dir, line)
+                subject_dirs.append(os.path.abspath(line))
+    elif subjects_dir:
+        for name in sorted(os.listdir(subjects_dir)):
+            path = os.path.join(subjects_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            if os.path.isdir(os.path.join(path, 'mri')) or \
+                    os.path.isdir(os.path.join(path, 'stats')):
+                subject_dirs.append(os.path.abspath(path))
+    return subject_dirs
+
+
+def _encode_subject(kwargs):
+    """Encode (and optionally upload) one subject; run in a worker process
+
+    Returns the subject directory, an error message (or None), the
+    measure definitions found, which the parent merges into fsterms.ttl, the
+    anonymous id used (or None), the profiling stages (or None), the
+    bulk export shards written (see export_graph) and whether the subject
+    was claimed by another worker sharing the journal.
+    """
+    if kwargs['profile']:
+        profiling.enable()
+    subject_dir = kwargs['subject_dir']
+    hash_cache = None
+    registry = MeasureRegistry()
+    journal = None
+    if kwargs['journal']:
+        journal = ProgressJournal(kwargs['journal'])
+        if not journal.claim('subject', subject_dir):
+            return (subject_dir, None, [], None, profiling.pop_report(), {},
+                    True)
+    try:
+        if kwargs['hash_cache']:
+            hash_cache = HashCache(kwargs['hash_cache'],
+                                   max_entries=kwargs['hash_cache_size'])
+        new_id = kwargs['new_id']
+        make_id = id_function(kwargs['deterministic_ids'])
+        deleted = None
+        stats_records = [] if kwargs['direct_stats'] else None
+        # the parent writes the mappings of all subjects to mapper.ttl
+        graph = None
+        if journal is not None:
+            # the output of an interrupted run is uploaded as is
+            graph = reusable_output(journal, subject_dir)
+            old_id = os.path.basename(subject_dir.rstrip(os.path.sep))
+        if graph is None and kwargs['incremental']:
+            graph, deleted, old_id, new_id = incremental_to_graph(
+                subject_dir, kwargs['project_id'], kwargs['output_dir'],
+                new_id=new_id, hash_cache=hash_cache, registry=registry,
+                stats_records=stats_records, mapper=None, make_id=make_id,
+                stream=kwargs['stream'], hash_threads=kwargs['hash_threads'])
+        elif graph is None:
+            graph, old_id = to_graph(subject_dir, kwargs['project_id'],
+                                     kwargs['output_dir'], new_id=new_id,
+                                     hash_cache=hash_cache, registry=registry,
+                                     stats_records=stats_records, mapper=None,
+                                     make_id=make_id, stream=kwargs['stream'],
+                                     hash_threads=kwargs['hash_threads'])
+            if journal is not None:
+                graph = journal_output(journal, subject_dir, graph,
+                                       stats_records, _output_files(
+                                           kwargs['output_dir'], old_id,
+                                           kwargs['project_id'],
+                                           new_id=new_id)[1])
+                stats_records = None
+        if kwargs['upload']:
+            scope = None
+            if journal is not None:
+                scope = upload_scope(kwargs['graph_iri'], subject_dir, graph)
+            upload_graph(graph, endpoint=kwargs['endpoint'],
+                         uri=kwargs['graph_iri'], max_stmts=kwargs['max_stmts'],
+                         max_in_flight=kwargs['max_in_flight'],
+                         compress=kwargs['compress'], deleted=deleted,
+                         stats_records=stats_records,
+                         skip_existing=kwargs['skip_existing'],
+                         journal=journal, scope=scope)
+        shards = {}
+        if kwargs['export_dir']:
+            shards = export_graph(graph, kwargs['export_dir'],
+                                  kwargs['graph_iri'], '%s_%s' % (
+                                      new_id or old_id, kwargs['project_id']),
+                                  stats_records=stats_records,
+                                  max_bytes=kwargs['shard_size'])
+    except Exception, e:
+        if journal is not None:
+            journal.release('subject', subject_dir)
+        return (subject_dir, '%s: %s' % (e.__class__.__name__, e),
+                registry.triples(), None, profiling.pop_report(), {}, False)
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+    if journal is not None:
+        journal.mark_done('subject', subject_dir)
+    return (subject_dir, None, registry.triples(), new_id,
+            profiling.pop_report(), shards, False)
+
+
+def encode_subjects(subject_dirs, project_id, output_dir, n_procs=1,
+                    anonymize=False, upload=False, endpoint=None,
+                    graph_iri=None, max_stmts=100, max_in_flight=4,
+                    compress=False, hash_cache=None, hash_cache_size=2000000,
+                    registry=None, incremental=False, direct_stats=False,
+                    id_map=None, deterministic_ids=False,
+                    skip_existing=False, stream=False, export_dir=None,
+                    shard_size=256 << 20, hash_threads=4, journal=None):
+    """Encode many subject directories across a pool of processes
+
+    Each subject produces the same <subject>_<project>.provn/.ttl outputs as
+    to_graph. hash_cache is the filename of a HashCache database, which each
+    worker opens on its own. Measure definitions from all workers are merged
+    into `registry` (default: fsterms.ttl, flushed every 100 subjects).
+    With direct_stats, stats collections are emitted by stats_triples and
+    are only written to the .ttl outputs.
+
+    With anonymize, subjects get the anonymous id of `id_map` (an IdMap,
+    which is saved if it has a filename); the mappings of all subjects are
+    merged into mapper.ttl at the end.
+
+    With deterministic_ids, records get content-derived identifiers (see
+    identifiers), so re-encoding and re-uploading a subject gives the same
+    triples; skip_existing does not upload batches already in the graph.
+    If profiling is enabled, the stages of the workers are merged into the
+    report of this process. With stream, outputs are written while each
+    subject is encoded (see to_graph). With an export_dir, each worker also
+    writes the subject as N-Quads shards of at most shard_size bytes in
+    graph_iri (see bulk_export), and their manifest is updated at the end.
+    Each worker hashes files with hash_threads threads (see
+    iter_hashed_files).
+
+    journal is the filename of a ProgressJournal: subjects done in an
+    earlier run are skipped, each worker claims its subject (so several
+    runs can share the subjects) and records the upload of its records, so
+    an interrupted upload is resumed from the output the subject was
+    encoded to (see journal_output and upload_graph).
+
+    Returns a list of (subject_dir, error) for subjects that failed.
+    """
+    if journal is not None:
+        if incremental:
+            raise ValueError('a journal cannot be used with incremental '
+                             'encoding')
+        done = ProgressJournal(journal)
+        n_subjects = len(subject_dirs)
+        subject_dirs = [subject_dir for subject_dir in subject_dirs
+                        if not done.is_done('subject', subject_dir)]
+        if len(subject_dirs) < n_subjects:
+            print('Skipping %d subjects done in the journal' %
+                  (n_subjects - len(subject_dirs)))
+    if anonymize and id_map is None:
+        id_map = IdMap()
+    jobs = [dict(subject_dir=subject_dir, project_id=project_id,
+                 output_dir=output_dir, upload=upload,
+                 new_id=(id_map.get(os.path.basename(subject_dir.rstrip(
+                     os.path.sep))) if anonymize else None),
+                 endpoint=endpoint, graph_iri=graph_iri, max_stmts=max_stmts,
+                 max_in_flight=max_in_flight, compress=compress,
+                 hash_cache=hash_cache, hash_cache_size=hash_cache_size,
+                 incremental=incremental, direct_stats=direct_stats,
+                 deterministic_ids=deterministic_ids,
+                 skip_existing=skip_existing, profile=profiling.enabled(),
+                 stream=stream, export_dir=export_dir, shard_size=shard_size,
+                 hash_threads=hash_threads, journal=journal)
+            for subject_dir in subject_dirs]
+    if n_procs > 1:
+        from multiprocessing import Pool
+        pool = Pool(n_procs)
+        results = pool.imap_unordered(_encode_subject, jobs)
+    else:
+        pool = None
+        results = (_encode_subject(job) for job in jobs)
+    if registry is None:
+        registry = MeasureRegistry(flush_every=100)
+    namespaces = [('fs', fs.get_uri()), ('nidm', nidm.get_uri())]
+    failed = []
+    mappings = []
+    shards = {}
+    for idx, (subject_dir, error, terms, new_id, stages,
+              subject_shards, claimed) in enumerate(results):
+        registry.add_triples(terms, namespaces=namespaces)
+        profiling.merge(stages)
+        shards.update(subject_shards)
+        if new_id:
+            subject_id = os.path.basename(subject_dir.rstrip(os.path.sep))
+            # incremental runs keep the id of the subject's manifest
+            id_map.ids[subject_id] = new_id
+            mappings.append((subject_id, new_id))
+        if claimed:
+            print('[%d/%d] Skipped %s (claimed by another worker)' % (
+                idx + 1, len(jobs), subject_dir))
+        elif error is None:
+            print('[%d/%d] Encoded %s' % (idx + 1, len(jobs), subject_dir))
+        else:
+            print('[%d/%d] Failed %s: %s' % (idx + 1, len(jobs), subject_dir,
+                                             error))
+            failed.append((subject_dir, error))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    registry.flush()
+    write_mapper(mappings, fs.get_uri(), nidm.get_uri())
+    if export_dir:
+        write_manifest(export_dir, shards)
+    if id_map is not None and id_map.filename:
+        id_map.save()
+    return failed
+
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(prog='fs_upload_to_triplesore.py',
                                      description=__doc__)
-    parser.add_argument('-s', '--subject_dir', type=str, required=True,
+    parser.add_argument('-s', '--subject_dir', type=str,
                         help='Path to subject directory to upload')
+    parser.add_argument('--subjects_dir', type=str,
+                        help=('FreeSurfer $SUBJECTS_DIR to encode every '
+                              'subject in (batch mode)'))
+    parser.add_argument('--subject_list', type=str,
+                        help=('File with one subject directory per line, '
+                              'relative to --subjects_dir if given (batch '
+                              'mode)'))
     parser.add_argument('-p', '--project_id', type=str, required=True,
                         help='Project tag to use for the subject directory.')
     parser.add_argument('-e', '--endpoint', type=str,
@@ -495,22 +1191,203 @@ if __name__ == "__main__":
                         action="store_true", help='Upload to triplestore')
     parser.add_argument('-n', '--num_statements', dest="max_stmts", type=int,
                         default=100,
-                        help=('Maximum statements to upload to triplestore in '
-                              'one request'))
+                        help=('Initial number of statements to upload to '
+                              'triplestore in one request (adapted to the '
+                              'endpoint latency)'))
+    parser.add_argument('--max_in_flight', dest="max_in_flight", type=int,
+                        default=4,
+                        help='Maximum number of concurrent upload requests')
+    parser.add_argument('--gzip', dest="compress", action="store_true",
+                        help='gzip-compress upload request bodies')
     parser.add_argument('-c', '--csv', dest="csv_file", type=str,
                         help='CSV file for additional participant metadata')
     parser.add_argument('--id_col_name', dest="col_name", type=str,
                         help='Column name for subject id in CSV file')
+    parser.add_argument('--hash_cache', dest="hash_cache", type=str,
+                        help=('sqlite file to cache file digests across runs '
+                              '(shared with serve_files.py)'))
+    parser.add_argument('--hash_cache_size', dest="hash_cache_size", type=int,
+                        default=2000000,
+                        help='Maximum number of digests kept in the cache')
+    parser.add_argument('-j', '--n_procs', dest="n_procs", type=int,
+                        default=1,
+                        help='Number of worker processes in batch mode')
+    parser.add_argument('-i', '--incremental', dest="incremental",
+                        action="store_true",
+                        help=('Keep a per-subject manifest in the output '
+                              'directory and only encode and upload files '
+                              'changed since the previous run'))
+    parser.add_argument('--file_rules', dest="file_rules", type=str,
+                        help=('JSON file with the filename tagging and '
+                              'ignore rules to use instead of the built-in '
+                              'ones'))
+    parser.add_argument('--id_map', dest="id_map", type=str,
+                        help=('CSV table (subject_id,new_id) of anonymous '
+                              'ids to use; implies --anonymize, ids of new '
+                              'subjects are added to it'))
+    parser.add_argument('--direct_stats', dest="direct_stats",
+                        action="store_true",
+                        help=('Write the triples of .stats files directly '
+                              'instead of building PROV records (faster; '
+                              'stats collections are left out of the .provn '
+                              'output)'))
+    parser.add_argument('--deterministic_ids', dest="deterministic_ids",
+                        action="store_true",
+                        help=('Derive record identifiers from the project, '
+                              'subject, file paths and digests instead of '
+                              'random uuids, so re-runs give the same IRIs'))
+    parser.add_argument('--skip_existing', dest="skip_existing",
+                        action="store_true",
+                        help=('Check each upload batch with an ASK query '
+                              'and skip batches already in the graph'))
+    parser.add_argument('--hash_threads', dest="hash_threads", type=int,
+                        default=4,
+                        help=('Number of threads reading and hashing files '
+                              'ahead of the encoder (1: no read-ahead)'))
+    parser.add_argument('--stream', dest="stream", action="store_true",
+                        help=('Write the outputs while the directory is '
+                              'walked, with memory independent of the '
+                              'number of files (the .ttl output holds '
+                              'N-Triples and is what gets uploaded)'))
+    parser.add_argument('--export_dir', dest="export_dir", type=str,
+                        help=('Also write the triples as gzipped N-Quads '
+                              'shards in --graph_iri, with a manifest.json, '
+                              'to this directory for bulk loading'))
+    parser.add_argument('--shard_mb', dest="shard_mb", type=int, default=256,
+                        help='Uncompressed size of the N-Quads shards (MB)')
+    parser.add_argument('--journal', dest="journal", type=str,
+                        help=('Progress journal recording the subjects and '
+                              'upload batches done, to resume an '
+                              'interrupted run (can be shared by parallel '
+                              'runs)'))
+    parser.add_argument('--profile', dest="profile", type=str,
+                        help=('Write the time, files, bytes read, triples '
+                              'and requests of each stage to this JSON file'))
+    parser.add_argument('--cprofile', dest="cprofile", action="store_true",
+                        help=('With --profile, also write a cProfile dump '
+                              'of the run to <profile>.prof'))
 
     args = parser.parse_args()
+    if not (args.subject_dir or args.subjects_dir or args.subject_list):
+        parser.error('one of --subject_dir, --subjects_dir or --subject_list '
+                     'is required')
     if args.output_dir is None:
         args.output_dir = os.getcwd()
+    if args.export_dir:
+        if args.graph_iri is None:
+            parser.error('--export_dir requires --graph_iri')
+        if args.incremental:
+            parser.error('--export_dir cannot be used with --incremental '
+                         '(bulk loaders cannot remove changed files)')
+        if not os.path.isdir(args.export_dir):
+            os.makedirs(args.export_dir)
+    if args.journal and args.incremental:
+        parser.error('--journal cannot be used with --incremental')
+    if args.profile:
+        profiling.enable(cprofile=args.cprofile)
+    if args.file_rules:
+        use_file_rules(args.file_rules)
+    id_map = None
+    if args.anonymize or args.id_map:
+        args.anonymize = True
+        id_map = IdMap(args.id_map)
+
+    if args.subject_dir is None:
+        subject_dirs = find_subject_dirs(args.subjects_dir, args.subject_list)
+        failed = encode_subjects(subject_dirs, args.project_id,
+                                 args.output_dir, n_procs=args.n_procs,
+                                 anonymize=args.anonymize, upload=args.upload,
+                                 endpoint=args.endpoint,
+                                 graph_iri=args.graph_iri,
+                                 max_stmts=args.max_stmts,
+                                 max_in_flight=args.max_in_flight,
+                                 compress=args.compress,
+                                 hash_cache=args.hash_cache,
+                                 hash_cache_size=args.hash_cache_size,
+                                 incremental=args.incremental,
+                                 direct_stats=args.direct_stats,
+                                 id_map=id_map,
+                                 deterministic_ids=args.deterministic_ids,
+                                 skip_existing=args.skip_existing,
+                                 stream=args.stream,
+                                 export_dir=args.export_dir,
+                                 shard_size=args.shard_mb << 20,
+                                 hash_threads=args.hash_threads,
+                                 journal=args.journal)
+        print('Encoded %d of %d subjects' % (len(subject_dirs) - len(failed),
+                                             len(subject_dirs)))
+        if args.profile:
+            profiling.print_report(profiling.write_report(args.profile))
+        raise SystemExit(1 if failed else 0)
+
+    hash_cache = None
+    if args.hash_cache:
+        hash_cache = HashCache(args.hash_cache,
+                               max_entries=args.hash_cache_size)
+
+    subject_dir = os.path.abspath(args.subject_dir)
+    journal = None
+    graph = None
+    if args.journal:
+        journal = ProgressJournal(args.journal)
+        if not journal.claim('subject', subject_dir):
+            print('%s is done or claimed by another worker in %s' % (
+                subject_dir, args.journal))
+            raise SystemExit(0)
+        # the output of an interrupted run is uploaded as is
+        graph = reusable_output(journal, subject_dir)
+        old_id = os.path.basename(subject_dir.rstrip(os.path.sep))
 
     new_id = None
     if args.anonymize:
-        new_id = uuid.uuid4().hex
-    graph, old_id = to_graph(args.subject_dir, args.project_id, args.output_dir,
-                             new_id=new_id)
+        new_id = id_map.get(os.path.basename(subject_dir.rstrip(os.path.sep)))
+    deleted = None
+    stats_records = [] if args.direct_stats else None
+    make_id = id_function(args.deterministic_ids)
+    if graph is not None:
+        print('Uploading %s written by an interrupted run' % graph)
+    elif args.incremental:
+        graph, deleted, old_id, new_id = incremental_to_graph(
+            args.subject_dir, args.project_id, args.output_dir, new_id=new_id,
+            hash_cache=hash_cache, stats_records=stats_records,
+            make_id=make_id, stream=args.stream,
+            hash_threads=args.hash_threads)
+    else:
+        graph, old_id = to_graph(args.subject_dir, args.project_id,
+                                 args.output_dir, new_id=new_id,
+                                 hash_cache=hash_cache,
+                                 stats_records=stats_records, make_id=make_id,
+                                 stream=args.stream,
+                                 hash_threads=args.hash_threads)
+        if journal is not None:
+            graph = journal_output(journal, subject_dir, graph, stats_records,
+                                   _output_files(args.output_dir, old_id,
+                                                 args.project_id,
+                                                 new_id=new_id)[1])
+            stats_records = None
+    if id_map is not None and id_map.filename:
+        id_map.ids[old_id] = new_id
+        id_map.save()
+    if hash_cache is not None:
+        print('Hash cache: %(hits)d hits, %(misses)d misses, '
+              '%(bytes_hashed)d bytes hashed' % hash_cache.stats())
+        hash_cache.close()
     if args.upload:
+        scope = None
+        if journal is not None:
+            scope = upload_scope(args.graph_iri, subject_dir, graph)
         upload_graph(graph, endpoint=args.endpoint, uri=args.graph_iri,
-                     old_id=old_id, new_id=new_id, max_stmts=args.max_stmts)
+                     max_stmts=args.max_stmts,
+                     max_in_flight=args.max_in_flight, compress=args.compress,
+                     deleted=deleted, stats_records=stats_records,
+                     skip_existing=args.skip_existing, journal=journal,
+                     scope=scope)
+    if args.export_dir:
+        write_manifest(args.export_dir, export_graph(
+            graph, args.export_dir, args.graph_iri,
+            '%s_%s' % (new_id or old_id, args.project_id),
+            stats_records=stats_records, max_bytes=args.shard_mb << 20))
+    if journal is not None:
+        journal.mark_done('subject', subject_dir)
+    if args.profile:
+        profiling.print_report(profiling.write_report(args.profile))
@@ -0,0 +1,222 @@
+"""Persistent cache of file content digests shared across runs
+
+Digests are keyed by (device, inode, size, mtime_ns) of the file, so a file
+that has not been touched since it was last hashed is never read again. The
+cache is a sqlite database and can be shared by concurrent processes (e.g.,
+several fs_upload_to_triplesore.py runs and serve_files.py).
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import profiling
+
+
+def hash_file(afile, algorithms=('md5',), chunk_len=1048576):
+    """Compute several digests of a file in a single read pass
+
+    Returns a dict mapping algorithm name to hex digest, or None if `afile` is
+    not a file.
+    """
+    if not os.path.isfile(afile):
+        return None
+    crypto_objs = [(name, hashlib.new(name)) for name in algorithms]
+    n_bytes = 0
+    with open(afile, 'rb') as fp:
+        while True:
+            data = fp.read(chunk_len)
+            if not data:
+                break
+            n_bytes += len(data)
+            for _, crypto_obj in crypto_objs:
+                crypto_obj.update(data)
+    profiling.count('hash', bytes_read=n_bytes)
+    return dict((name, crypto_obj.hexdigest())
+                for name, crypto_obj in crypto_objs)
+
+
+def file_key(afile):
+    """Return the (device, inode, size, mtime_ns) cache key of a file
+    """
+    st = os.stat(afile)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1e9))
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
+class HashCache(object):
+    """On-disk cache of file digests
+
+    filename: path to the sqlite database (created if missing)
+    max_entries: number of digests kept before the least recently used ones
+        are evicted
+    atime_resolution: seconds after which a hit refreshes the access time
+        of a digest (refreshes are written in batches, so hits do not each
+        take the database write lock)
+    """
+
+    def __init__(self, filename, max_entries=2000000, timeout=60.,
+                 atime_resolution=3600.):
+        self.filename = os.path.abspath(filename)
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.atime_resolution = atime_resolution
+        self._touched = []
+        self.hits = 0
+        self.misses = 0
+        self.bytes_hashed = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        conn = self._connection()
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS digests (
+                            dev INTEGER, ino INTEGER, size INTEGER,
+                            mtime_ns INTEGER, algorithm TEXT, hexdigest TEXT,
+                            atime REAL,
+                            PRIMARY KEY (dev, ino, size, mtime_ns, algorithm))
+                         """)
+            conn.execute("""CREATE INDEX IF NOT EXISTS digests_atime
+                            ON digests (atime)""")
+            # running number of digests, so eviction does not count the
+            # whole table
+            conn.execute("""CREATE TABLE IF NOT EXISTS counts (
+                            name TEXT PRIMARY KEY, value INTEGER)""")
+            if conn.execute("""SELECT value FROM counts
+                               WHERE name='digests'""").fetchone() is None:
+                conn.execute("""INSERT INTO counts
+                                SELECT 'digests', COUNT(*) FROM digests""")
+
+    def _connection(self):
+        """Return the sqlite connection of the calling thread
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=self.timeout)
+            try:
+                conn.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.OperationalError:
+                # e.g., on file systems without shared memory support
+                pass
+            self._local.conn = conn
+        return conn
+
+    def lookup(self, afile, algorithms=('md5',)):
+        """Return cached digests for `afile` or None if any is missing
+        """
+        key = file_key(afile)
+        conn = self._connection()
+        rows = conn.execute("""SELECT algorithm, hexdigest, atime
+                               FROM digests
+                               WHERE dev=? AND ino=? AND size=? AND mtime_ns=?
+                            """, key).fetchall()
+        digests = dict((str(name), str(value)) for name, value, _ in rows)
+        if not all(name in digests for name in algorithms):
+            return None
+        now = time.time()
+        if min(atime for _, _, atime in rows) < now - self.atime_resolution:
+            with self._lock:
+                self._touched.append((now,) + key)
+                flush = len(self._touched) >= 1000
+            if flush:
+                self._write_atimes()
+        return dict((name, digests[name]) for name in algorithms)
+
+    def _write_atimes(self):
+        """Write the access times of the hits recorded since the last call
+        in one transaction
+        """
+        with self._lock:
+            touched, self._touched = self._touched, []
+        if not touched:
+            return
+        conn = self._connection()
+        with conn:
+            conn.executemany("""UPDATE digests SET atime=?
+                                WHERE dev=? AND ino=? AND size=? AND
+                                mtime_ns=?""", touched)
+
+    def store(self, afile, digests, key=None):
+        """Add digests of `afile` to the cache
+        """
+        if key is None:
+            key = file_key(afile)
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            cursor = conn.executemany("""INSERT OR IGNORE INTO digests
+                                         VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                                      [key + (name, value, now)
+                                       for name, value in digests.items()])
+            n_new = max(cursor.rowcount, 0)
+            conn.executemany("""UPDATE digests SET hexdigest=?, atime=?
+                                WHERE dev=? AND ino=? AND size=? AND
+                                mtime_ns=? AND algorithm=?""",
+                             [(value, now) + key + (name,)
+                              for name, value in digests.items()])
+            if n_new:
+                conn.execute("""UPDATE counts SET value=value+?
+                                WHERE name='digests'""", (n_new,))
+        with self._lock:
+            self._puts += len(digests)
+            evict = self._puts >= 1000
+            if evict:
+                self._puts = 0
+        if evict:
+            self.evict()
+
+    def hash_file(self, afile, algorithms=('md5',)):
+        """Return digests of `afile`, reading the file only on a cache miss
+        """
+        if not os.path.isfile(afile):
+            return None
+        digests = self.lookup(afile, algorithms)
+        if digests is not None:
+            with self._lock:
+                self.hits += 1
+            return digests
+        key = file_key(afile)
+        digests = hash_file(afile, algorithms)
+        with self._lock:
+            self.misses += 1
+            self.bytes_hashed += key[2]
+        # only cache the result if the file did not change while reading it
+        if file_key(afile) == key:
+            self.store(afile, digests, key=key)
+        return digests
+
+    def evict(self):
+        """Drop least recently used digests beyond `max_entries`
+        """
+        self._write_atimes()
+        conn = self._connection()
+        with conn:
+            n_entries = conn.execute("""SELECT value FROM counts
+                                        WHERE name='digests'""").fetchone()[0]
+            if n_entries > self.max_entries:
+                cursor = conn.execute(
+                    """DELETE FROM digests WHERE rowid IN
+                       (SELECT rowid FROM digests ORDER BY atime LIMIT ?)""",
+                    (n_entries - self.max_entries,))
+                conn.execute("""UPDATE counts SET value=value-?
+                                WHERE name='digests'""", (cursor.rowcount,))
+
+    def stats(self):
+        """Return hit/miss statistics for this process
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / total if total else 0.,
+                'bytes_hashed': self.bytes_hashed}
+
+    def close(self):
+        self.evict()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,132 @@
+"""Anonymous subject ids and their rewriting during encoding
+
+IdMap holds the subject id -> anonymous id table of a batch of subjects; it
+can be read from and saved to a CSV file (columns subject_id,new_id) so
+that subjects keep their anonymous id across runs. id_rewriter returns the
+function applied to the values that can contain a subject id (paths,
+labels, stats header fields) when they are put in the graph, so neither the
+PROV-N text nor the N-Triples need to be rewritten afterwards.
+
+The sameSubjectAs statements linking anonymous and original ids are
+merged into mapper.ttl by write_mapper. Both files are merged with their
+contents on disk under an exclusive lock (<file>.lock) and replaced
+atomically, so concurrent runs do not lose each other's ids.
+"""
+
+import csv
+import fcntl
+import os
+import tempfile
+import uuid
+
+import rdflib
+
+
+def _locked_update(filename, update, suffix):
+    """Call update(tmp_fp) with filename locked and replace the file with
+    what it wrote
+    """
+    filename = os.path.abspath(filename)
+    with open(filename + '.lock', 'a') as lock_fp:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+        try:
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                            suffix=suffix)
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    update(fp)
+                os.chmod(tmp_file, 0o644)
+                os.rename(tmp_file, filename)
+            except:
+                os.unlink(tmp_file)
+                raise
+        finally:
+            fcntl.flock(lock_fp, fcntl.LOCK_UN)
+
+
+def _read_ids(filename):
+    ids = {}
+    if filename is not None and os.path.exists(filename):
+        with open(filename, 'rt') as fp:
+            for row in csv.DictReader(fp):
+                ids[row['subject_id']] = row['new_id']
+    return ids
+
+
+def id_rewriter(old_id, new_id):
+    """Return a function replacing old_id by new_id in a string value
+
+    Without a new_id the values are returned unchanged.
+    """
+    if not new_id or new_id == old_id:
+        return lambda value: value
+
+    def rewrite(value):
+        if old_id in value:
+            return value.replace(old_id, new_id)
+        return value
+    return rewrite
+
+
+class IdMap(object):
+    """Subject ids mapped to anonymous ids
+
+    filename: CSV file to read the table from (if it exists) and to save to
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.ids = _read_ids(filename)
+        self._added = []
+
+    def get(self, subject_id, create=True):
+        """Return the anonymous id of a subject, creating one if needed
+        """
+        new_id = self.ids.get(subject_id)
+        if new_id is None and create:
+            new_id = uuid.uuid4().hex
+            self.ids[subject_id] = new_id
+            self._added.append(subject_id)
+        return new_id
+
+    def added(self):
+        """Return (subject_id, new_id) of the ids created since loading
+        """
+        return [(subject_id, self.ids[subject_id])
+                for subject_id in self._added]
+
+    def save(self, filename=None):
+        """Save the table, keeping the ids other runs added to the file
+        """
+        filename = filename or self.filename
+
+        def update(fp):
+            ids = _read_ids(filename)
+            ids.update(self.ids)
+            writer = csv.writer(fp)
+            writer.writerow(['subject_id', 'new_id'])
+            for subject_id in sorted(ids):
+                writer.writerow([subject_id, ids[subject_id]])
+        _locked_update(filename, update, '.csv.tmp')
+
+
+def write_mapper(pairs, fs_uri, nidm_uri, filename='mapper.ttl'):
+    """Merge (subject_id, new_id) pairs as nidm:sameSubjectAs statements
+    into a Turtle file
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return
+    fs = rdflib.Namespace(fs_uri)
+    nidm = rdflib.Namespace(nidm_uri)
+    map_graph = rdflib.Graph()
+    map_graph.namespace_manager.bind('fs', fs_uri)
+    map_graph.namespace_manager.bind('nidm', nidm_uri)
+    for subject_id, new_id in pairs:
+        map_graph.add((fs[new_id], nidm['sameSubjectAs'], fs[subject_id]))
+
+    def update(fp):
+        if os.path.exists(filename):
+            map_graph.parse(filename, format='turtle')
+        map_graph.serialize(fp, format='turtle')
+    _locked_update(filename, update, '.ttl.tmp')
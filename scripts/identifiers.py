@@ -0,0 +1,39 @@
+"""Identifiers of the records in the generated graphs
+
+By default every entity, activity, agent and collection gets a fresh
+uuid1, so encoding the same data twice gives two disjoint graphs. With
+content-derived identifiers the local names are uuid5 hashes of stable
+inputs (project, subject, relative path, digest, structure name, ...), so
+re-encoding unchanged data gives the same IRIs and triples, which a
+triplestore stores only once, and retried uploads are idempotent.
+
+Both functions take the parts an identifier is derived from and return a
+32-character hex string, so either can be used where the other was.
+"""
+
+import uuid
+
+# uuid5 namespace of the content-derived identifiers
+id_namespace = uuid.UUID('8e5b3f3a-6d0c-5b8e-9a51-3f1c2b7d9e40')
+
+
+def random_id(*parts):
+    """Return a new uuid1 hex identifier (parts are ignored)
+    """
+    return uuid.uuid1().hex
+
+
+def content_id(*parts):
+    """Return the uuid5 hex identifier of the given parts
+    """
+    name = u'\x1f'.join(part if isinstance(part, unicode)
+                        else str(part).decode('utf-8') for part in parts)
+    return uuid.uuid5(id_namespace, name.encode('utf-8')).hex
+
+
+def id_function(deterministic=False):
+    """Return content_id if deterministic is set, random_id otherwise
+    """
+    if deterministic:
+        return content_id
+    return random_id
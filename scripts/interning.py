@@ -0,0 +1,110 @@
+"""Shared instances of the values that repeat across the records of a graph
+
+prov.Namespace already caches the QNames it creates, but every record gets
+its own copy of the other attribute values: ProvRecord converts each string
+to a new unicode object, and a prov.Literal is created for every typed
+measure value. File tags, .stats header values and small integer or
+rounded float measures repeat constantly across files and subjects, so a
+full subject graph is mostly made of duplicate small objects.
+
+Interner returns a single instance per distinct value. Strings are their
+own keys in its table and literals are keyed by the type and repr of their
+value, so values that compare equal but print differently (0.0 and -0.0)
+are never merged. The table is cleared when it reaches `max_entries`, so
+memory stays bounded when most values are unique. PathCache remembers
+os.path.exists results for a bounded number of paths.
+"""
+
+from collections import OrderedDict
+import os
+
+import prov.model as prov
+
+
+class Interner(object):
+    """Table of shared strings and prov.Literal instances
+
+    max_entries: number of values kept before the table is cleared (0
+        disables interning: values are returned as new objects)
+    """
+
+    def __init__(self, max_entries=200000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._table = {}
+
+    def _add(self, key, value):
+        self.misses += 1
+        if self.max_entries:
+            if len(self._table) >= self.max_entries:
+                self._table.clear()
+            self._table[key] = value
+        return value
+
+    def text(self, value):
+        """Return the shared instance of a string
+
+        ASCII byte strings are shared as unicode; other byte strings (e.g.,
+        paths in the file system encoding) are kept as they are.
+        """
+        if not isinstance(value, basestring):
+            return value
+        # str and unicode keys of the same ASCII text are equal
+        try:
+            value = self._table[value]
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+        if isinstance(value, str):
+            try:
+                return self._add(value, unicode(value))
+            except UnicodeDecodeError:
+                pass
+        return self._add(value, value)
+
+    def literal(self, value, datatype):
+        """Return the shared prov.Literal of a value and datatype
+        """
+        key = (type(value), repr(value), datatype)
+        try:
+            literal = self._table[key]
+            self.hits += 1
+            return literal
+        except KeyError:
+            return self._add(key, prov.Literal(value, datatype))
+
+    def clear(self):
+        self._table.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._table)}
+
+
+class PathCache(object):
+    """Bounded cache of os.path.exists results (least recently used paths
+    are dropped first)
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._exists = OrderedDict()
+
+    def exists(self, path):
+        try:
+            result = self._exists.pop(path)
+            self.hits += 1
+        except KeyError:
+            result = os.path.exists(path)
+            self.misses += 1
+            if len(self._exists) >= self.max_entries:
+                self._exists.popitem(last=False)
+        self._exists[path] = result
+        return result
+
+    def clear(self):
+        self._exists.clear()
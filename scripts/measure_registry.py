@@ -0,0 +1,98 @@
+"""In-memory registry of FreeSurfer measure definitions (fsterms.ttl)
+
+parse_stats returns a small graph describing every measure it encounters.
+Instead of merging each of those into fsterms.ttl on disk, the definitions
+are collected here for the whole run and written out once (or every
+`flush_every` additions). Writes take an exclusive lock, merge with the terms
+already on disk (contributed by other processes) and atomically replace the
+file.
+"""
+
+import fcntl
+import os
+import tempfile
+import threading
+
+import rdflib
+
+import profiling
+
+
+class MeasureRegistry(object):
+    """Collect measure definitions and flush them to a Turtle file
+
+    filename: vocabulary file to merge into (default: fsterms.ttl)
+    flush_every: flush after this many calls to add (None: only on flush)
+    """
+
+    def __init__(self, filename='fsterms.ttl', flush_every=None):
+        self.filename = os.path.abspath(filename)
+        self.flush_every = flush_every
+        self.graph = rdflib.Graph()
+        self._n_added = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.graph)
+
+    def add(self, measure_graph):
+        """Merge the measure definitions of a parse_stats graph
+        """
+        self.add_triples(measure_graph, namespaces=measure_graph.namespaces())
+
+    def add_triples(self, triples, namespaces=None):
+        """Merge an iterable of (s, p, o) measure triples
+        """
+        with self._lock:
+            if namespaces is not None:
+                for prefix, uri in namespaces:
+                    self.graph.bind(prefix, uri)
+            n_triples = len(self.graph)
+            for triple in triples:
+                self.graph.add(triple)
+            if len(self.graph) != n_triples:
+                self._dirty = True
+            self._n_added += 1
+            flush = self.flush_every and self._n_added % self.flush_every == 0
+        if flush:
+            self.flush()
+
+    def triples(self):
+        """Return the collected triples as a list (e.g., to send them from a
+        worker process to the registry of the parent)
+        """
+        with self._lock:
+            return list(self.graph)
+
+    def flush(self):
+        """Merge collected terms into the vocabulary file
+
+        The file is locked for the duration of the merge and replaced
+        atomically, so concurrent runs never lose each other's terms or see
+        a partially written file.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            dirname = os.path.dirname(self.filename)
+            with profiling.stage('fsterms'), \
+                    open(self.filename + '.lock', 'a') as lock_fp:
+                fcntl.flock(lock_fp, fcntl.LOCK_EX)
+                try:
+                    if os.path.exists(self.filename):
+                        self.graph.parse(self.filename, format='turtle')
+                    fd, tmp_file = tempfile.mkstemp(dir=dirname,
+                                                    suffix='.ttl.tmp')
+                    try:
+                        with os.fdopen(fd, 'wb') as fp:
+                            self.graph.serialize(fp, format='turtle')
+                        os.chmod(tmp_file, 0o644)
+                        os.rename(tmp_file, self.filename)
+                    except:
+                        os.unlink(tmp_file)
+                        raise
+                finally:
+                    fcntl.flock(lock_fp, fcntl.LOCK_UN)
+            self._dirty = False
+            profiling.count('fsterms', triples=len(self.graph))
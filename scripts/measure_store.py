@@ -0,0 +1,537 @@
+#!/usr/bin/env python
+"""Columnar store of FreeSurfer stats values across subjects
+
+For analyses that only need the numbers, the .stats files of many subjects
+are read with fs_stats.load_stats into one subject x structure x measure
+array per stats table (e.g., lh.aparc, aseg), instead of being encoded,
+uploaded and queried back with SPARQL. Header `Measure` lines are stored in
+the same array as the table rows (e.g., Cortex x MeanThickness of
+lh.aparc). Values are float64, with NaN where a subject has no value.
+
+Subjects are added in segments, so the store grows incrementally; a
+subject added again (e.g., after re-running FreeSurfer) is served from its
+latest segment, and compact() merges all segments into one. Arrays are
+.npy files read memory-mapped. The IRI of the file entity each table came
+from is kept per subject as a provenance column (by default the
+content-derived IRI fs_upload_to_triplesore.py gives the file with
+--deterministic_ids, see identifiers).
+
+Segments are written on their own and then added to index.json under an
+exclusive lock on <store>/index.json.lock (held for the whole of
+compact()), so concurrent writers do not drop each other's segments. The
+segments merged by compact() stay on disk until the next segment is added
+or merged, for the instances that read the index before; an instance that
+still finds a segment gone reads the index again under the lock.
+
+Layout:
+
+    <store>/index.json            {"segments": [<segment>, ...],
+                                   "retired": [<segment>, ...]}
+    <store>/<segment>/segment.json
+        {"subjects": [...],
+         "tables": {<table>: {"structures": [...], "measures": [...],
+                              "units": [...], "provenance": [...]}}}
+    <store>/<segment>/<table>.npy  (subjects, structures, measures)
+"""
+
+import errno
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from fs_stats import load_stats
+from hash_cache import hash_file
+from identifiers import content_id
+
+niiri = 'http://nidm.nidash.org/iri/'
+
+
+def stats_tables(subject_dir):
+    """Return the (table name, filename) of the .stats files of a subject
+    (curvature summaries, which have no table, are left out)
+    """
+    stats_dir = os.path.join(subject_dir, 'stats')
+    if not os.path.isdir(stats_dir):
+        return []
+    return [(name[:-len('.stats')], os.path.join(stats_dir, name))
+            for name in sorted(os.listdir(stats_dir))
+            if name.endswith('.stats') and '.curv.' not in name]
+
+
+def file_iri(subject_id, subject_dir, filename):
+    """Return the content-derived IRI of the file entity of a .stats file
+    (see fs_upload_to_triplesore.create_entity)
+    """
+    relpath = os.path.relpath(filename, subject_dir)
+    return niiri + content_id('file', subject_id, relpath,
+                              hash_file(filename)['md5'])
+
+
+def read_table(filename):
+    """Return the structures, measures, units and (structure, measure)
+    values of a .stats file
+    """
+    table = load_stats(filename)
+    structures = []
+    measures = []
+    units = []
+    cells = []
+    struct_pos = {}
+    measure_pos = {}
+
+    def position(names, positions, name):
+        if name not in positions:
+            positions[name] = len(names)
+            names.append(name)
+            return positions[name], True
+        return positions[name], False
+
+    columns = []
+    for col_idx in sorted(table.tableinfo):
+        info = table.tableinfo[col_idx]
+        column = table.columns.get(info['ColHeader'])
+        if col_idx == table.struct_idx or column is None or \
+                column.dtype.kind not in 'if':
+            continue
+        col, new = position(measures, measure_pos, info['ColHeader'])
+        if new:
+            units.append(info['Units'])
+        columns.append((col, column))
+    rows = []
+    if table.struct_idx is not None:
+        rows = [position(structures, struct_pos, name)[0]
+                for name in table.structures.tolist()]
+    # header measures come after the table rows and columns
+    for measure in table.measures:
+        row, _ = position(structures, struct_pos, measure['structure'])
+        col, new = position(measures, measure_pos, measure['name'])
+        if new:
+            units.append(measure['units'])
+        cells.append((row, col, measure['value']))
+    values = np.empty((len(structures), len(measures)))
+    values.fill(np.nan)
+    if rows:
+        for col, column in columns:
+            values[rows, col] = column
+    for row, col, value in cells:
+        values[row, col] = value
+    return structures, measures, units, values
+
+
+def read_subject(args):
+    """Return the subject id and the tables of a subject directory (run in
+    a worker process)
+    """
+    subject_dir, subject_id, provenance = args
+    tables = {}
+    for name, filename in stats_tables(subject_dir):
+        structures, measures, units, values = read_table(filename)
+        iri = None
+        if provenance:
+            iri = file_iri(subject_id, subject_dir, filename)
+        tables[name] = {'structures': structures, 'measures': measures,
+                        'units': units, 'values': values, 'provenance': iri}
+    return subject_id, tables
+
+
+def _write_json(data, filename):
+    """Write JSON atomically
+    """
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                    suffix='.json.tmp')
+    try:
+        with os.fdopen(fd, 'wt') as fp:
+            json.dump(data, fp, indent=1, sort_keys=True)
+        os.chmod(tmp_file, 0o644)
+        os.rename(tmp_file, filename)
+    except:
+        os.unlink(tmp_file)
+        raise
+
+
+class MeasureStore(object):
+    """Subject x structure x measure arrays of the stats tables of many
+    subjects
+
+    path: store directory (created if missing)
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._read_index()
+
+    def _read_index(self):
+        index = os.path.join(self.path, 'index.json')
+        self.index = {'segments': []}
+        if os.path.exists(index):
+            with open(index, 'rt') as fp:
+                self.index = json.load(fp)
+        self._segments = None
+
+    def _locked(self):
+        """Lock the index against other processes and read it again
+        """
+        return _IndexLock(self)
+
+    def _reload(self):
+        """Read the index again once another instance has written it
+        """
+        with self._locked():
+            pass
+
+    def _add_segment(self, name, replace=False):
+        """Add a segment to the index (call with the index locked)
+
+        The segments retired by the previous compaction are removed; with
+        replace, the current ones are retired.
+        """
+        retired = self.index.get('retired', [])
+        if replace:
+            self.index['retired'] = self.index['segments']
+            self.index['segments'] = [name]
+        else:
+            self.index['retired'] = []
+            self.index['segments'].append(name)
+        _write_json(self.index, os.path.join(self.path, 'index.json'))
+        self._segments = None
+        for old in retired:
+            shutil.rmtree(os.path.join(self.path, old), ignore_errors=True)
+
+    def _segment(self, name):
+        with open(os.path.join(self.path, name, 'segment.json'), 'rt') as fp:
+            return json.load(fp)
+
+    def segments(self):
+        """Return the (name, info) of the segments, oldest first
+        """
+        if self._segments is None:
+            try:
+                self._segments = [(name, self._segment(name))
+                                  for name in self.index['segments']]
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._reload()
+                self._segments = [(name, self._segment(name))
+                                  for name in self.index['segments']]
+        return self._segments
+
+    def subjects(self):
+        """Return the ids of the subjects in the store, in the order they
+        were first added
+        """
+        subjects = []
+        seen = set()
+        for _, info in self.segments():
+            for subject in info['subjects']:
+                if subject not in seen:
+                    seen.add(subject)
+                    subjects.append(subject)
+        return subjects
+
+    def tables(self):
+        """Return the names of the stats tables in the store
+        """
+        return sorted(set(table for _, info in self.segments()
+                          for table in info['tables']))
+
+    def measures(self, table):
+        """Return the measures of a table and their units
+        """
+        measures = []
+        units = {}
+        for _, info in self.segments():
+            table_info = info['tables'].get(table)
+            if table_info is None:
+                continue
+            for measure, unit in zip(table_info['measures'],
+                                     table_info['units']):
+                if measure not in units:
+                    units[measure] = unit
+                    measures.append(measure)
+        return [(measure, units[measure]) for measure in measures]
+
+    def add_subjects(self, subject_dirs, subject_ids=None, replace=False,
+                     provenance=True, n_procs=1):
+        """Read the stats tables of subject directories into a new segment
+
+        subject_ids: ids of the subjects (default: directory names)
+        replace: read subjects already in the store again (their latest
+            values are used)
+        provenance: record the file entity IRI of each table
+        n_procs: number of processes reading the subjects
+
+        Returns the number of subjects added.
+        """
+        if subject_ids is None:
+            subject_ids = [os.path.basename(subject_dir.rstrip(os.path.sep))
+                           for subject_dir in subject_dirs]
+        present = set() if replace else set(self.subjects())
+        jobs = [(subject_dir, subject_id, provenance)
+                for subject_dir, subject_id in zip(subject_dirs, subject_ids)
+                if subject_id not in present]
+        if not jobs:
+            return 0
+        if n_procs > 1:
+            from multiprocessing import Pool
+            pool = Pool(n_procs)
+            try:
+                results = pool.map(read_subject, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [read_subject(job) for job in jobs]
+        name = self._write_segment(results)
+        with self._locked():
+            self._add_segment(name)
+        return len(results)
+
+    def _write_segment(self, results):
+        """Write a segment from the (subject id, tables) of read_subject
+        and return its name (the caller adds it to the index)
+        """
+        subjects = [subject for subject, _ in results]
+        names = sorted(set(name for _, tables in results for name in tables))
+        segment = tempfile.mkdtemp(prefix='segment-', dir=self.path)
+        info = {'subjects': subjects, 'tables': {}}
+        try:
+            for name in names:
+                structures, measures, units = [], [], []
+                struct_pos, measure_pos = {}, {}
+                for _, tables in results:
+                    if name not in tables:
+                        continue
+                    table = tables[name]
+                    for structure in table['structures']:
+                        if structure not in struct_pos:
+                            struct_pos[structure] = len(structures)
+                            structures.append(structure)
+                    for measure, unit in zip(table['measures'],
+                                             table['units']):
+                        if measure not in measure_pos:
+                            measure_pos[measure] = len(measures)
+                            measures.append(measure)
+                            units.append(unit)
+                values = np.lib.format.open_memmap(
+                    os.path.join(segment, name + '.npy'), mode='w+',
+                    dtype=np.float64,
+                    shape=(len(subjects), len(structures), len(measures)))
+                values[:] = np.nan
+                iris = []
+                for idx, (_, tables) in enumerate(results):
+                    table = tables.get(name)
+                    iris.append(table and table['provenance'])
+                    if table is None:
+                        continue
+                    rows = [struct_pos[structure]
+                            for structure in table['structures']]
+                    cols = [measure_pos[measure]
+                            for measure in table['measures']]
+                    values[idx][np.ix_(rows, cols)] = table['values']
+                values.flush()
+                del values
+                info['tables'][name] = {'structures': structures,
+                                        'measures': measures,
+                                        'units': units,
+                                        'provenance': iris}
+            _write_json(info, os.path.join(segment, 'segment.json'))
+        except:
+            shutil.rmtree(segment)
+            raise
+        return os.path.basename(segment)
+
+    def query(self, table, measure, structures=None, subjects=None):
+        """Return the values of a measure of a table across subjects
+
+        structures, subjects: names to select (default: all, in store
+            order)
+
+        Returns the subjects, the structures and a (subjects, structures)
+        float array with NaN where a subject has no value.
+        """
+        values, subjects, structures, _ = self._gather(
+            table, measure, structures, subjects)
+        return subjects, structures, values
+
+    def provenance(self, table, subjects=None):
+        """Return the subjects and the file entity IRI each got its values
+        of a table from (None if it has no such table)
+        """
+        _, subjects, _, iris = self._gather(table, None, [], subjects)
+        return subjects, iris
+
+    def _gather(self, table, measure, structures, subjects):
+        try:
+            return self._gather_values(table, measure, structures, subjects)
+        except IOError, e:
+            # a segment removed by the compaction of another instance
+            if e.errno != errno.ENOENT:
+                raise
+            self._reload()
+            return self._gather_values(table, measure, structures, subjects)
+
+    def _gather_values(self, table, measure, structures, subjects):
+        if subjects is None:
+            subjects = self.subjects()
+        if structures is None:
+            structures = []
+            seen = set()
+            for _, info in self.segments():
+                for structure in info['tables'].get(table, {}).get(
+                        'structures', []):
+                    if structure not in seen:
+                        seen.add(structure)
+                        structures.append(structure)
+        subject_pos = dict((subject, idx)
+                           for idx, subject in enumerate(subjects))
+        struct_pos = dict((structure, idx)
+                          for idx, structure in enumerate(structures))
+        values = np.empty((len(subjects), len(structures)))
+        values.fill(np.nan)
+        iris = [None] * len(subjects)
+        for name, info in self.segments():
+            # later segments override the subjects they hold
+            rows = [(idx, subject_pos[subject])
+                    for idx, subject in enumerate(info['subjects'])
+                    if subject in subject_pos]
+            if not rows:
+                continue
+            table_info = info['tables'].get(table)
+            for idx, pos in rows:
+                iris[pos] = table_info and table_info['provenance'][idx]
+                values[pos] = np.nan
+            if table_info is None or measure is None or \
+                    measure not in table_info['measures']:
+                continue
+            col = table_info['measures'].index(measure)
+            cols = [(idx, struct_pos[structure])
+                    for idx, structure in enumerate(table_info['structures'])
+                    if structure in struct_pos]
+            if not cols:
+                continue
+            array = np.load(os.path.join(self.path, name, table + '.npy'),
+                            mmap_mode='r')
+            src_rows, dst_rows = zip(*rows)
+            src_cols, dst_cols = zip(*cols)
+            values[np.ix_(dst_rows, dst_cols)] = \
+                array[np.ix_(src_rows, src_cols, [col])][:, :, 0]
+        return values, subjects, structures, iris
+
+    def compact(self):
+        """Merge all segments into one (with the latest values of each
+        subject)
+
+        Returns the number of segments merged.
+        """
+        with self._locked():
+            segments = self.segments()
+            if len(segments) < 2:
+                return len(segments)
+            self._compact()
+        return len(segments)
+
+    def _compact(self):
+        """Replace the segments by one (call with the index locked)
+        """
+        subjects = self.subjects()
+        results = [(subject, {}) for subject in subjects]
+        for table in self.tables():
+            measures = self.measures(table)
+            if not measures:
+                continue
+            struct_values = []
+            for measure, _ in measures:
+                _, structures, values = self.query(table, measure)
+                struct_values.append(values)
+            _, iris = self.provenance(table)
+            stacked = np.dstack(struct_values)
+            for idx, (_, tables) in enumerate(results):
+                if iris[idx] is None and np.isnan(stacked[idx]).all():
+                    continue
+                tables[table] = {'structures': structures,
+                                 'measures': [name for name, _ in measures],
+                                 'units': [unit for _, unit in measures],
+                                 'values': stacked[idx],
+                                 'provenance': iris[idx]}
+        self._add_segment(self._write_segment(results), replace=True)
+
+
+class _IndexLock(object):
+
+    def __init__(self, store):
+        self.store = store
+        self.fp = None
+
+    def __enter__(self):
+        self.fp = open(os.path.join(self.store.path, 'index.json.lock'), 'a')
+        fcntl.flock(self.fp, fcntl.LOCK_EX)
+        try:
+            self.store._read_index()
+        except:
+            self.__exit__()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fp, fcntl.LOCK_UN)
+        self.fp.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import csv
+    import sys
+    parser = argparse.ArgumentParser(
+        prog='measure_store.py', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('store', type=str, help='Store directory')
+    parser.add_argument('--subjects_dir', type=str,
+                        help=('FreeSurfer $SUBJECTS_DIR whose subjects are '
+                              'added to the store'))
+    parser.add_argument('--subject_list', type=str,
+                        help=('File with one subject directory per line, '
+                              'relative to --subjects_dir if given'))
+    parser.add_argument('--replace', action='store_true',
+                        help='Read subjects already in the store again')
+    parser.add_argument('-j', '--n_procs', dest="n_procs", type=int,
+                        default=1,
+                        help='Number of processes reading subjects')
+    parser.add_argument('--compact', action='store_true',
+                        help='Merge the segments of the store')
+    parser.add_argument('-t', '--table', type=str,
+                        help='Stats table to query (e.g., lh.aparc)')
+    parser.add_argument('-m', '--measure', type=str,
+                        help=('Measure to write as CSV, one row per subject '
+                              '(e.g., ThickAvg)'))
+    args = parser.parse_args()
+
+    store = MeasureStore(args.store)
+    if args.subjects_dir or args.subject_list:
+        from fs_upload_to_triplesore import find_subject_dirs
+        subject_dirs = find_subject_dirs(args.subjects_dir,
+                                         args.subject_list)
+        print('Added %d of %d subjects' % (
+            store.add_subjects(subject_dirs, replace=args.replace,
+                               n_procs=args.n_procs), len(subject_dirs)))
+    if args.compact:
+        print('Merged %d segments' % store.compact())
+    if args.table and args.measure:
+        subjects, structures, values = store.query(args.table, args.measure)
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['subject'] + structures)
+        for subject, row in zip(subjects, values):
+            writer.writerow([subject] + ['' if np.isnan(value) else repr(value)
+                                         for value in row])
+    elif args.table:
+        for measure, units in store.measures(args.table):
+            print('%s (%s)' % (measure, units))
+    elif not (args.subjects_dir or args.subject_list or args.compact):
+        for table in store.tables():
+            print(table)
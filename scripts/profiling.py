@@ -0,0 +1,200 @@
+"""Per-stage wall time and counters of a run (--profile)
+
+The scripts wrap their stages (directory walk, hashing, .stats parsing,
+fsterms.ttl merging, serialization, upload, ...) in `stage(name)` blocks and
+add counters to them (files, bytes_read, triples, requests, ...) with
+`count`. Nothing is recorded until `enable()` is called, so the hooks cost a
+function call otherwise. Stage times are inclusive: a stage nested in
+another (e.g., hash in entity) is also counted in the outer one.
+
+`write_report` saves the stages as JSON, together with the cProfile dump of
+the run if one was started with `enable(cprofile=True)`. Reports of worker
+processes are sent to the parent with `pop_report` and added with `merge`.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+_profile = None
+
+
+class Profile(object):
+    """Wall time, number of calls and counters of named stages
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def _stage(self, name):
+        info = self.stages.get(name)
+        if info is None:
+            info = self.stages[name] = {'seconds': 0., 'calls': 0}
+        return info
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            info = self._stage(name)
+            info['seconds'] += seconds
+            info['calls'] += 1
+
+    def count(self, name, counters):
+        with self._lock:
+            info = self._stage(name)
+            for key, value in counters.items():
+                info[key] = info.get(key, 0) + value
+
+    def merge(self, stages):
+        """Add the stages of another report (e.g., of a worker process)
+        """
+        with self._lock:
+            for name, counters in stages.items():
+                info = self._stage(name)
+                for key, value in counters.items():
+                    info[key] = info.get(key, 0) + value
+
+    def report(self):
+        with self._lock:
+            return dict((name, dict(info))
+                        for name, info in self.stages.items())
+
+
+class _Stage(object):
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.add_time(self.name, time.time() - self.t0)
+        return False
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_stage = _NullStage()
+_cprofile = None
+
+
+def enable(cprofile=False):
+    """Start recording stages (and a cProfile of the whole process)
+    """
+    global _profile, _cprofile
+    if _profile is None:
+        _profile = Profile()
+    if cprofile and _cprofile is None:
+        import cProfile
+        _cprofile = cProfile.Profile()
+        _cprofile.enable()
+
+
+def enabled():
+    return _profile is not None
+
+
+def stage(name):
+    """Return a context manager timing a stage
+    """
+    if _profile is None:
+        return _null_stage
+    return _Stage(_profile, name)
+
+
+def count(name, **counters):
+    """Add counters (e.g., files=1, bytes_read=n) to a stage
+    """
+    if _profile is not None:
+        _profile.count(name, counters)
+
+
+def timed(name, iterable, counter='items'):
+    """Yield from an iterable, timing each step as a call of a stage and
+    counting the items produced
+    """
+    if _profile is None:
+        for item in iterable:
+            yield item
+        return
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        count(name, **{counter: 1})
+        yield item
+
+
+def merge(stages):
+    if _profile is not None and stages:
+        _profile.merge(stages)
+
+
+def pop_report():
+    """Return the stages recorded so far and start over (None if disabled)
+    """
+    global _profile
+    if _profile is None:
+        return None
+    stages = _profile.report()
+    start = _profile.start
+    _profile = Profile()
+    _profile.start = start
+    return stages
+
+
+def report():
+    """Return the run report: command line, total wall time and stages
+    """
+    if _profile is None:
+        return None
+    return {'argv': sys.argv,
+            'pid': os.getpid(),
+            'started': _profile.start,
+            'seconds': time.time() - _profile.start,
+            'stages': _profile.report()}
+
+
+def write_report(filename):
+    """Write the JSON report; the cProfile dump goes to <filename>.prof
+    """
+    run_report = report()
+    if run_report is None:
+        return None
+    if _cprofile is not None:
+        _cprofile.disable()
+        run_report['cprofile'] = filename + '.prof'
+        _cprofile.dump_stats(run_report['cprofile'])
+    with open(filename, 'wt') as fp:
+        json.dump(run_report, fp, indent=2, sort_keys=True)
+    return run_report
+
+
+def print_report(run_report, fp=sys.stdout):
+    """Print the stages of a report as a table, slowest first
+    """
+    fp.write('%-20s %10s %8s  %s\n' % ('stage', 'seconds', 'calls',
+                                       'counters'))
+    for name, info in sorted(run_report['stages'].items(),
+                             key=lambda item: -item[1]['seconds']):
+        counters = ', '.join('%s=%d' % (key, value)
+                             for key, value in sorted(info.items())
+                             if key not in ('seconds', 'calls'))
+        fp.write('%-20s %10.3f %8d  %s\n' % (name, info['seconds'],
+                                             info['calls'], counters))
+    fp.write('%-20s %10.3f\n' % ('total', run_report['seconds']))
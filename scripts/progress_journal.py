@@ -0,0 +1,296 @@
+"""Append-only journal of completed work for resuming interrupted runs
+
+A ProgressJournal records the work items of a run (stats files, subjects,
+collections) once they are done, and the ranges of upload groups whose
+batches were stored (see SparqlUploader.upload), so a restarted run skips
+what was already uploaded instead of inserting it again. Workers of
+parallel runs sharing a journal claim an item before working on it; a
+claim expires after claim_ttl seconds, or as soon as the process holding
+it is gone (for workers on the same host), so the items of a dead worker
+are taken over.
+
+Layout (one JSON object per line, appended under an exclusive lock on
+<journal>.lock):
+
+    {"op": "done", "kind": ..., "key": ..., "info": {...}, "time": ...}
+    {"op": "claim" | "release", "kind": ..., "key": ..., "worker": ...,
+     "time": ...}
+    {"op": "range", "key": <upload scope>, "start": ..., "end": ...}
+
+A line cut short by a crash is skipped. compact() rewrites the journal
+with one line per done item, the merged ranges of each scope and the
+claims still held.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+
+def merge_ranges(ranges):
+    """Return sorted, non-overlapping [start, end) ranges
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class ProgressJournal(object):
+    """Journal of the work items done by the runs sharing a file
+
+    filename: journal path (created if missing)
+    worker: name of this worker in claims (default: <host>:<pid>)
+    claim_ttl: seconds after which the claim of another worker is ignored
+    """
+
+    def __init__(self, filename, worker=None, claim_ttl=3600.):
+        self.filename = os.path.abspath(filename)
+        self.worker = worker or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.claim_ttl = claim_ttl
+        self._lock = threading.Lock()
+        self._reset()
+        with self._lock:
+            with self._locked():
+                pass
+
+    def _reset(self):
+        self._done = {}
+        self._claims = {}
+        self._ranges = {}
+        self._offset = 0
+        self._inode = None
+
+    def _locked(self):
+        """Lock the journal against other processes and read the entries
+        they appended (call with self._lock held)
+        """
+        return _FileLock(self)
+
+    def _refresh(self):
+        if not os.path.exists(self.filename):
+            open(self.filename, 'a').close()
+        inode = os.stat(self.filename).st_ino
+        if inode != self._inode:
+            # compacted by another process
+            self._reset()
+            self._inode = inode
+        with open(self.filename, 'rb') as fp:
+            fp.seek(self._offset)
+            for line in fp:
+                if not line.endswith('\n'):
+                    break
+                self._offset += len(line)
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+    def _apply(self, entry):
+        op = entry['op']
+        if op == 'range':
+            ranges = self._ranges.setdefault(entry['key'], [])
+            ranges.append([entry['start'], entry['end']])
+            if len(ranges) > 64:
+                ranges[:] = merge_ranges(ranges)
+            return
+        item = (entry['kind'], entry['key'])
+        if op == 'done':
+            self._done[item] = entry.get('info') or {}
+            self._claims.pop(item, None)
+        elif op == 'claim':
+            self._claims[item] = (entry['worker'], entry['time'])
+        elif op == 'release':
+            if self._claims.get(item, (None,))[0] == entry['worker']:
+                del self._claims[item]
+
+    def _append(self, entries):
+        """Write entries (with the journal locked)
+        """
+        lines = [json.dumps(entry, separators=(',', ':')) + '\n'
+                 for entry in entries]
+        with open(self.filename, 'ab') as fp:
+            if os.path.getsize(self.filename) > self._offset:
+                # the last line was cut short
+                fp.write('\n')
+            fp.writelines(lines)
+            fp.flush()
+            os.fsync(fp.fileno())
+        # applied as they are read back, e.g., with rdflib terms as strings
+        for line in lines:
+            self._apply(json.loads(line))
+        self._offset = os.path.getsize(self.filename)
+
+    def refresh(self):
+        """Read the entries appended by other workers
+        """
+        with self._lock:
+            with self._locked():
+                pass
+
+    def is_done(self, kind, key):
+        with self._lock:
+            return (kind, key) in self._done
+
+    def info(self, kind, key):
+        """Return the info recorded with a done item, or None
+        """
+        with self._lock:
+            return self._done.get((kind, key))
+
+    def mark_done(self, kind, key, **info):
+        with self._lock:
+            with self._locked():
+                self._append([{'op': 'done', 'kind': kind, 'key': key,
+                               'info': info, 'time': time.time()}])
+
+    def claim(self, kind, key):
+        """Claim an item for this worker
+
+        Returns False if the item is done or held by another worker.
+        """
+        item = (kind, key)
+        with self._lock:
+            with self._locked():
+                if item in self._done:
+                    return False
+                worker, claimed = self._claims.get(item, (None, 0))
+                now = time.time()
+                if worker not in (None, self.worker) and \
+                        not self._is_stale(worker, claimed, now):
+                    return False
+                self._append([{'op': 'claim', 'kind': kind, 'key': key,
+                               'worker': self.worker, 'time': now}])
+                return True
+
+    def _is_stale(self, worker, claimed, now):
+        """Return True if a claim expired or its process on this host
+        is gone
+        """
+        if claimed + self.claim_ttl <= now:
+            return True
+        host, _, pid = worker.rpartition(':')
+        if host != socket.gethostname() or not pid.isdigit():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except OSError, e:
+            return e.errno == errno.ESRCH
+        return False
+
+    def release(self, kind, key):
+        """Give up the claim of an item that was not done (e.g., failed)
+        """
+        with self._lock:
+            with self._locked():
+                self._append([{'op': 'release', 'kind': kind, 'key': key,
+                               'worker': self.worker, 'time': time.time()}])
+
+    def ranges(self, key):
+        """Return the [start, end) group ranges uploaded in a scope
+        """
+        with self._lock:
+            return merge_ranges(self._ranges.get(key, []))
+
+    def add_range(self, key, start, end):
+        with self._lock:
+            with self._locked():
+                self._append([{'op': 'range', 'key': key, 'start': start,
+                               'end': end}])
+
+    def compact(self):
+        """Rewrite the journal without superseded entries
+
+        Returns the number of lines written.
+        """
+        with self._lock:
+            with self._locked():
+                now = time.time()
+                entries = [{'op': 'done', 'kind': kind, 'key': key,
+                            'info': info, 'time': now}
+                           for (kind, key), info in sorted(
+                               self._done.items())]
+                entries.extend({'op': 'range', 'key': key, 'start': start,
+                                'end': end}
+                               for key, ranges in sorted(self._ranges.items())
+                               for start, end in merge_ranges(ranges))
+                entries.extend({'op': 'claim', 'kind': kind, 'key': key,
+                                'worker': worker, 'time': claimed}
+                               for (kind, key), (worker, claimed) in sorted(
+                                   self._claims.items())
+                               if not self._is_stale(worker, claimed, now))
+                fd, tmp_file = tempfile.mkstemp(
+                    dir=os.path.dirname(self.filename), suffix='.journal.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as fp:
+                        for entry in entries:
+                            fp.write(json.dumps(entry, separators=(',', ':'))
+                                     + '\n')
+                        fp.flush()
+                        os.fsync(fp.fileno())
+                    os.chmod(tmp_file, 0o644)
+                    os.rename(tmp_file, self.filename)
+                except:
+                    os.unlink(tmp_file)
+                    raise
+                self._reset()
+                self._refresh()
+                return len(entries)
+
+    def stats(self):
+        """Return the number of done items of each kind, of upload scopes
+        and of claims held
+        """
+        with self._lock:
+            done = {}
+            for kind, _ in self._done:
+                done[kind] = done.get(kind, 0) + 1
+            return {'done': done, 'scopes': len(self._ranges),
+                    'claims': len(self._claims)}
+
+
+class _FileLock(object):
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.fp = None
+
+    def __enter__(self):
+        self.fp = open(self.journal.filename + '.lock', 'a')
+        fcntl.flock(self.fp, fcntl.LOCK_EX)
+        try:
+            self.journal._refresh()
+        except:
+            self.__exit__()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fp, fcntl.LOCK_UN)
+        self.fp.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog='progress_journal.py',
+                                     description=__doc__)
+    parser.add_argument('journal', type=str, help='Journal file')
+    parser.add_argument('--compact', action='store_true',
+                        help='Rewrite the journal without superseded entries')
+    args = parser.parse_args()
+
+    journal = ProgressJournal(args.journal)
+    if args.compact:
+        print('Wrote %d entries' % journal.compact())
+    stats = journal.stats()
+    for kind, count in sorted(stats['done'].items()):
+        print('%s: %d done' % (kind, count))
+    print('%d upload scopes, %d claims' % (stats['scopes'], stats['claims']))
@@ -0,0 +1,261 @@
+"""Persistent cache of SPARQL SELECT results shared across runs
+
+Results are keyed by the endpoint and the query text with its whitespace
+and comments normalized, so re-running get_collections/get_urls (or any
+query of a notebook) while iterating does not transfer the same result set
+again. Rows are stored as zlib-compressed JSON in a sqlite database. Entries
+expire after `ttl` seconds and the least recently used ones are evicted
+beyond `max_bytes`. After an upload, invalidate(endpoint, graph_iri) drops
+the results that may depend on the graph.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+import rdflib
+
+import profiling
+
+# IRIs, string literals and comments, which whitespace normalization must
+# not touch (comments are dropped)
+token_re = re.compile(r'(<[^<>"{}|^`\\\s]*>|"""(?:[^"\\]|\\.|"(?!""))*"""|'
+                      r"'''(?:[^'\\]|\\.|'(?!''))*'''|"
+                      r'"(?:[^"\\\n]|\\.)*"|'
+                      r"'(?:[^'\\\n]|\\.)*'|#[^\n]*)")
+graph_re = re.compile(r'\b(?:from(?:\s+named)?|graph)\s+<([^>]*)>',
+                      re.IGNORECASE)
+
+
+def normalize_query(query):
+    """Return the query with comments removed and runs of whitespace
+    outside of IRIs and literals replaced by a single space
+    """
+    parts = []
+    for idx, part in enumerate(token_re.split(query)):
+        if idx % 2:
+            if not part.startswith('#'):
+                parts.append(part)
+        else:
+            parts.append(' '.join(part.split()))
+    return ' '.join(part for part in parts if part)
+
+
+def query_graphs(query):
+    """Return the graph IRIs named in FROM, FROM NAMED and GRAPH clauses
+    (empty if the query reads the default graph only)
+    """
+    return sorted(set(graph_re.findall(normalize_query(query))))
+
+
+def _utf8(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def dump_term(term):
+    """Return a JSON-serializable form of an rdflib term (or None)
+    """
+    if term is None:
+        return None
+    if isinstance(term, rdflib.URIRef):
+        return ['u', unicode(term)]
+    if isinstance(term, rdflib.BNode):
+        return ['b', unicode(term)]
+    return ['l', unicode(term), term.language,
+            term.datatype and unicode(term.datatype)]
+
+
+def load_term(data):
+    """Return the rdflib term of dump_term
+    """
+    if data is None:
+        return None
+    if data[0] == 'u':
+        return rdflib.URIRef(data[1])
+    if data[0] == 'b':
+        return rdflib.BNode(data[1])
+    return rdflib.Literal(data[1], lang=data[2], datatype=data[3])
+
+
+class QueryCache(object):
+    """On-disk cache of SELECT results
+
+    filename: path to the sqlite database (created if missing)
+    ttl: seconds a result is used for (None: until invalidated)
+    max_bytes: compressed size of the results kept before the least
+        recently used ones are evicted
+    """
+
+    def __init__(self, filename, ttl=3600., max_bytes=256 * 1024 * 1024,
+                 timeout=60.):
+        self.filename = os.path.abspath(filename)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+        self.bytes_read = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        conn = self._connection()
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS results (
+                            key TEXT PRIMARY KEY, endpoint TEXT,
+                            graphs TEXT, created REAL, atime REAL,
+                            size INTEGER, data BLOB)
+                         """)
+            conn.execute("""CREATE INDEX IF NOT EXISTS results_atime
+                            ON results (atime)""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS results_endpoint
+                            ON results (endpoint)""")
+
+    def _connection(self):
+        """Return the sqlite connection of the calling thread
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=self.timeout)
+            try:
+                conn.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.OperationalError:
+                # e.g., on file systems without shared memory support
+                pass
+            self._local.conn = conn
+        return conn
+
+    def key(self, endpoint, query):
+        """Return the cache key of a query sent to an endpoint
+        """
+        return hashlib.sha1('%s\n%s' % (
+            _utf8(endpoint), _utf8(normalize_query(query)))).hexdigest()
+
+    def lookup(self, endpoint, query):
+        """Return the cached rows of a query, or None
+        """
+        key = self.key(endpoint, query)
+        conn = self._connection()
+        row = conn.execute("""SELECT created, data FROM results
+                              WHERE key=?""", (key,)).fetchone()
+        now = time.time()
+        if row is not None and self.ttl is not None and \
+                row[0] + self.ttl < now:
+            with conn:
+                conn.execute('DELETE FROM results WHERE key=?', (key,))
+            with self._lock:
+                self.expired += 1
+            row = None
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            profiling.count('query', cache_misses=1)
+            return None
+        with conn:
+            conn.execute('UPDATE results SET atime=? WHERE key=?',
+                         (now, key))
+        data = str(row[1])
+        with self._lock:
+            self.hits += 1
+            self.bytes_read += len(data)
+        profiling.count('query', cache_hits=1)
+        return [tuple(load_term(term) for term in values)
+                for values in json.loads(zlib.decompress(data))]
+
+    def store(self, endpoint, query, rows):
+        """Add the rows (sequences of rdflib terms) of a query to the cache
+        """
+        data = zlib.compress(json.dumps(
+            [[dump_term(term) for term in values] for values in rows],
+            separators=(',', ':')))
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute("""INSERT OR REPLACE INTO results
+                            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                         (self.key(endpoint, query), endpoint,
+                          ' '.join(query_graphs(query)), now, now,
+                          len(data), sqlite3.Binary(data)))
+        with self._lock:
+            self._puts += 1
+            evict = self._puts >= 100
+            if evict:
+                self._puts = 0
+        if evict:
+            self.evict()
+
+    def rows(self, endpoint, query, run):
+        """Return the rows of a query, calling run() for them on a miss
+        """
+        rows = self.lookup(endpoint, query)
+        if rows is None:
+            rows = [tuple(values) for values in run()]
+            self.store(endpoint, query, rows)
+        return rows
+
+    def invalidate(self, endpoint, graph_iri=None):
+        """Drop the results of an endpoint that may depend on a graph: the
+        queries naming it and those reading the default graph (all of them
+        if graph_iri is None)
+
+        Returns the number of results dropped.
+        """
+        conn = self._connection()
+        with conn:
+            if graph_iri is None:
+                cursor = conn.execute('DELETE FROM results WHERE endpoint=?',
+                                      (endpoint,))
+            else:
+                cursor = conn.execute(
+                    """DELETE FROM results WHERE endpoint=? AND
+                       (graphs='' OR instr(' ' || graphs || ' ', ?) > 0)""",
+                    (endpoint, ' %s ' % graph_iri))
+        with self._lock:
+            self.invalidated += cursor.rowcount
+        return cursor.rowcount
+
+    def evict(self):
+        """Drop expired results and least recently used ones beyond
+        `max_bytes`
+        """
+        conn = self._connection()
+        with conn:
+            if self.ttl is not None:
+                conn.execute('DELETE FROM results WHERE created < ?',
+                             (time.time() - self.ttl,))
+            n_bytes = conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            if n_bytes <= self.max_bytes:
+                return
+            for key, size in conn.execute(
+                    'SELECT key, size FROM results ORDER BY atime').fetchall():
+                conn.execute('DELETE FROM results WHERE key=?', (key,))
+                n_bytes -= size
+                if n_bytes <= self.max_bytes:
+                    break
+
+    def stats(self):
+        """Return hit/miss statistics for this process
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / total if total else 0.,
+                'expired': self.expired,
+                'invalidated': self.invalidated,
+                'bytes_read': self.bytes_read}
+
+    def close(self):
+        self.evict()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
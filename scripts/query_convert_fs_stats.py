@@ -3,13 +3,14 @@
 """
 
 #standard library
+from cStringIO import StringIO
 from datetime import datetime as dt
 import hashlib
 import os
-from tempfile import mktemp
+from Queue import Queue
 import pwd
+import threading
 import urlparse
-import urllib
 from uuid import uuid1
 
 # PROV API library
@@ -17,9 +18,40 @@ import pandas as pd
 import prov.model as prov
 import rdflib
 import requests
+from requests.adapters import HTTPAdapter
 
-def get_collections(endpoint, limit=1000):
+from fs_stats import read_stats
+from measure_registry import MeasureRegistry
+import profiling
+from progress_journal import ProgressJournal
+from query_cache import QueryCache
+from rdf_stream import batch_ntriples, iter_record_ntriples
+from sparql_cursor import SparqlCursor
+from sparql_upload import SparqlUploader
+from stats_triples import ntriples, stats_triples, stats_vocabulary
+
+# terms of the stats collections written directly by stats_triples, matching
+# those of parse_stats
+stats_terms = stats_vocabulary(
+    'http://freesurfer.net/fswiki/terms/', 'http://nidm.nidash.org/terms/',
+    'http://nidm.nidash.org/iri/',
+    'http://nidm.nidash.org/terms/FreeSurferStatsCollection',
+    'http://freesurfer.net/fswiki/terms/stat_header',
+    'http://nidm.nidash.org/terms/AnatomicalAnnotation',
+    'http://nidm.nidash.org/terms/units',
+    namespaces={'prov': prov.PROV.get_uri(), 'xsd': prov.XSD.get_uri(),
+                'foaf': 'http://xmlns.com/foaf/0.1/',
+                'dcterms': 'http://purl.org/dc/terms/',
+                'fs': 'http://freesurfer.net/fswiki/terms/',
+                'nidm': 'http://nidm.nidash.org/terms/',
+                'niiri': 'http://nidm.nidash.org/iri/'})
+
+
+def get_collections(endpoint, page_size=1000, cache=None):
     """Get all freesurfer subject directory collections from remote endpoint
+
+    Returns a SparqlCursor: rows are fetched page_size at a time while they
+    are iterated over, or read from `cache` (a query_cache.QueryCache).
     """
     query = """
     PREFIX prov: <http://www.w3.org/ns/prov#>
@@ -30,21 +62,26 @@ def get_collections(endpoint, limit=1000):
     {?collection a prov:Collection;
                  a fs:subject_directory .
     }
-    LIMIT %d
-    """ % limit
-    g = rdflib.Graph('SPARQLStore')
-    g.open(endpoint)
-    results = g.query(query)
-    return results
-
-def get_urls(endpoint, collection, limit=1000, ignore_filter=False):
+    """
+    return SparqlCursor(endpoint, query, page_size=page_size, cache=cache)
+
+def _urls_query(collection, ignore_filter=False, values=None):
+    """Return the query of the stats files of `collection`, a term or a
+    variable bound by a VALUES block of the `values` collections
+    """
     query = """
     PREFIX prov: <http://www.w3.org/ns/prov#>
     PREFIX fs: <http://freesurfer.net/fswiki/terms/>
     PREFIX crypto: <http://www.w3.org/2000/10/swap/crypto#>
     PREFIX nidm: <http://nidm.nidash.org/terms/>
-    select ?e ?relpath ?md5 ?path where
-    {<%s> a prov:Collection;
+    select ?e ?relpath ?md5 ?path%s where
+    {""" % (' ' + collection if values is not None else '')
+    if values is not None:
+        query += """VALUES %s {
+      %s
+     }
+     """ % (collection, '\n      '.join('<%s>' % uri for uri in values))
+    query += """%s a prov:Collection;
         prov:hadMember ?e .
      ?e fs:FileType fs:statistic_file;
         fs:relative_path ?relpath;
@@ -63,67 +100,40 @@ def get_urls(endpoint, collection, limit=1000, ignore_filter=False):
     """
     query += """
     }
-    LIMIT %d
-    """ % limit
-    g = rdflib.ConjunctiveGraph('SPARQLStore')
-    g.open(endpoint)
-    results = g.query(query)
-    return results
-
-def read_stats(filename):
-    """Convert stats file to a structure
     """
-    header = {}
-    tableinfo = {}
-    measures = []
-    rowmeasures = []
-    with open(filename, 'rt') as fp:
-        lines = fp.readlines()
-        for line in lines:
-            if line == line[0]:
-                continue
-            #parse commented header
-            if line.startswith('#'):
-                fields = line.split()[1:]
-                if len(fields) < 2:
-                    continue
-                tag = fields[0]
-                if tag == 'TableCol':
-                    col_idx = int(fields[1])
-                    if col_idx not in tableinfo:
-                        tableinfo[col_idx] = {}
-                    tableinfo[col_idx][fields[2]] = ' '.join(fields[3:])
-                    if tableinfo[col_idx][fields[2]] == "StructName":
-                        struct_idx = col_idx
-                elif tag == "Measure":
-                    fields = ' '.join(fields[1:]).split(', ')
-                    measures.append({'structure': fields[0],
-                                     'name': fields[1],
-                                     'description': fields[2],
-                                     'value': fields[3],
-                                     'units': fields[4],
-                                     'source': 'Header'})
-                elif tag == "ColHeaders":
-                    continue
-                else:
-                    header[tag] = ' '.join(fields[1:])
-            else:
-                #read values
-                row = line.split()
-                values = {}
-                measures.append({'structure': row[struct_idx-1],
-                                 'items': [],
-                                 'source': 'Table'}),
-                for idx, value in enumerate(row):
-                    if idx + 1 == struct_idx:
-                        continue
-                    measures[-1]['items'].append({
-                        'name': tableinfo[idx + 1]['ColHeader'],
-                        'description': tableinfo[idx + 1]['FieldName'],
-                        'value': value,
-                        'units': tableinfo[idx + 1]['Units'],
-                        })
-    return header, tableinfo, measures
+    return query
+
+def get_urls(endpoint, collection, page_size=1000, ignore_filter=False,
+             cache=None):
+    """Get the (entity, relpath, md5, url) rows of the stats files of a
+    collection, as a SparqlCursor (see get_collections)
+    """
+    query = _urls_query('<%s>' % collection, ignore_filter=ignore_filter)
+    return SparqlCursor(endpoint, query, page_size=page_size, cache=cache)
+
+def get_batch_urls(endpoint, collections, page_size=1000,
+                   ignore_filter=False, cache=None):
+    """Get the (entity, relpath, md5, url, collection) rows of the stats
+    files of several collections in one query, as a SparqlCursor
+
+    The collections are listed in a VALUES block, so the store evaluates
+    the filters of get_urls once for all of them.
+    """
+    query = _urls_query('?collection', ignore_filter=ignore_filter,
+                        values=collections)
+    return SparqlCursor(endpoint, query, page_size=page_size, cache=cache)
+
+def batches(items, size):
+    """Yield lists of up to size consecutive items
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 def parse_stats(fs_stat_file, entity_uri):
     """Convert stats file to a nidm object
@@ -170,7 +180,6 @@ def parse_stats(fs_stat_file, entity_uri):
     measure_graph = rdflib.ConjunctiveGraph()
     measure_graph.namespace_manager.bind('fs', fs.get_uri())
     measure_graph.namespace_manager.bind('nidm', nidm.get_uri())
-    unknown_units = set(('unitless', 'NA'))
     for measure in measures:
         obj_attr = []
         struct_uri = fs[measure['structure']]
@@ -189,21 +198,21 @@ def parse_stats(fs_stat_file, entity_uri):
                                    nidm['units'].rdf_representation(),
                                    rdflib.Literal(measure['units'])))
             obj_attr.append((nidm["AnatomicalAnnotation"], struct_uri))
-            if str(measure['units']) in unknown_units:
-                valref = prov.Literal(int(measure['value']), prov.XSD['integer'])
+            # values are already typed by fs_stats.read_stats
+            if isinstance(measure['value'], (int, long)):
+                valref = prov.Literal(measure['value'], prov.XSD['integer'])
             else:
-                valref= prov.Literal(float(measure['value']), prov.XSD['float'])
+                valref= prov.Literal(measure['value'], prov.XSD['float'])
             obj_attr.append((fs[measure_name], valref))
         elif measure['source'] == 'Table':
             obj_attr.append((nidm["AnatomicalAnnotation"], struct_uri))
             for column_info in measure['items']:
                 measure_name = column_info['name']
-                if column_info['units'] in unknown_units and \
-                   '.' not in column_info['value']:
-                    valref = prov.Literal(int(column_info['value']),
+                if isinstance(column_info['value'], (int, long)):
+                    valref = prov.Literal(column_info['value'],
                                           prov.XSD['integer'])
                 else:
-                    valref= prov.Literal(float(column_info['value']),
+                    valref= prov.Literal(column_info['value'],
                                          prov.XSD['float'])
                 obj_attr.append((fs[measure_name], valref))
                 if measure_name not in measure_list:
@@ -231,18 +240,90 @@ def parse_stats(fs_stat_file, entity_uri):
     g.wasGeneratedBy(stat_collection, a0)
     return g, measure_graph
 
-def job(row):
-    entity, relpath, md5sum, urlget = row[0], row[1], row[2], row[3]
-    r = requests.get(urlget).json()
-    if str(md5sum) == str(r['md5sum']):
-        filename = mktemp()
-        urllib.urlretrieve(r['uri'], filename)
-        stats_graph, measure_graph = parse_stats(filename, entity)
-        os.unlink(filename)
-        return stats_graph, measure_graph
-    return None
+def file_session(pool_size=10):
+    """Return a requests session keeping up to pool_size connections to
+    the file server
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class TransferError(IOError):
+    """A download does not match the md5 reported by the file server
+    """
+
+def fetch_stats(row, session=requests):
+    """Download the stats file of an (entity, relpath, md5, url) row of
+    get_urls into memory
+
+    The body is hashed as it arrives and a TransferError is raised if it
+    does not match the md5 reported by the file server. Returns the
+    contents, or None if that md5 differs from the one of the row (the
+    file changed since it was encoded).
+    """
+    md5sum, urlget = row[2], row[3]
+    with profiling.stage('download'):
+        response = session.get(urlget)
+        response.raise_for_status()
+        info = response.json()
+    if str(md5sum) != str(info['md5sum']):
+        return None
+    digest = hashlib.md5()
+    chunks = []
+    with profiling.stage('download'):
+        response = session.get(info['uri'], stream=True)
+        response.raise_for_status()
+        for chunk in response.iter_content(65536):
+            digest.update(chunk)
+            chunks.append(chunk)
+    data = ''.join(chunks)
+    if digest.hexdigest() != str(info['md5sum']):
+        raise TransferError('md5 of %s is %s after %d bytes, expected %s' %
+                            (info['uri'], digest.hexdigest(), len(data),
+                             info['md5sum']))
+    profiling.count('download', files=1, bytes_read=len(data))
+    return data
+
+def convert_stats(entity, data):
+    """Return the stats_triples records and measure terms of the contents
+    of a stats file
+    """
+    profiling.count('stats', files=1)
+    with profiling.stage('stats'):
+        return stats_triples(StringIO(data), entity, stats_terms)
+
+def job(row, session=requests):
+    data = fetch_stats(row, session=session)
+    if data is None:
+        return None
+    return convert_stats(row[0], data)
+
+def _convert_job(args):
+    """Convert the contents of a stats file (in a worker process)
+
+    Returns the entity, the N-Triples lines of each record, the measure
+    terms, the profiling stages of the worker (if `profile`) and an error
+    message (or None).
+    """
+    entity, data, profile = args
+    if profile:
+        profiling.enable()
+    try:
+        records, terms = convert_stats(entity, data)
+        groups = [ntriples(triples) for _, triples in records]
+        error = None
+    except Exception, e:
+        groups, terms = [], []
+        error = '%s: %s' % (e.__class__.__name__, e)
+    return (entity, groups, terms, profiling.pop_report() if profile else None,
+            error)
 
 def upload_graph(graph, endpoint=None, uri='http://test.nidm.org'):
+    """Upload a PROV bundle, or the (identifier, triples) records of
+    stats_triples, in INSERT IN GRAPH requests
+    """
     import requests
     from requests.auth import HTTPDigestAuth
 
@@ -254,32 +335,311 @@ def upload_graph(graph, endpoint=None, uri='http://test.nidm.org'):
     session = requests.Session()
     session.headers = {'Accept': 'text/html'}  # HTML from SELECT queries
 
-    counter = 0
     max_stmts = 1000
-    stmts = graph.rdf().serialize(format='nt').splitlines()
-    N = len(stmts)
-    while (counter < N):
-        endcounter = min(N, counter + max_stmts)
+    N = 0
+    if isinstance(graph, prov.ProvBundle):
+        groups = iter_record_ntriples(graph)
+    else:
+        groups = (ntriples(triples) for _, triples in graph)
+    for stmts in profiling.timed('rdf', batch_ntriples(
+            groups, max_stmts=max_stmts), 'batches'):
         query = """
         INSERT IN GRAPH <%s>
         {
         %s
         }
-        """ % (uri, '\n'.join(stmts[counter:endcounter]))
+        """ % (uri, '\n'.join(stmts))
         data = {'query': query}
-        result = session.post(endpoint, data=data)
+        with profiling.stage('upload'):
+            result = session.post(endpoint, data=data)
+        profiling.count('upload', requests=1, triples=len(stmts))
         print(result)
-        counter = endcounter
+        N += len(stmts)
     print('Submitted %d statemnts' % N)
 
-def process_collection(endpoint, collection, graph_iri, ignore_filter=False):
-    results = get_urls(endpoint, collection, ignore_filter=ignore_filter)
-    for row in results:
-        g, mg = job(row)
-        if os.path.exists('fsterms.ttl'):
-            mg.parse('fsterms.ttl', format='turtle')
-        mg.serialize('fsterms.ttl', format='turtle')
-        upload_graph(g, endpoint=endpoint, uri=graph_iri)
+def process_collection(endpoint, collection, graph_iri, ignore_filter=False,
+                       page_size=1000, cache=None, journal=None, **kwargs):
+    """Encode and upload all stats files of a collection
+
+    The files are queried page_size at a time; the other arguments are
+    those of convert_rows. The collection is marked done in the journal
+    (if any) once all its files are.
+
+    Returns counts of the files converted, failed and skipped (md5
+    mismatch), and the upload statistics.
+    """
+    rows = get_urls(endpoint, collection, page_size=page_size,
+                    ignore_filter=ignore_filter, cache=cache)
+    counts = convert_rows(endpoint, rows, graph_iri, name=collection,
+                          ignore_filter=ignore_filter, cache=cache,
+                          journal=journal, **kwargs)
+    if journal is not None and not (counts['failed'] or counts['claimed']):
+        journal.mark_done('collection', unicode(collection))
+    return counts
+
+def process_collections(endpoint, collections, graph_iri, values_size=50,
+                        ignore_filter=False, page_size=1000, registry=None,
+                        cache=None, journal=None, **kwargs):
+    """Encode and upload the stats files of many collections
+
+    The files of values_size collections at a time are queried together
+    (get_batch_urls) and go through one convert_rows pipeline, whose
+    other arguments are those of convert_rows. Collections done in the
+    journal (if any) are skipped, and marked done once all their files are.
+
+    Returns the summed counts of the files converted, failed and skipped,
+    and the number of collections.
+    """
+    flush_registry = registry is None
+    if flush_registry:
+        registry = MeasureRegistry()
+    totals = {'collections': 0, 'files': 0, 'failed': 0, 'skipped': 0,
+              'resumed': 0, 'claimed': 0}
+    if journal is not None:
+        collections = (collection for collection in collections
+                       if not journal.is_done('collection',
+                                              unicode(collection)))
+    for batch in batches(collections, values_size):
+        rows = get_batch_urls(endpoint, batch, page_size=page_size,
+                              ignore_filter=ignore_filter, cache=cache)
+        counts = convert_rows(endpoint, rows, graph_iri,
+                              name='%d collections' % len(batch),
+                              ignore_filter=ignore_filter, registry=registry,
+                              cache=cache, journal=journal, **kwargs)
+        totals['collections'] += len(batch)
+        for name in ('files', 'failed', 'skipped', 'resumed', 'claimed'):
+            totals[name] += counts[name]
+        if journal is not None and not (counts['failed'] or
+                                        counts['claimed']):
+            for collection in batch:
+                journal.mark_done('collection', unicode(collection))
+    if flush_registry:
+        registry.flush()
+    return totals
+
+def convert_rows(endpoint, rows, graph_iri, name='', ignore_filter=False,
+                 registry=None, n_downloads=4, n_parsers=2, max_in_flight=4,
+                 max_stmts=1000, queue_size=64, pool=None, session=None,
+                 cache=None, journal=None):
+    """Encode and upload the stats files of the (entity, relpath, md5,
+    url, ...) rows of get_urls or get_batch_urls
+
+    Measure definitions are collected in `registry` (default: merged into
+    fsterms.ttl once the rows have been processed). Unless ignore_filter,
+    the rows come from a query filtering out converted files, and are read
+    before the uploads start.
+
+    The files go through a pipeline of stages connected by queues of
+    queue_size items: n_downloads threads fetch them over a pooled session,
+    n_parsers processes (a multiprocessing Pool, which can be passed in as
+    `pool` to reuse it across collections; 0 converts in this process)
+    convert them with stats_triples, and a SparqlUploader merges their
+    records into INSERT DATA requests of about max_stmts statements, with
+    up to max_in_flight requests running. A stage that falls behind blocks
+    the previous ones once its queue is full. The results of `cache` that
+    may depend on graph_iri are invalidated once uploads have been sent.
+
+    With a ProgressJournal, a file is claimed before it is downloaded and
+    marked done once all its records are stored, so a restarted run (or
+    another worker sharing the journal) skips it.
+
+    If the upload fails, the downloads stop, the files already in the
+    pipeline (including conversions pending in `pool`) are drained and their
+    claims released before the error is raised, so a shared pool is left
+    idle.
+
+    Returns counts of the files converted, failed, skipped (md5
+    mismatch), done in the journal (resumed) or claimed by another
+    worker, and the upload statistics.
+    """
+    flush_registry = registry is None
+    if flush_registry:
+        registry = MeasureRegistry()
+    own_pool = pool is None and n_parsers > 0
+    if own_pool:
+        from multiprocessing import Pool
+        pool = Pool(n_parsers)
+    if session is None:
+        session = file_session(pool_size=n_downloads)
+    if not ignore_filter:
+        # the uploads add the prov:wasDerivedFrom statements the query
+        # filters on, which would shift the offsets of the next pages
+        rows = list(rows)
+    rows = iter(rows)
+    rows_lock = threading.Lock()
+    fetched = Queue(maxsize=queue_size)
+    converted = Queue(maxsize=queue_size)
+    counts = {'files': 0, 'failed': 0, 'skipped': 0, 'resumed': 0,
+              'claimed': 0}
+    counts_lock = threading.Lock()
+    # set when the upload failed: the stages drop what they receive
+    stop = threading.Event()
+    # set once the end of the converted queue was read
+    finished = threading.Event()
+
+    def add_count(name):
+        with counts_lock:
+            counts[name] += 1
+
+    def release(entity):
+        if journal is not None:
+            journal.release('file', unicode(entity))
+
+    def download():
+        try:
+            while not stop.is_set():
+                with rows_lock:
+                    row = next(rows, None)
+                if row is None:
+                    return
+                if journal is not None:
+                    key = unicode(row[0])
+                    if journal.is_done('file', key):
+                        add_count('resumed')
+                        continue
+                    if not journal.claim('file', key):
+                        add_count('resumed' if journal.is_done('file', key)
+                                  else 'claimed')
+                        continue
+                try:
+                    data = fetch_stats(row, session=session)
+                except Exception, e:
+                    print('Failed to download %s: %s' % (row[3], e))
+                    add_count('failed')
+                    release(row[0])
+                    continue
+                if data is None:
+                    print('md5 mismatch, skipped %s' % row[3])
+                    add_count('skipped')
+                    release(row[0])
+                    continue
+                fetched.put((row[0], data, profiling.enabled()))
+        finally:
+            fetched.put(None)
+
+    def dispatch():
+        # at most queue_size files are converted or waiting for the
+        # upload at a time
+        slots = threading.Semaphore(queue_size)
+
+        def done(result):
+            if stop.is_set():
+                release(result[0])
+            else:
+                converted.put(result)
+            slots.release()
+        n_done = 0
+        while n_done < n_downloads:
+            item = fetched.get()
+            if item is None:
+                n_done += 1
+                continue
+            if stop.is_set():
+                release(item[0])
+                continue
+            if pool is None:
+                converted.put(_convert_job(item[:2] + (False,)))
+                continue
+            slots.acquire()
+            pool.apply_async(_convert_job, (item,), callback=done)
+        for _ in range(queue_size):
+            slots.acquire()
+        converted.put(None)
+
+    namespaces = [('fs', stats_terms['fs']), ('nidm', stats_terms['nidm'])]
+    # entity of each group index not stored yet, and number of groups of
+    # each entity not stored yet
+    owners = {}
+    pending = {}
+    pending_lock = threading.Lock()
+
+    def groups():
+        n_groups = 0
+        while True:
+            result = converted.get()
+            if result is None:
+                finished.set()
+                return
+            entity, lines, terms, stages, error = result
+            profiling.merge(stages)
+            if error is not None:
+                print('Failed to convert %s: %s' % (entity, error))
+                add_count('failed')
+                release(entity)
+                continue
+            add_count('files')
+            registry.add_triples(terms, namespaces=namespaces)
+            if journal is not None and not lines:
+                journal.mark_done('file', unicode(entity))
+            elif journal is not None:
+                with pending_lock:
+                    pending[entity] = len(lines)
+                    for idx in range(n_groups, n_groups + len(lines)):
+                        owners[idx] = entity
+            n_groups += len(lines)
+            for group in lines:
+                yield group
+
+    def uploaded(start, end):
+        done = []
+        with pending_lock:
+            for idx in range(start, end):
+                entity = owners.pop(idx)
+                pending[entity] -= 1
+                if not pending[entity]:
+                    del pending[entity]
+                    done.append(entity)
+        for entity in done:
+            journal.mark_done('file', unicode(entity))
+
+    threads = [threading.Thread(target=download) for _ in range(n_downloads)]
+    threads.append(threading.Thread(target=dispatch))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    uploader = SparqlUploader(endpoint, graph_iri, batch_size=max_stmts,
+                              max_in_flight=max_in_flight)
+    try:
+        with profiling.stage('upload'):
+            uploader.upload(groups(), on_uploaded=(
+                uploaded if journal is not None else None))
+    except:
+        stop.set()
+        # unblock the stages waiting on a full queue and wait for the
+        # conversions still running in the pool
+        while not finished.is_set():
+            result = converted.get()
+            if result is None:
+                break
+            release(result[0])
+        for thread in threads:
+            thread.join()
+        with pending_lock:
+            for entity in pending:
+                release(entity)
+        raise
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+        if cache is not None and uploader.n_requests:
+            cache.invalidate(endpoint, graph_iri)
+    for thread in threads:
+        thread.join()
+    stats = uploader.stats()
+    profiling.count('upload', triples=stats['statements'],
+                    requests=stats['requests'], retries=stats['retries'])
+    print('%s: %d files, %d failed, %d skipped, %d statements in %d '
+          'requests' % (name, counts['files'], counts['failed'],
+                        counts['skipped'], stats['statements'],
+                        stats['requests']))
+    if counts['resumed'] or counts['claimed']:
+        print('%s: %d files done in the journal, %d claimed by other '
+              'workers' % (name, counts['resumed'], counts['claimed']))
+    if flush_registry:
+        registry.flush()
+    counts['upload'] = stats
+    return counts
 
 if __name__ == "__main__":
     import argparse
@@ -292,13 +652,99 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output_dir', type=str,
                         help='Output directory')
     parser.add_argument('-c', '--collection', type=str,
-                        help='Identifier for collection')
+                        help=('Identifier for collection (default: every '
+                              'subject directory collection)'))
+    parser.add_argument('-l', '--collection_list', type=str,
+                        help=('File listing the collections to convert, '
+                              'one per line (instead of querying them)'))
+    parser.add_argument('--values_size', dest="values_size", type=int,
+                        default=50,
+                        help=('Number of collections whose stats files are '
+                              'queried together'))
+    parser.add_argument('--page_size', dest="page_size", type=int,
+                        default=1000,
+                        help='Number of query results requested at a time')
+    parser.add_argument('--query_cache', dest="query_cache", type=str,
+                        help=('sqlite file caching the results of the SELECT '
+                              'queries across runs'))
+    parser.add_argument('--query_cache_ttl', dest="query_cache_ttl",
+                        type=float, default=3600.,
+                        help='Seconds a cached query result is used for')
+    parser.add_argument('--journal', dest="journal", type=str,
+                        help=('Progress journal recording the files and '
+                              'collections done, to resume an interrupted '
+                              'run (can be shared by parallel runs)'))
+    parser.add_argument('--n_downloads', dest="n_downloads", type=int,
+                        default=4,
+                        help='Number of concurrent file downloads')
+    parser.add_argument('-j', '--n_parsers', dest="n_parsers", type=int,
+                        default=2,
+                        help=('Number of processes converting stats files '
+                              '(0: convert in the main process)'))
+    parser.add_argument('-n', '--num_statements', dest="max_stmts", type=int,
+                        default=1000,
+                        help=('Initial number of statements per upload '
+                              'request (records of many files are merged)'))
+    parser.add_argument('--max_in_flight', dest="max_in_flight", type=int,
+                        default=4,
+                        help='Maximum number of concurrent upload requests')
+    parser.add_argument('--queue_size', dest="queue_size", type=int,
+                        default=64,
+                        help=('Files buffered between two stages before the '
+                              'previous stage waits'))
+    parser.add_argument('--profile', dest="profile", type=str,
+                        help=('Write the time and counters of each stage to '
+                              'this JSON file'))
+    parser.add_argument('--cprofile', dest="cprofile", action="store_true",
+                        help=('With --profile, also write a cProfile dump '
+                              'of the run to <profile>.prof'))
 
     args = parser.parse_args()
     if args.output_dir is None:
         args.output_dir = os.getcwd()
+    if args.profile:
+        profiling.enable(cprofile=args.cprofile)
 
-    #process_collection(args.endpoint, args.collection, args.graph_iri)
+    journal = None
+    if args.journal:
+        journal = ProgressJournal(args.journal)
+    cache = None
+    if args.query_cache:
+        cache = QueryCache(args.query_cache, ttl=args.query_cache_ttl)
+    if args.collection:
+        collections = [args.collection]
+    elif args.collection_list:
+        with open(args.collection_list, 'rt') as fp:
+            collections = [line.strip() for line in fp if line.strip()]
+    else:
+        collections = (row[0] for row in get_collections(
+            args.endpoint, page_size=args.page_size, cache=cache))
+    pool = None
+    if args.n_parsers > 0:
+        from multiprocessing import Pool
+        pool = Pool(args.n_parsers)
+    registry = MeasureRegistry()
+    session = file_session(pool_size=args.n_downloads)
+    process_collections(args.endpoint, collections, args.graph_iri,
+                        values_size=args.values_size, registry=registry,
+                        page_size=args.page_size,
+                        n_downloads=args.n_downloads,
+                        n_parsers=args.n_parsers,
+                        max_in_flight=args.max_in_flight,
+                        max_stmts=args.max_stmts,
+                        queue_size=args.queue_size, pool=pool,
+                        session=session, cache=cache, journal=journal)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    registry.flush()
+    if cache is not None:
+        stats = cache.stats()
+        print('Query cache: %d hits, %d misses (%.0f%%)' % (
+            stats['hits'], stats['misses'], 100 * stats['hit_rate']))
+        cache.close()
     #graph = to_graph(args.subject_dir, args.project_id, args.output_dir,
     #                 args.hostname)
     #upload_graph(graph, endpoint=args.endpoint, uri=args.graph_iri)
+    if args.profile:
+        profiling.print_report(profiling.write_report(args.profile))
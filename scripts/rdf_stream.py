@@ -0,0 +1,226 @@
+"""Stream a PROV bundle as batches of N-Triples lines
+
+Calling ``bundle.rdf().serialize(format='nt').splitlines()`` holds the full
+rdflib graph, the serialized document and the list of its lines in memory at
+once before anything can be uploaded. The generators here convert one record
+at a time instead, so memory stays bounded by the batch size.
+
+RecordWriter goes one step further for the output files: each chunk of
+records is written to .provn and .ttl files, and flush() then returns a fresh
+bundle, with the namespaces seen so far, for the records that follow. The
+.ttl file holds the N-Triples lines of each record, one record per paragraph,
+so it can be uploaded (iter_ttl_groups) without converting the records a
+second time.
+"""
+
+import os
+import shutil
+
+import prov.model as prov
+import rdflib
+
+
+def nt_term(term):
+    """Return the N-Triples form of an rdflib term
+
+    Literals are written on one line with \\, ", \\n and \\r escaped
+    (Literal.n3() writes multi-line values in triple quotes).
+    """
+    if not isinstance(term, rdflib.Literal):
+        return term.n3()
+    text = u'"%s"' % (term.replace('\\', '\\\\').replace('\n', '\\n')
+                      .replace('"', '\\"').replace('\r', '\\r'))
+    if term.language:
+        return u'%s@%s' % (text, term.language)
+    if term.datatype:
+        return u'%s^^<%s>' % (text, term.datatype)
+    return text
+
+
+def _escape_char(char):
+    code = ord(char)
+    if code < 128:
+        return char
+    return (u'\\u%04X' if code <= 0xFFFF else u'\\U%08X') % code
+
+
+def ntriple(triple):
+    """Return the N-Triples line of an rdflib triple (an ASCII str, with
+    other characters escaped as \\uXXXX or \\UXXXXXXXX)
+    """
+    line = u'%s %s %s .' % tuple(nt_term(term) for term in triple)
+    try:
+        return line.encode('ascii')
+    except UnicodeEncodeError:
+        return ''.join(_escape_char(char) for char in line).encode('ascii')
+
+
+def record_ntriples(record):
+    """Return the N-Triples lines of a single PROV record
+    """
+    return [ntriple(triple) for triple in record.rdf(rdflib.Graph())]
+
+
+def iter_record_ntriples(bundle):
+    """Yield the N-Triples lines of each asserted record of a bundle as a list
+    """
+    for record in bundle.get_records():
+        if not record.is_asserted():
+            continue
+        lines = record_ntriples(record)
+        if lines:
+            yield lines
+
+
+def iter_ntriples(bundle):
+    """Yield the N-Triples lines of all asserted records of a bundle
+    """
+    for lines in iter_record_ntriples(bundle):
+        for line in lines:
+            yield line
+
+
+def iter_ntriples_batches(bundle, max_stmts=100):
+    """Yield lists of at most `max_stmts` N-Triples lines from a bundle
+
+    The lines of one record are never split across batches, because blank
+    nodes of qualified relations only match within the same INSERT DATA
+    request. A single record larger than `max_stmts` is yielded on its own.
+    """
+    return batch_ntriples(iter_record_ntriples(bundle), max_stmts=max_stmts)
+
+
+def batch_ntriples(groups, max_stmts=100):
+    """Yield lists of at most `max_stmts` lines from lists of N-Triples
+    lines, without splitting a list (see iter_ntriples_batches)
+    """
+    batch = []
+    for lines in groups:
+        if batch and len(batch) + len(lines) > max_stmts:
+            yield batch
+            batch = []
+        batch.extend(lines)
+    if batch:
+        yield batch
+
+
+class RecordWriter(object):
+    """Write the records of a bundle to .provn and .ttl files incrementally
+
+    bundle: ProvBundle the first records are added to
+    provn_file, ttl_file: output files (either can be None)
+
+    Each flush writes the asserted records of the current bundle and
+    replaces it by a new, empty bundle with the same namespaces (returned by
+    flush and kept in self.bundle), so memory does not grow with the number
+    of records. Relations added later to flushed records still work, since
+    they hold the records themselves. PROV-N records are spooled
+    to <provn_file>.part and the file is assembled on close, once every
+    namespace the records use is known. The .ttl file starts with the
+    prefixes of the bundle followed by N-Triples, which is valid Turtle.
+    """
+
+    def __init__(self, bundle, provn_file=None, ttl_file=None):
+        self.bundle = bundle
+        self.provn_file = provn_file
+        self.ttl_file = ttl_file
+        self.n_records = 0
+        self.n_triples = 0
+        self._provn = None
+        self._ttl = None
+        self._namespaces = []
+        self._add_namespaces(bundle)
+        if provn_file is not None:
+            self._provn = open(provn_file + '.part', 'wt')
+        if ttl_file is not None:
+            self._ttl = open(ttl_file, 'wt')
+            for namespace in bundle.get_registered_namespaces():
+                self._ttl.write('@prefix %s: <%s> .\n' % (
+                    namespace.get_prefix(), namespace.get_uri()))
+
+    def write_group(self, lines):
+        """Write a list of N-Triples lines as one .ttl paragraph
+        """
+        if self._ttl is not None and lines:
+            self._ttl.write('\n')
+            self._ttl.write('\n'.join(lines))
+            self._ttl.write('\n')
+            self.n_triples += len(lines)
+
+    def _add_namespaces(self, bundle):
+        for namespace in bundle.get_registered_namespaces():
+            if namespace not in self._namespaces:
+                self._namespaces.append(namespace)
+
+    def flush(self):
+        """Write the records of the current bundle and start a new one
+
+        Returns the new bundle, to which the following records are added.
+        """
+        bundle = self.bundle
+        for record in bundle.get_records():
+            if not record.is_asserted():
+                continue
+            if self._provn is not None:
+                self._provn.write('\n  ')
+                self._provn.write(record.get_provn(1).encode('utf-8'))
+            self.write_group(record_ntriples(record))
+            self.n_records += 1
+        # records may have registered namespaces of their own
+        self._add_namespaces(bundle)
+        self.bundle = prov.ProvBundle()
+        for namespace in self._namespaces:
+            self.bundle.add_namespace(namespace)
+        return self.bundle
+
+    def close(self):
+        self.flush()
+        if self._ttl is not None:
+            self._ttl.close()
+        if self._provn is not None:
+            self._provn.close()
+            with open(self.provn_file, 'wt') as fp:
+                fp.write('document')
+                for namespace in self._namespaces:
+                    fp.write('\n  prefix %s <%s>' % (namespace.get_prefix(),
+                                                     namespace.get_uri()))
+                fp.write('\n  ')
+                with open(self.provn_file + '.part', 'rt') as part:
+                    shutil.copyfileobj(part, fp)
+                fp.write('\nendDocument')
+            os.unlink(self.provn_file + '.part')
+
+
+def write_ttl_groups(groups, filename):
+    """Write lists of N-Triples lines as the paragraphs of a file that
+    iter_ttl_groups reads back as the same lists
+
+    Returns the number of lines written.
+    """
+    n_lines = 0
+    with open(filename, 'wt') as fp:
+        for lines in groups:
+            if lines:
+                fp.write('\n')
+                fp.write('\n'.join(lines))
+                fp.write('\n')
+                n_lines += len(lines)
+    return n_lines
+
+
+def iter_ttl_groups(filename):
+    """Yield the N-Triples lines of each paragraph of a RecordWriter .ttl
+    file as a list
+    """
+    lines = []
+    with open(filename, 'rt') as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                if lines:
+                    yield lines
+                lines = []
+            elif not line.startswith('@prefix'):
+                lines.append(line)
+    if lines:
+        yield lines
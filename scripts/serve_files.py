@@ -10,8 +10,15 @@ from urlparse import urlparse
 import cherrypy
 from nipype.utils.filemanip import hash_infile
 
+from hash_cache import HashCache
+
 FILE_DIR = os.path.join(os.getcwd(), 'files')
 
+# digest cache shared with fs_upload_to_triplesore.py --hash_cache
+HASH_CACHE = None
+if os.environ.get('NIDM_HASH_CACHE'):
+    HASH_CACHE = HashCache(os.environ['NIDM_HASH_CACHE'])
+
 class FileServer(object):
 
     @cherrypy.expose
@@ -27,7 +34,10 @@ class FileServer(object):
         if not os.path.exists(fullpath) or \
             not fullpath.startswith('/mindhive/xnat/surfaces/adhd200'):
             raise cherrypy.HTTPError("403 Forbidden", "You are not allowed to access this resource.")
-        file_hash = hash_infile(fullpath)
+        if HASH_CACHE is not None:
+            file_hash = HASH_CACHE.hash_file(fullpath, ('md5',))['md5']
+        else:
+            file_hash = hash_infile(fullpath)
         object_hash = md5.md5(file_uri + file_hash).hexdigest()
         link_path = os.path.join(FILE_DIR, object_hash)
         if not os.path.exists(link_path):
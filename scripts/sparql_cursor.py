@@ -0,0 +1,189 @@
+"""Paged SPARQL SELECT results
+
+A SELECT with a fixed LIMIT silently drops the rows past the limit, and
+rdflib's SPARQLStore parses the whole result set before the first row can
+be used. SparqlCursor runs a query page by page instead: the query is
+ordered (ORDER BY) so that pages do not overlap or skip rows, each page is
+requested with LIMIT/OFFSET and the rows are yielded as they are consumed.
+The next page is requested in a background thread while the rows of the
+current one are processed. Rows are tuples of rdflib terms in the order of
+the projected variables (None for unbound ones), like the rows of rdflib
+query results.
+
+With a query cache, the full ordered result is cached under the query
+without LIMIT/OFFSET once every page was fetched, so the rows of a pass
+never mix pages of different snapshots of the store.
+"""
+
+import json
+import re
+import threading
+import time
+
+import rdflib
+import requests
+
+import profiling
+
+select_re = re.compile(r'\bselect\s+(?:distinct\s+|reduced\s+)?(.*?)\s*'
+                       r'(?:where|\{)', re.IGNORECASE | re.DOTALL)
+variable_re = re.compile(r'[?$](\w+)')
+
+
+def query_variables(query):
+    """Return the names of the variables projected by a SELECT query
+    """
+    match = select_re.search(query)
+    if match is None or '*' in match.group(1):
+        raise ValueError('Cannot page a query without explicit variables')
+    return variable_re.findall(match.group(1))
+
+
+def ordered_query(query, order_by):
+    """Return a query with an ORDER BY clause appended
+    """
+    return '%s\nORDER BY %s\n' % (
+        query.rstrip(), ' '.join('?%s' % name for name in order_by))
+
+
+def paged_query(query, order_by, limit, offset):
+    """Return a query with ORDER BY, LIMIT and OFFSET clauses appended
+    """
+    return '%sLIMIT %d OFFSET %d\n' % (ordered_query(query, order_by), limit,
+                                       offset)
+
+
+def parse_term(binding):
+    """Return the rdflib term of a SPARQL JSON results binding
+    """
+    if binding is None:
+        return None
+    kind = binding['type']
+    if kind == 'uri':
+        return rdflib.URIRef(binding['value'])
+    if kind == 'bnode':
+        return rdflib.BNode(binding['value'])
+    return rdflib.Literal(binding['value'], lang=binding.get('xml:lang'),
+                          datatype=binding.get('datatype'))
+
+
+class SparqlCursor(object):
+    """Iterate over the rows of a SELECT query, one page at a time
+
+    endpoint: SPARQL query URL
+    query: SELECT query without ORDER BY/LIMIT/OFFSET
+    order_by: variables ordering the results (default: all projected
+        variables, which gives a stable order for distinct rows)
+    page_size: rows per request
+    prefetch: request the next page while the current one is consumed
+    cache: a query_cache.QueryCache the full ordered result is looked up
+        in first, and stored in once all pages were fetched
+    """
+
+    def __init__(self, endpoint, query, order_by=None, page_size=1000,
+                 prefetch=True, max_tries=5, backoff_base=0.5, timeout=300.,
+                 session=None, cache=None):
+        self.endpoint = endpoint
+        self.query = query
+        self.variables = query_variables(query)
+        self.order_by = order_by or self.variables
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.max_tries = max_tries
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.cache = cache
+        self.n_requests = 0
+        self.n_rows = 0
+
+    def __iter__(self):
+        query = ordered_query(self.query, self.order_by)
+        result = None
+        if self.cache is not None:
+            rows = self.cache.lookup(self.endpoint, query)
+            if rows is not None:
+                self.n_rows += len(rows)
+                for row in rows:
+                    yield row
+                return
+            result = []
+        offset = 0
+        page = self._fetch(offset)
+        while True:
+            following = None
+            if len(page) == self.page_size:
+                following = _Prefetch(self._fetch, offset + self.page_size,
+                                      self.prefetch)
+            if result is not None:
+                result.extend(page)
+                if following is None:
+                    self.cache.store(self.endpoint, query, result)
+            for row in page:
+                yield row
+            if following is None:
+                return
+            offset += self.page_size
+            page = following.get()
+
+    def _fetch(self, offset):
+        """Return the rows of the page starting at offset
+        """
+        query = paged_query(self.query, self.order_by, self.page_size,
+                            offset)
+        data = {'query': query}
+        headers = {'Accept': 'application/sparql-results+json'}
+        for n_try in range(self.max_tries):
+            if n_try:
+                time.sleep(self.backoff_base * 2 ** (n_try - 1))
+            try:
+                with profiling.stage('query'):
+                    response = self.session.post(self.endpoint, data=data,
+                                                 headers=headers,
+                                                 timeout=self.timeout)
+                self.n_requests += 1
+                profiling.count('query', requests=1)
+                if response.status_code < 500:
+                    break
+            except requests.RequestException:
+                if n_try == self.max_tries - 1:
+                    raise
+        response.raise_for_status()
+        results = json.loads(response.content)
+        rows = [tuple(parse_term(binding.get(name))
+                      for name in self.variables)
+                for binding in results['results']['bindings']]
+        self.n_rows += len(rows)
+        profiling.count('query', rows=len(rows))
+        return rows
+
+
+class _Prefetch(object):
+    """Call fetch(offset) in a background thread (or on get() if not
+    prefetching)
+    """
+
+    def __init__(self, fetch, offset, background=True):
+        self.fetch = fetch
+        self.offset = offset
+        self.rows = None
+        self.error = None
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        try:
+            self.rows = self.fetch(self.offset)
+        except Exception, e:
+            self.error = e
+
+    def get(self):
+        if self.thread is None:
+            return self.fetch(self.offset)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.rows
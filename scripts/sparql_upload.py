@@ -0,0 +1,299 @@
+"""Concurrent, adaptive upload of N-Triples statements to a SPARQL endpoint
+
+SparqlUploader keeps up to `max_in_flight` INSERT DATA requests running over
+one pooled HTTP session. Failed requests are retried with exponential backoff
+and jitter. The number of statements per request adapts to the endpoint:
+it grows while requests finish faster than `target_latency` and is halved on
+slow responses or errors; batches rejected as too large (413/414) are split.
+With `skip_existing`, an ASK query is sent before each batch and batches the
+graph already contains are not inserted again; this pays off when records
+have content-derived identifiers (see identifiers) and an upload is re-run.
+upload() can also skip the groups of ranges stored by an earlier, interrupted
+run and report the ranges it stores (see progress_journal).
+"""
+
+import json
+from Queue import Queue
+import random
+import threading
+import time
+from urllib import urlencode
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+
+insert_data_template = """
+        INSERT DATA
+        {GRAPH <%(graph)s>
+        {
+        %(data)s
+        }
+        }
+        """
+
+# removes every triple with one of the resources as subject or object, and
+# the blank nodes of their qualified relations
+delete_template = """
+        DELETE { GRAPH <%(graph)s> { ?b ?p ?o } }
+        WHERE { GRAPH <%(graph)s> {
+          VALUES ?r { %(data)s }
+          ?r ?q ?b . ?b ?p ?o . FILTER(isBlank(?b)) } } ;
+        DELETE { GRAPH <%(graph)s> { ?r ?p ?o } }
+        WHERE { GRAPH <%(graph)s> { VALUES ?r { %(data)s } ?r ?p ?o } } ;
+        DELETE { GRAPH <%(graph)s> { ?s ?p ?r } }
+        WHERE { GRAPH <%(graph)s> { VALUES ?r { %(data)s } ?s ?p ?r } }
+        """
+
+# blank nodes in the pattern match any node, so batches of qualified
+# relations are found as well
+ask_template = """
+        ASK WHERE
+        {GRAPH <%(graph)s>
+        {
+        %(data)s
+        }
+        }
+        """
+
+payload_errors = (413, 414)
+
+
+class SparqlUploader(object):
+    """Upload groups of N-Triples lines to a SPARQL endpoint
+
+    endpoint: SPARQL update URL
+    graph_iri: named graph to insert into
+    batch_size: initial number of statements per request
+    min_batch, max_batch: bounds of the adaptive batch size
+    max_in_flight: number of concurrent requests
+    target_latency: seconds per request the batch size is tuned towards
+    compress: gzip the request body (Content-Encoding: gzip)
+    max_tries: attempts per batch before giving up
+    template: update request with %(graph)s and %(data)s placeholders
+    skip_existing: do not insert batches already in the graph (one ASK
+        query per batch)
+    """
+
+    def __init__(self, endpoint, graph_iri, batch_size=100, min_batch=10,
+                 max_batch=10000, max_in_flight=4, target_latency=2.,
+                 compress=False, max_tries=10, backoff_base=0.5,
+                 backoff_max=60., timeout=300., template=insert_data_template,
+                 auth=None, skip_existing=False):
+        self.endpoint = endpoint
+        self.graph_iri = graph_iri
+        self.batch_size = batch_size
+        self.min_batch = min(min_batch, batch_size)
+        self.max_batch = max(max_batch, batch_size)
+        self.max_in_flight = max_in_flight
+        self.target_latency = target_latency
+        self.compress = compress
+        self.max_tries = max_tries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.template = template
+        self.skip_existing = skip_existing
+        self.session = requests.Session()
+        self.session.headers = {'Accept': 'text/html'}
+        if auth is not None:
+            self.session.auth = auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._error = None
+        self.n_statements = 0
+        self.n_requests = 0
+        self.n_retries = 0
+        self.n_skipped = 0
+        self.elapsed = 0.
+
+    def upload(self, groups, done=None, on_uploaded=None):
+        """Upload an iterable of N-Triples line lists
+
+        Lines of one group (e.g., one PROV record) are always sent in the
+        same request. Groups are numbered from 0: those in the sorted
+        [start, end) ranges of `done` are not sent, and
+        on_uploaded(start, end) is called (from a worker thread) once the
+        groups of a range are stored. Returns the number of statements
+        uploaded.
+        """
+        start = time.time()
+        n_start = self.n_statements
+        work = Queue(maxsize=self.max_in_flight)
+        workers = [threading.Thread(target=self._worker, args=(work,))
+                   for _ in range(self.max_in_flight)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            for item in self._batches(groups, done or []):
+                if self._error is not None:
+                    break
+                work.put(item + (on_uploaded,))
+        finally:
+            for _ in workers:
+                work.put(None)
+            for worker in workers:
+                worker.join()
+            self.elapsed += time.time() - start
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        return self.n_statements - n_start
+
+    def delete(self, iris, batch_size=100):
+        """Delete all statements about the given resources from the graph
+
+        Returns the number of resources deleted.
+        """
+        iris = list(iris)
+        for idx in range(0, len(iris), batch_size):
+            self._send([['<%s>' % iri] for iri in iris[idx:idx + batch_size]],
+                       template=delete_template, count=False)
+        return len(iris)
+
+    def stats(self):
+        """Return upload counters and throughput
+        """
+        return {'statements': self.n_statements,
+                'requests': self.n_requests,
+                'retries': self.n_retries,
+                'skipped': self.n_skipped,
+                'seconds': self.elapsed,
+                'statements_per_sec': (self.n_statements / self.elapsed
+                                       if self.elapsed else 0.),
+                'batch_size': self.batch_size}
+
+    def _batches(self, groups, done=()):
+        """Yield (index of the first group, batch) of consecutive groups,
+        leaving out those in the `done` ranges
+        """
+        batch = []
+        first = 0
+        n_stmts = 0
+        done = iter(done)
+        skip = next(done, None)
+        for idx, lines in enumerate(groups):
+            while skip is not None and idx >= skip[1]:
+                skip = next(done, None)
+            if skip is not None and idx >= skip[0]:
+                continue
+            if batch and (n_stmts + len(lines) > self.batch_size or
+                          idx != first + len(batch)):
+                yield first, batch
+                batch = []
+                n_stmts = 0
+            if not batch:
+                first = idx
+            batch.append(lines)
+            n_stmts += len(lines)
+        if batch:
+            yield first, batch
+
+    def _worker(self, work):
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            first, batch, on_uploaded = item
+            try:
+                if self.skip_existing and self._exists(batch):
+                    with self._lock:
+                        self.n_skipped += sum(len(lines) for lines in batch)
+                else:
+                    self._send(batch)
+                if on_uploaded is not None:
+                    on_uploaded(first, first + len(batch))
+            except Exception, e:
+                with self._lock:
+                    if self._error is None:
+                        self._error = e
+
+    def _exists(self, batch):
+        """Return True if every statement of the batch is in the graph
+        """
+        body, headers = self._encode(batch, ask_template)
+        headers['Accept'] = 'application/sparql-results+json'
+        for n_try in range(self.max_tries):
+            if n_try:
+                time.sleep(self._backoff(n_try))
+            try:
+                result = self.session.post(self.endpoint, data=body,
+                                           headers=headers,
+                                           timeout=self.timeout)
+            except requests.RequestException:
+                continue
+            if result.status_code == requests.codes.ok:
+                try:
+                    return bool(json.loads(result.content)['boolean'])
+                except (ValueError, KeyError):
+                    return False
+        # let the insert report the error
+        return False
+
+    def _encode(self, batch, template):
+        data = '\n'.join(line for lines in batch for line in lines)
+        query = template % {'graph': self.graph_iri, 'data': data}
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        body = urlencode({'query': query})
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        if self.compress:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+        return body, headers
+
+    def _send(self, batch, template=None, count=True):
+        n_stmts = sum(len(lines) for lines in batch) if count else 0
+        body, headers = self._encode(batch, template or self.template)
+        status = None
+        for n_try in range(self.max_tries):
+            if n_try:
+                with self._lock:
+                    self.n_retries += 1
+                time.sleep(self._backoff(n_try))
+            t0 = time.time()
+            try:
+                result = self.session.post(self.endpoint, data=body,
+                                           headers=headers,
+                                           timeout=self.timeout)
+                status = result.status_code
+            except requests.RequestException, e:
+                status = e
+                self._adapt(None)
+                continue
+            if status == requests.codes.ok:
+                with self._lock:
+                    self.n_requests += 1
+                    self.n_statements += n_stmts
+                if count:
+                    self._adapt(time.time() - t0)
+                return
+            self._adapt(None)
+            if status in payload_errors and len(batch) > 1:
+                half = len(batch) // 2
+                self._send(batch[:half], template=template, count=count)
+                self._send(batch[half:], template=template, count=count)
+                return
+        raise IOError('Could not upload some statements: %s' % status)
+
+    def _backoff(self, n_try):
+        """Full-jitter exponential backoff
+        """
+        return random.uniform(0, min(self.backoff_max,
+                                     self.backoff_base * 2 ** n_try))
+
+    def _adapt(self, latency):
+        """Grow the batch size on fast responses, halve it on slow or failed
+        """
+        with self._lock:
+            if latency is None or latency > self.target_latency:
+                self.batch_size = max(self.min_batch, self.batch_size // 2)
+            elif latency < self.target_latency / 2:
+                self.batch_size = min(self.max_batch,
+                                      int(self.batch_size * 1.25) + 1)
@@ -0,0 +1,230 @@
+"""Emit the RDF of a FreeSurfer stats collection without prov.model objects
+
+parse_stats in the upload scripts builds a prov entity per structure and a
+prov.Literal per value, and the bundle is converted with .rdf() afterwards.
+The functions here write the same triples straight from the typed columns of
+fs_stats.load_stats: the activity and user agent generating the collection,
+the collection, its header entity, one entity per structure and the
+membership, derivation and generation relations.
+
+The terms used differ between the scripts, so they are passed in a
+vocabulary dict made by stats_vocabulary. Triples are yielded grouped by the
+PROV record they belong to, like rdf_stream.iter_record_ntriples, so that
+blank nodes of qualified relations stay in the same upload request.
+"""
+
+from datetime import datetime as dt
+import os
+import pwd
+
+import prov.model as prov
+import rdflib
+
+from fs_stats import load_stats
+from identifiers import random_id
+from rdf_stream import ntriple
+
+PROV = rdflib.Namespace(prov.PROV.get_uri())
+FOAF = rdflib.Namespace('http://xmlns.com/foaf/0.1/')
+RDF_TYPE = rdflib.RDF['type']
+RDFS_LABEL = rdflib.RDFS['label']
+# prov.Literal values keep the datatype namespace of prov.model
+XSD_INTEGER = rdflib.URIRef(prov.XSD['integer'].get_uri())
+XSD_FLOAT = rdflib.URIRef(prov.XSD['float'].get_uri())
+
+
+def stats_vocabulary(fs, nidm, niiri, collection_type, header_type,
+                     anatomical_annotation, units, header_key=None,
+                     structure_key=None, namespaces=None):
+    """Return the terms used for a stats collection
+
+    fs, nidm, niiri: namespace URIs of measures and structures, of the
+        nidm terms and of the generated identifiers
+    collection_type, header_type: rdf:type of the collection and header
+    anatomical_annotation: predicate linking a structure entity to its name
+    units: predicate of the units of a measure definition
+    header_key, structure_key: functions mapping header tags and structure
+        names to local names in fs (default: unchanged)
+    namespaces: dict of prefix to URI of the bundle the collection belongs
+        to; header values like 'prefix:name' or starting with one of the URIs
+        are written as IRIs, as prov.model does
+    """
+    same = lambda name: name
+    return {'fs': rdflib.Namespace(fs),
+            'nidm': rdflib.Namespace(nidm),
+            'niiri': rdflib.Namespace(niiri),
+            'measure': rdflib.URIRef(fs + 'Measure'),
+            'collection_type': rdflib.URIRef(collection_type),
+            'header_type': rdflib.URIRef(header_type),
+            'anatomical_annotation': rdflib.URIRef(anatomical_annotation),
+            'units': rdflib.URIRef(units),
+            'header_key': header_key or same,
+            'structure_key': structure_key or same,
+            'namespaces': dict(namespaces or {})}
+
+
+def header_value(value, namespaces):
+    """Return the RDF term prov.model makes of a string attribute value
+    """
+    if ':' in value and not value.startswith('_:'):
+        prefix, local_part = value.split(':', 1)
+        if prefix in namespaces:
+            return rdflib.URIRef(namespaces[prefix] + local_part)
+        for uri in namespaces.values():
+            if value.startswith(uri):
+                return rdflib.URIRef(value)
+    return rdflib.Literal(unicode(value))
+
+
+def measure_literal(value):
+    """Return the literal parse_stats writes for a typed measure value
+    """
+    if isinstance(value, (int, long)):
+        return rdflib.Literal(value, datatype=XSD_INTEGER)
+    return rdflib.Literal(value, datatype=XSD_FLOAT)
+
+
+def measure_terms(table, vocabulary):
+    """Return the triples defining the measures of a StatsTable
+    """
+    fs = vocabulary['fs']
+    measures = [(measure['name'], measure['description'], measure['units'])
+                for measure in table.measures]
+    measures.extend((info['ColHeader'], info['FieldName'], info['Units'])
+                    for col_idx, info in sorted(table.tableinfo.items())
+                    if col_idx != table.struct_idx)
+    triples = []
+    seen = set()
+    for name, description, units in measures:
+        if name in seen:
+            continue
+        seen.add(name)
+        measure_uri = fs[name]
+        triples.extend([(measure_uri, RDF_TYPE, vocabulary['measure']),
+                        (measure_uri, RDFS_LABEL, rdflib.Literal(description)),
+                        (measure_uri, vocabulary['units'],
+                         rdflib.Literal(units))])
+    return triples
+
+
+def iter_stats_records(table, entity_uri, vocabulary, make_id=random_id,
+                       username=None, start_time=None, rewrite=None):
+    """Yield (identifier, triples) for each record of a stats collection
+
+    table: StatsTable of the stats file
+    entity_uri: IRI of the file entity the collection is derived from
+    make_id: identifier function (see identifiers); content-derived
+        identifiers are made from the same parts as in parse_stats
+    rewrite: function applied to the header values (see id_map.id_rewriter)
+    identifier is the IRI of element records (None for relations) and
+    triples a list of rdflib triples.
+    """
+    niiri = vocabulary['niiri']
+    get_id = lambda *parts: niiri[make_id(entity_uri, *parts)]
+    if username is None:
+        username = pwd.getpwuid(os.geteuid()).pw_name
+    if start_time is None:
+        start_time = dt.utcnow()
+    fs = vocabulary['fs']
+    anatomical_annotation = vocabulary['anatomical_annotation']
+    structure_key = vocabulary['structure_key']
+    entity_uri = rdflib.URIRef(entity_uri)
+
+    a0 = get_id('activity')
+    yield a0, [(a0, RDF_TYPE, PROV['Activity']),
+               (a0, PROV['startTime'], rdflib.Literal(start_time))]
+    user_agent = niiri[make_id('agent', username)]
+    yield user_agent, [(user_agent, RDF_TYPE, PROV['Agent']),
+                       (user_agent, RDF_TYPE, PROV['Person']),
+                       (user_agent, RDFS_LABEL, rdflib.Literal(username)),
+                       (user_agent, FOAF['name'], rdflib.Literal(username))]
+    association = rdflib.BNode()
+    yield None, [(a0, PROV['wasAssociatedWith'], user_agent),
+                 (a0, PROV['qualifiedAssociation'], association),
+                 (association, RDF_TYPE, PROV['Association']),
+                 (association, PROV['agent'], user_agent),
+                 (association, PROV['Role'], rdflib.Literal(u'LoggedInUser'))]
+    stat_collection = get_id('collection')
+    yield stat_collection, [(stat_collection, RDF_TYPE, PROV['Entity']),
+                            (stat_collection, RDF_TYPE, PROV['Collection']),
+                            (stat_collection, RDF_TYPE,
+                             vocabulary['collection_type'])]
+    # header elements
+    statheader_collection = get_id('header')
+    triples = [(statheader_collection, RDF_TYPE, PROV['Entity']),
+               (statheader_collection, RDF_TYPE, vocabulary['header_type'])]
+    header_key = vocabulary['header_key']
+    namespaces = vocabulary['namespaces']
+    for key, value in table.header.items():
+        if rewrite is not None:
+            value = rewrite(value)
+        triples.append((statheader_collection, fs[header_key(key)],
+                        header_value(value, namespaces)))
+    yield statheader_collection, triples
+
+    # measures; the values of a repeated structure are added to its first
+    # entity while the membership points to a new identifier, as in
+    # parse_stats
+    structures = {}
+    occurrences = {}
+    members = []
+
+    def add_structure(structure, values):
+        local_name = structure_key(structure)
+        struct_uri = fs[local_name]
+        occurrences[struct_uri] = occurrences.get(struct_uri, -1) + 1
+        member = get_id('structure', local_name, occurrences[struct_uri])
+        members.append(member)
+        if struct_uri in structures:
+            structure_triples = structures[struct_uri]
+            subject = structure_triples[0][0]
+        else:
+            subject = member
+            structure_triples = [(subject, RDF_TYPE, PROV['Entity']),
+                                 (subject, anatomical_annotation,
+                                  struct_uri)]
+            structures[struct_uri] = structure_triples
+        structure_triples.extend((subject, predicate, value)
+                                 for predicate, value in values)
+
+    for measure in table.measures:
+        add_structure(measure['structure'],
+                      [(fs[measure['name']], measure_literal(measure['value']))])
+    if len(table):
+        names = [table.tableinfo[col_idx]['ColHeader']
+                 for col_idx in sorted(table.tableinfo)
+                 if col_idx != table.struct_idx]
+        predicates = [fs[name] for name in names]
+        columns = []
+        for name in names:
+            column = table.columns[name]
+            datatype = XSD_INTEGER if column.dtype.kind in 'iu' \
+                else XSD_FLOAT
+            columns.append([rdflib.Literal(value, datatype=datatype)
+                            for value in column.tolist()])
+        for structure, values in zip(table.structures.tolist(),
+                                     zip(*columns)):
+            add_structure(structure, zip(predicates, values))
+    for structure_triples in structures.values():
+        yield structure_triples[0][0], structure_triples
+    for member in members:
+        yield None, [(stat_collection, PROV['hadMember'], member)]
+    yield None, [(stat_collection, PROV['hadMember'], statheader_collection)]
+    yield None, [(stat_collection, PROV['wasDerivedFrom'], entity_uri)]
+    yield None, [(stat_collection, PROV['wasGeneratedBy'], a0)]
+
+
+def stats_triples(fs_stat_file, entity_uri, vocabulary, **kwargs):
+    """Return the record triple groups of a stats file and the triples
+    defining its measures (see iter_stats_records)
+    """
+    table = load_stats(fs_stat_file)
+    return (list(iter_stats_records(table, entity_uri, vocabulary, **kwargs)),
+            measure_terms(table, vocabulary))
+
+
+def ntriples(triples):
+    """Return the N-Triples lines of a list of rdflib triples
+    """
+    return [ntriple(triple) for triple in triples]
+
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""Local stand-in for the serve_files.py file server
+
+Answers GET /file?file_uri=<uri> like FileServer.file: if the path of the
+uri is a file under `root`, the reply is the JSON {"uri": ..., "md5sum": ...}
+with a /files/<hash> link to download the file from; other paths get a 403.
+Runs in-process (start()/stop()) without cherrypy or a files/ link
+directory, so query_convert_fs_stats.job can be exercised and timed
+against local data. Latency can be injected.
+"""
+
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+from hash_cache import hash_file
+
+
+class StubFileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        parsed = urlparse.urlparse(self.path)
+        if server.latency:
+            time.sleep(server.latency)
+        if parsed.path == '/file':
+            params = urlparse.parse_qs(parsed.query)
+            file_uri = (params.get('file_uri') or [''])[0]
+            fullpath = os.path.realpath(urlparse.urlparse(file_uri).path)
+            if not os.path.isfile(fullpath) or \
+                    not fullpath.startswith(server.root):
+                return self._reply(403, 'You are not allowed to access this '
+                                        'resource.')
+            file_hash = hash_file(fullpath)['md5']
+            object_hash = hashlib.md5(file_uri + file_hash).hexdigest()
+            with server.lock:
+                server.n_requests += 1
+                server.links[object_hash] = fullpath
+            return self._reply(200, json.dumps(
+                {'uri': '%s/files/%s' % (server.url, object_hash),
+                 'md5sum': file_hash}), 'application/json')
+        if parsed.path.startswith('/files/'):
+            fullpath = server.links.get(parsed.path[len('/files/'):])
+            if fullpath is None:
+                return self._reply(404, 'Not found')
+            with open(fullpath, 'rb') as fp:
+                data = fp.read()
+            with server.lock:
+                server.n_downloads += 1
+                server.bytes_sent += len(data)
+            return self._reply(200, data, 'application/octet-stream')
+        self._reply(200, 'FileServer for triple store files')
+
+    def _reply(self, code, text, content_type='text/html'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+
+class StubFileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded stub file server; use start()/stop() to run it in-process
+
+    root: only files below this directory are served
+    """
+    daemon_threads = True
+
+    def __init__(self, root, host='127.0.0.1', port=0, latency=0.,
+                 verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           StubFileHandler)
+        self.root = os.path.realpath(root)
+        self.latency = latency
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.links = {}
+        self.n_requests = 0
+        self.n_downloads = 0
+        self.bytes_sent = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def file_url(self, path):
+        """Return the /file query URL of a local path
+        """
+        return '%s/file?%s' % (self.url, urllib.urlencode(
+            {'file_uri': 'file://%s' % os.path.abspath(path)}))
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.n_requests,
+                    'downloads': self.n_downloads,
+                    'bytes_sent': self.bytes_sent}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog='stub_file_server.py',
+                                     description=__doc__)
+    parser.add_argument('root', type=str,
+                        help='Directory whose files are served')
+    parser.add_argument('-p', '--port', type=int, default=10101,
+                        help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='Seconds to wait before answering a request')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every request')
+    args = parser.parse_args()
+
+    server = StubFileServer(args.root, port=args.port, latency=args.latency,
+                            verbose=args.verbose)
+    print('Stub file server at %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats()))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""Local stand-in for a SPARQL update endpoint
+
+Accepts the INSERT DATA / INSERT IN GRAPH requests sent by the upload_graph
+functions (and the resource DELETE and batch ASK requests of sparql_upload)
+and keeps the
+inserted N-Triples statements per graph, so uploads can be exercised and
+timed without the INCF Virtuoso server. SELECT queries (e.g., the paged
+queries of sparql_cursor) are evaluated by rdflib over all the statements
+stored. Latency, random failures and a payload size limit can be injected.
+"""
+
+import BaseHTTPServer
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+import zlib
+
+import rdflib
+
+graph_re = re.compile(r'GRAPH\s*<([^>]*)>')
+values_re = re.compile(r'VALUES\s*\?r\s*\{([^}]*)\}')
+select_re = re.compile(r'^\s*(PREFIX[^\n]*\n\s*)*SELECT\b', re.IGNORECASE)
+
+
+def parse_update(query):
+    """Return the graph IRI and N-Triples statements of an update request
+    """
+    match = graph_re.search(query)
+    graph_iri = match.group(1) if match else None
+    body = query[query.find('{', match.end() if match else 0) + 1:]
+    stmts = [line.strip() for line in body.splitlines()
+             if line.strip().endswith('.')]
+    return graph_iri, stmts
+
+
+def split_statement(stmt):
+    """Return the subject, predicate and object of an N-Triples statement
+    """
+    subj, pred, obj = stmt.split(None, 2)
+    return subj, pred, obj.rsplit('.', 1)[0].strip()
+
+
+def contains(stmts, pattern):
+    """Return True if the statements of an ASK pattern are stored
+
+    Blank nodes of the pattern match any term.
+    """
+    for stmt in pattern:
+        if stmt in stmts:
+            continue
+        if '_:' not in stmt:
+            return False
+        terms = split_statement(stmt)
+        if not any(all(term.startswith('_:') or term == other
+                       for term, other in zip(terms, split_statement(stored)))
+                   for stored in stmts):
+            return False
+    return True
+
+
+def delete_resources(stmts, resources):
+    """Remove statements about `resources` (and their blank nodes) in place
+    """
+    bnodes = set()
+    for stmt in list(stmts):
+        subj, _, obj = stmt.split(None, 2)
+        obj = obj.rsplit('.', 1)[0].strip()
+        if subj in resources:
+            stmts.discard(stmt)
+            if obj.startswith('_:'):
+                bnodes.add(obj)
+        elif obj in resources:
+            stmts.discard(stmt)
+    for stmt in list(stmts):
+        if stmt.split(None, 1)[0] in bnodes:
+            stmts.discard(stmt)
+
+
+class StubSparqlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 31)
+        if self.headers.get('Content-Type', '').startswith(
+                'application/sparql-update'):
+            query = body
+        else:
+            params = urlparse.parse_qs(body)
+            query = (params.get('query') or params.get('update') or [''])[0]
+        if server.latency:
+            time.sleep(server.latency)
+        if server.fail_rate and random.random() < server.fail_rate:
+            return self._reply(503, 'Service unavailable')
+        if select_re.match(query):
+            graph = server.dataset()
+            with server.lock:
+                server.n_requests += 1
+            return self._reply(200, graph.query(query).serialize(
+                format='json'), 'application/sparql-results+json')
+        if query.lstrip().startswith('ASK'):
+            graph_iri, stmts = parse_update(query)
+            with server.lock:
+                server.n_requests += 1
+                found = contains(server.graphs.get(graph_iri, set()), stmts)
+            return self._reply(200, json.dumps({'head': {}, 'boolean': found}),
+                               'application/sparql-results+json')
+        if query.lstrip().startswith('DELETE'):
+            graph_iri = graph_re.search(query).group(1)
+            resources = set(values_re.search(query).group(1).split())
+            with server.lock:
+                server.n_requests += 1
+                server.version += 1
+                delete_resources(server.graphs.get(graph_iri, set()),
+                                 resources)
+            return self._reply(200, 'Deleted %d resources' % len(resources))
+        graph_iri, stmts = parse_update(query)
+        if server.max_stmts and len(stmts) > server.max_stmts:
+            return self._reply(413, 'Too many statements')
+        with server.lock:
+            server.n_requests += 1
+            server.n_statements += len(stmts)
+            server.version += 1
+            server.graphs.setdefault(graph_iri, set()).update(stmts)
+        self._reply(200, 'Inserted %d statements' % len(stmts))
+
+    def do_GET(self):
+        """Return the request and triple counts as JSON
+        """
+        self._reply(200, json.dumps(self.server.stats()), 'application/json')
+
+    def _reply(self, code, text, content_type='text/html'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+
+class StubSparqlServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    """Threaded stub endpoint; use start()/stop() to run it in-process
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0., fail_rate=0.,
+                 max_stmts=None, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           StubSparqlHandler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.max_stmts = max_stmts
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_statements = 0
+        self.graphs = {}
+        self.version = 0
+        self._dataset = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/sparql' % self.server_address[:2]
+
+    def dataset(self):
+        """Return an rdflib graph of the statements of all graphs (parsed
+        again only after updates)
+        """
+        with self.lock:
+            if self._dataset is None or self._dataset[0] != self.version:
+                graph = rdflib.ConjunctiveGraph()
+                data = '\n'.join(stmt for stmts in self.graphs.values()
+                                 for stmt in stmts)
+                if data:
+                    graph.parse(data=data, format='nt')
+                self._dataset = (self.version, graph)
+            return self._dataset[1]
+
+    def n_triples(self, graph_iri=None):
+        """Number of distinct statements stored (in one or all graphs)
+        """
+        with self.lock:
+            if graph_iri is not None:
+                return len(self.graphs.get(graph_iri, ()))
+            return sum(len(stmts) for stmts in self.graphs.values())
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.n_requests,
+                    'statements': self.n_statements,
+                    'graphs': dict((str(key), len(value))
+                                   for key, value in self.graphs.items())}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog='stub_sparql_endpoint.py',
+                                     description=__doc__)
+    parser.add_argument('-p', '--port', type=int, default=8890,
+                        help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='Seconds to wait before answering a request')
+    parser.add_argument('--fail_rate', type=float, default=0.,
+                        help='Fraction of requests answered with 503')
+    parser.add_argument('--max_stmts', type=int,
+                        help='Answer 413 to requests with more statements')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every request')
+    args = parser.parse_args()
+
+    server = StubSparqlServer(port=args.port, latency=args.latency,
+                              fail_rate=args.fail_rate,
+                              max_stmts=args.max_stmts, verbose=args.verbose)
+    print('Stub SPARQL endpoint at %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats()))
@@ -0,0 +1,63 @@
+"""Per-subject manifest of encoded files for incremental re-encoding
+
+The manifest records, for every file of a subject directory, its relative
+path, size, mtime and digests together with the IRIs generated for it (the
+file entity and, for .stats files, the stats collection and its members).
+A later run compares the directory against it to encode only added or
+changed files and to delete the resources of changed or removed ones.
+
+Layout (JSON):
+
+    {"subject_id": ..., "project_id": ..., "new_id": ...,
+     "collection": <IRI of the subject directory collection>,
+     "files": {<relative path>: {"size": ..., "mtime": ..., "md5": ...,
+                                 "sha512": ..., "iris": [...]}}}
+"""
+
+import json
+import os
+import tempfile
+
+
+def manifest_filename(output_dir, subject_id, project_id):
+    return os.path.join(output_dir, '%s_%s.manifest.json' % (subject_id,
+                                                             project_id))
+
+
+def new_manifest(subject_id, project_id, new_id=None):
+    return {'subject_id': subject_id,
+            'project_id': project_id,
+            'new_id': new_id,
+            'collection': None,
+            'files': {}}
+
+
+def file_state(filepath):
+    """Return the size and mtime recorded for a file
+    """
+    st = os.stat(filepath)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def is_unchanged(entry, state):
+    return entry['size'] == state['size'] and entry['mtime'] == state['mtime']
+
+
+def load_manifest(filename):
+    with open(filename, 'rt') as fp:
+        return json.load(fp)
+
+
+def save_manifest(manifest, filename):
+    """Write the manifest atomically
+    """
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(
+        os.path.abspath(filename)), suffix='.json.tmp')
+    try:
+        with os.fdopen(fd, 'wt') as fp:
+            json.dump(manifest, fp, indent=1, sort_keys=True)
+        os.chmod(tmp_file, 0o644)
+        os.rename(tmp_file, filename)
+    except:
+        os.unlink(tmp_file)
+        raise
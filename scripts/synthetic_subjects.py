@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""Generate synthetic FreeSurfer subject directories for benchmarks
+
+Each subject gets the mri/surf/label/stats/scripts layout of a recon-all
+run (subject_template), including directories fs_upload_to_triplesore.py
+ignores. Volume, surface and label files are filled with pseudo-random
+bytes of a configurable size (unique per file, so digests differ), and the
+aseg-, aparc- and BA-like .stats files have FreeSurfer headers (measures,
+table columns) and realistic structure names.
+"""
+
+import os
+import random
+
+subject_template = (
+    ['mri/%s.mgz' % name for name in
+     ['T1', 'T1.bak', 'brain', 'brainmask', 'aseg', 'aparc+aseg',
+      'aparc.a2009s+aseg', 'wm', 'filled', 'norm', 'nu', 'orig', 'rawavg']] +
+    ['mri/orig/001.mgz', 'mri/transforms/talairach.xfm',
+     'mri/transforms/bak/talairach.auto.xfm'] +
+    ['surf/%s.%s' % (hemi, name) for hemi in ['lh', 'rh'] for name in
+     ['white', 'pial', 'orig', 'inflated', 'sphere', 'sphere.reg', 'curv',
+      'thickness', 'area', 'sulc', 'volume', 'jacobian_white']] +
+    ['label/%s.%s%s.label' % (hemi, area, suffix)
+     for hemi in ['lh', 'rh']
+     for area in ['BA1', 'BA2', 'BA3a', 'BA3b', 'BA44', 'BA45', 'BA4a',
+                  'BA4p', 'BA6', 'V1', 'V2', 'MT', 'entorhinal', 'cortex']
+     for suffix in ['', '_exvivo', '.thresh']] +
+    ['label/%s.%s.annot' % (hemi, name) for hemi in ['lh', 'rh']
+     for name in ['aparc', 'aparc.a2009s', 'BA', 'BA.thresh']] +
+    ['stats/%s.stats' % name for name in
+     ['aseg', 'wmparc', 'lh.aparc', 'rh.aparc', 'lh.aparc.a2009s',
+      'rh.aparc.a2009s', 'lh.BA', 'rh.BA', 'lh.curv', 'rh.curv']] +
+    ['scripts/%s' % name for name in
+     ['recon-all.log', 'recon-all.done', 'recon-all-status.log',
+      'build-stamp.txt']] +
+    ['tmp/cw256/tmp.mgz', 'touch/rusage.mri_ca_register.dat',
+     'trash/old.mgz', 'src/README'] +
+    ['label/aparc.annot.ctab', 'label/aparc.annot.a2009s.ctab'])
+
+aseg_columns = [('Index', 'Index', 'NA', '%d'),
+                ('SegId', 'Segmentation Id', 'NA', '%d'),
+                ('NVoxels', 'Number of Voxels', 'unitless', '%d'),
+                ('Volume_mm3', 'Volume', 'mm^3', '%.1f'),
+                ('StructName', 'Structure Name', 'NA', '%s'),
+                ('normMean', 'Intensity normMean', 'MR', '%.4f'),
+                ('normStdDev', 'Itensity normStdDev', 'MR', '%.4f'),
+                ('normMin', 'Intensity normMin', 'MR', '%.4f'),
+                ('normMax', 'Intensity normMax', 'MR', '%.4f'),
+                ('normRange', 'Intensity normRange', 'MR', '%.4f')]
+
+aparc_columns = [('StructName', 'Structure Name', 'NA', '%s'),
+                 ('NumVert', 'Number of Vertices', 'unitless', '%d'),
+                 ('SurfArea', 'Surface Area', 'mm^2', '%d'),
+                 ('GrayVol', 'Gray Matter Volume', 'mm^3', '%d'),
+                 ('ThickAvg', 'Average Thickness', 'mm', '%.3f'),
+                 ('ThickStd', 'Thickness StdDev', 'mm', '%.3f'),
+                 ('MeanCurv', 'Integrated Rectified Mean Curvature', 'mm^-1',
+                  '%.3f'),
+                 ('GausCurv', 'Integrated Rectified Gaussian Curvature',
+                  'mm^-2', '%.3f'),
+                 ('FoldInd', 'Folding Index', 'unitless', '%d'),
+                 ('CurvInd', 'Intrinsic Curvature Index', 'unitless', '%.1f')]
+
+aseg_structures = [
+    'Left-Lateral-Ventricle', 'Left-Inf-Lat-Vent',
+    'Left-Cerebellum-White-Matter', 'Left-Cerebellum-Cortex',
+    'Left-Thalamus-Proper', 'Left-Caudate', 'Left-Putamen', 'Left-Pallidum',
+    '3rd-Ventricle', '4th-Ventricle', 'Brain-Stem', 'Left-Hippocampus',
+    'Left-Amygdala', 'CSF', 'Left-Accumbens-area', 'Left-VentralDC',
+    'Left-vessel', 'Left-choroid-plexus', 'Right-Lateral-Ventricle',
+    'Right-Inf-Lat-Vent', 'Right-Cerebellum-White-Matter',
+    'Right-Cerebellum-Cortex', 'Right-Thalamus-Proper', 'Right-Caudate',
+    'Right-Putamen', 'Right-Pallidum', 'Right-Hippocampus',
+    'Right-Amygdala', 'Right-Accumbens-area', 'Right-VentralDC',
+    'Right-vessel', 'Right-choroid-plexus', '5th-Ventricle',
+    'WM-hypointensities', 'Left-WM-hypointensities',
+    'Right-WM-hypointensities', 'non-WM-hypointensities',
+    'Left-non-WM-hypointensities', 'Right-non-WM-hypointensities',
+    'Optic-Chiasm', 'CC_Posterior', 'CC_Mid_Posterior', 'CC_Central',
+    'CC_Mid_Anterior', 'CC_Anterior']
+
+aparc_structures = [
+    'bankssts', 'caudalanteriorcingulate', 'caudalmiddlefrontal', 'cuneus',
+    'entorhinal', 'fusiform', 'inferiorparietal', 'inferiortemporal',
+    'isthmuscingulate', 'lateraloccipital', 'lateralorbitofrontal',
+    'lingual', 'medialorbitofrontal', 'middletemporal', 'parahippocampal',
+    'paracentral', 'parsopercularis', 'parsorbitalis', 'parstriangularis',
+    'pericalcarine', 'postcentral', 'posteriorcingulate', 'precentral',
+    'precuneus', 'rostralanteriorcingulate', 'rostralmiddlefrontal',
+    'superiorfrontal', 'superiorparietal', 'superiortemporal',
+    'supramarginal', 'frontalpole', 'temporalpole', 'transversetemporal',
+    'insula']
+
+ba_structures = ['BA1', 'BA2', 'BA3a', 'BA3b', 'BA4a', 'BA4p', 'BA6',
+                 'BA44', 'BA45', 'V1', 'V2', 'MT', 'perirhinal']
+
+aseg_measures = [
+    ('BrainSeg', 'BrainSegVol', 'Brain Segmentation Volume', 'mm^3'),
+    ('BrainSegNotVent', 'BrainSegVolNotVent',
+     'Brain Segmentation Volume Without Ventricles', 'mm^3'),
+    ('lhCortex', 'lhCortexVol', 'Left hemisphere cortical gray matter volume',
+     'mm^3'),
+    ('rhCortex', 'rhCortexVol',
+     'Right hemisphere cortical gray matter volume', 'mm^3'),
+    ('Cortex', 'CortexVol', 'Total cortical gray matter volume', 'mm^3'),
+    ('SubCortGray', 'SubCortGrayVol', 'Subcortical gray matter volume',
+     'mm^3'),
+    ('TotalGray', 'TotalGrayVol', 'Total gray matter volume', 'mm^3'),
+    ('SupraTentorial', 'SupraTentorialVol', 'Supratentorial volume', 'mm^3'),
+    ('IntraCranialVol', 'ICV', 'Intracranial Volume', 'mm^3')]
+
+aparc_measures = [
+    ('Cortex', 'NumVert', 'Number of Vertices', 'unitless'),
+    ('Cortex', 'WhiteSurfArea', 'White Surface Total Area', 'mm^2'),
+    ('Cortex', 'MeanThickness', 'Mean Thickness', 'mm')]
+
+
+def write_synthetic_stats(filename, columns, n_rows, seed=0, structures=None,
+                          header=None, measures=None):
+    """Write a .stats file with FreeSurfer-style header and random values
+
+    structures: names of the table rows (cycled, with a suffix, if there are
+        more rows; default: Structure-<row>)
+    header: (tag, value) header lines (default: a minimal header)
+    measures: (structure, name, description, units) header measures
+    """
+    rng = random.Random(seed)
+    if header is None:
+        header = [('generating_program', 'synthetic'),
+                  ('subjectname', 'bench')]
+    if measures is None:
+        measures = [('BrainSeg', 'BrainSegVol', 'Brain Segmentation Volume',
+                     'mm^3'),
+                    ('Cortex', 'NumVert', 'Number of Vertices', 'unitless')]
+    with open(filename, 'wt') as fp:
+        fp.write('# Title Segmentation Statistics \n# \n')
+        for tag, value in header:
+            fp.write('# %s %s\n' % (tag, value))
+        for structure, name, description, units in measures:
+            if units == 'unitless':
+                value = '%d' % rng.randint(1000, 200000)
+            else:
+                value = '%f' % rng.uniform(1000, 1500000)
+            fp.write('# Measure %s, %s, %s, %s, %s\n' % (
+                structure, name, description, value, units))
+        fp.write('# NRows %d \n# NTableCols %d \n' % (n_rows, len(columns)))
+        for idx, (name, field, units, _) in enumerate(columns):
+            fp.write('# TableCol %2d ColHeader %s\n' % (idx + 1, name))
+            fp.write('# TableCol %2d FieldName %s\n' % (idx + 1, field))
+            fp.write('# TableCol %2d Units     %s\n' % (idx + 1, units))
+        fp.write('# ColHeaders %s\n' % ' '.join(col[0] for col in columns))
+        for row in range(n_rows):
+            if structures is None:
+                structure = 'Structure-%d' % row
+            elif row < len(structures):
+                structure = structures[row]
+            else:
+                structure = '%s-%d' % (structures[row % len(structures)],
+                                       row // len(structures))
+            values = []
+            for name, _, _, fmt in columns:
+                if fmt == '%s':
+                    values.append(structure)
+                elif fmt == '%d':
+                    values.append(fmt % rng.randint(0, 100000))
+                else:
+                    values.append(fmt % rng.uniform(0, 1000))
+            fp.write(' '.join(values) + '\n')
+
+
+def stats_kind(relpath):
+    """Return the columns, structures and measures of a .stats file
+    (None for curvature stats, which are not tables)
+    """
+    name = os.path.basename(relpath)
+    if 'curv' in name:
+        return None
+    if name in ('aseg.stats', 'wmparc.stats'):
+        return aseg_columns, aseg_structures, aseg_measures
+    if '.BA' in name:
+        return aparc_columns, ba_structures, aparc_measures
+    if 'a2009s' in name:
+        # the Destrieux parcellation has about 74 structures per hemisphere
+        return aparc_columns, aparc_structures * 2 + aparc_structures[:6], \
+            aparc_measures
+    return aparc_columns, aparc_structures, aparc_measures
+
+
+def make_subject(basedir, subject_id, file_size=65536, seed=0,
+                 subjects_dir='/data/subjects'):
+    """Write one synthetic subject directory; return its path and number of
+    bytes written
+
+    file_size: bytes of each volume, surface and label file
+    """
+    rng = random.Random('%s-%s' % (seed, subject_id))
+    # one random block per subject; each file starts with its own path so
+    # that no two files have the same digest
+    block = ''.join(chr(rng.getrandbits(8)) for _ in range(min(file_size,
+                                                              65536)))
+    subject_dir = os.path.join(basedir, subject_id)
+    n_bytes = 0
+    for relpath in subject_template:
+        filename = os.path.join(subject_dir, relpath)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        if relpath.startswith('stats/'):
+            kind = stats_kind(relpath)
+            if kind is None:
+                with open(filename, 'wt') as fp:
+                    fp.write('# mris_curvature_stats %s\n' % relpath)
+                    fp.write('Raw Gaussian Curvature: %f\n' % rng.random())
+            else:
+                columns, structures, measures = kind
+                header = [('generating_program', 'mri_segstats'),
+                          ('cvs_version', '$Id: synthetic $'),
+                          ('sysname', 'Linux'),
+                          ('hostname', 'bench'),
+                          ('machine', 'x86_64'),
+                          ('user', 'bench'),
+                          ('SUBJECTS_DIR', subjects_dir),
+                          ('subjectname', subject_id)]
+                if relpath.startswith('stats/lh.') or \
+                        relpath.startswith('stats/rh.'):
+                    header.append(('hemi', relpath[6:8]))
+                write_synthetic_stats(filename, columns, len(structures),
+                                      seed=rng.random(),
+                                      structures=structures, header=header,
+                                      measures=measures)
+        elif relpath.startswith('scripts/') or relpath.endswith('.xfm') or \
+                relpath.endswith('.ctab') or relpath.endswith('README'):
+            with open(filename, 'wt') as fp:
+                fp.write('%s %s\n' % (subject_id, relpath))
+        else:
+            with open(filename, 'wb') as fp:
+                fp.write('%s/%s\n' % (subject_id, relpath))
+                remaining = file_size
+                while remaining > 0:
+                    fp.write(block[:remaining])
+                    remaining -= len(block)
+        n_bytes += os.path.getsize(filename)
+    return subject_dir, n_bytes
+
+
+def make_subjects(basedir, n_subjects, file_size=65536, seed=0,
+                  prefix='SUBJ'):
+    """Write n_subjects synthetic subjects; return their directories
+    """
+    return [make_subject(basedir, '%s%05d' % (prefix, idx + 1),
+                         file_size=file_size, seed=seed)[0]
+            for idx in range(n_subjects)]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(prog='synthetic_subjects.py',
+                                     description=__doc__)
+    parser.add_argument('-o', '--output_dir', type=str, required=True,
+                        help=('Directory to write the subjects to (its path '
+                              'must not contain an ignored name like tmp)'))
+    parser.add_argument('-n', '--n_subjects', type=int, default=10,
+                        help='Number of subjects')
+    parser.add_argument('--file_size', type=int, default=65536,
+                        help='Bytes of each volume, surface and label file')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the generated values')
+    args = parser.parse_args()
+
+    for idx in range(args.n_subjects):
+        subject_dir, n_bytes = make_subject(args.output_dir,
+                                            'SUBJ%05d' % (idx + 1),
+                                            file_size=args.file_size,
+                                            seed=args.seed)
+        print('%s (%d bytes)' % (subject_dir, n_bytes))
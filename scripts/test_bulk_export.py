@@ -0,0 +1,135 @@
+"""Tests of the N-Quads shard export and its manifest
+(run with python -m unittest test_bulk_export)
+"""
+
+import gzip
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import rdflib
+
+import bulk_export
+
+graph_iri = 'http://test.nidm.org/export'
+agent = '<http://test.nidm.org/agent> <http://www.w3.org/2000/01/' \
+    'rdf-schema#label> "agent" .'
+
+
+def groups(n_groups, tag, shared=False):
+    """Return groups of N-Triples lines like those of PROV records, with a
+    qualified relation (and, if shared, a statement repeated in every group)
+    """
+    groups = []
+    for idx in range(n_groups):
+        node = '<http://test.nidm.org/%s/%d>' % (tag, idx)
+        groups.append([
+            '%s <http://www.w3.org/ns/prov#qualifiedAssociation> _:%s%d .' % (
+                node, tag, idx),
+            '_:%s%d <http://www.w3.org/ns/prov#agent> '
+            '<http://test.nidm.org/agent> .' % (tag, idx),
+            '%s <http://www.w3.org/2000/01/rdf-schema#label> "m\\u00e9asure '
+            '%d" .' % (node, idx)] + ([agent] if shared else []))
+    return groups
+
+
+def export(export_dir, prefix):
+    shards = bulk_export.export_groups(groups(100, prefix, shared=True),
+                                       export_dir, graph_iri, prefix,
+                                       max_bytes=4096)
+    bulk_export.write_manifest(export_dir, shards)
+
+
+class BulkExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.export_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.export_dir)
+
+    def load(self):
+        dataset = rdflib.Dataset()
+        for name in os.listdir(self.export_dir):
+            if name.endswith('.nq.gz'):
+                with gzip.open(os.path.join(self.export_dir, name)) as fp:
+                    dataset.parse(fp, format='nquads')
+        return dataset
+
+    def test_shards_hold_the_groups(self):
+        shards = bulk_export.export_groups(
+            groups(300, 'subject'), self.export_dir, graph_iri, 'subject',
+            max_bytes=4096)
+        manifest = bulk_export.write_manifest(self.export_dir, shards)
+        self.assertTrue(len(manifest['shards']) > 1)
+        self.assertEqual(manifest['triples'], 3 * 300)
+        quads = self.load().quads((None, None, None, None))
+        self.assertEqual(len(set(quads)), manifest['triples'])
+        self.assertEqual(bulk_export.verify_export(self.export_dir), [])
+
+    def test_repeated_statements_are_stored_once(self):
+        manifest = bulk_export.write_manifest(
+            self.export_dir, bulk_export.export_groups(
+                groups(300, 'subject', shared=True), self.export_dir,
+                graph_iri, 'subject', max_bytes=4096))
+        self.assertTrue(len(manifest['shards']) > 1)
+        self.assertEqual(manifest['triples'], 4 * 300)
+        # the agent statement is written with every group but stored once
+        quads = self.load().quads((None, None, None, None))
+        self.assertEqual(len(set(quads)), manifest['triples'] - 299)
+        self.assertEqual(bulk_export.verify_export(self.export_dir), [])
+
+    def test_groups_are_not_split(self):
+        bulk_export.write_manifest(self.export_dir, bulk_export.export_groups(
+            groups(300, 'subject'), self.export_dir, graph_iri, 'subject',
+            max_bytes=4096))
+        for name in os.listdir(self.export_dir):
+            if name.endswith('.nq.gz'):
+                with gzip.open(os.path.join(self.export_dir, name)) as fp:
+                    self.assertEqual(
+                        sum(1 for line in fp if line.strip()) % 3, 0)
+
+    def test_smaller_export_drops_shards(self):
+        export(self.export_dir, 'subject')
+        manifest = bulk_export.write_manifest(
+            self.export_dir, bulk_export.export_groups(
+                groups(10, 'subject'), self.export_dir, graph_iri,
+                'subject', max_bytes=4096))
+        self.assertEqual(manifest['triples'], 3 * 10)
+        self.assertEqual(bulk_export.verify_export(self.export_dir), [])
+
+    def test_concurrent_exports_keep_entries(self):
+        prefixes = ['subject%02d' % idx for idx in range(8)]
+        workers = [multiprocessing.Process(target=export,
+                                           args=(self.export_dir, prefix))
+                   for prefix in prefixes]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        manifest = bulk_export.load_manifest(self.export_dir)
+        self.assertEqual(set(name.rsplit('-', 1)[0]
+                             for name in manifest['shards']), set(prefixes))
+        self.assertEqual(manifest['triples'], 8 * 4 * 100)
+        quads = self.load().quads((None, None, None, None))
+        self.assertEqual(len(set(quads)), 8 * 3 * 100 + 1)
+        self.assertEqual(bulk_export.verify_export(self.export_dir), [])
+        self.assertFalse([name for name in os.listdir(self.export_dir)
+                          if name.endswith('.tmp')])
+
+    def test_missing_statements_are_reported(self):
+        export(self.export_dir, 'subject')
+        name = sorted(bulk_export.load_manifest(self.export_dir)['shards'])[0]
+        filename = os.path.join(self.export_dir, name)
+        with gzip.open(filename) as fp:
+            lines = fp.readlines()
+        with gzip.open(filename, 'wb') as fp:
+            fp.writelines(lines[1:])
+        errors = bulk_export.verify_export(self.export_dir)
+        self.assertEqual(len(errors), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Tests of interning.Interner (run with python -m unittest test_interning)
+"""
+
+import unittest
+
+import prov.model as prov
+
+from interning import Interner
+
+
+class InternerTest(unittest.TestCase):
+
+    def test_text_shared(self):
+        interner = Interner()
+        first = interner.text('lh.aparc.stats')
+        self.assertIsInstance(first, unicode)
+        self.assertIs(interner.text(u'lh.aparc.stats'), first)
+        self.assertIs(interner.text('lh.aparc.stats'), first)
+
+    def test_text_non_ascii(self):
+        interner = Interner()
+        path = 'caf\xc3\xa9.mgz'
+        self.assertEqual(interner.text(path), path)
+        self.assertIs(interner.text(path), interner.text(path))
+        self.assertEqual(interner.text(u'caf\xe9.mgz'), u'caf\xe9.mgz')
+
+    def test_literal_signed_zero(self):
+        interner = Interner()
+        positive = interner.literal(0.0, prov.XSD['float'])
+        negative = interner.literal(-0.0, prov.XSD['float'])
+        self.assertEqual(repr(positive.get_value()), '0.0')
+        self.assertEqual(repr(negative.get_value()), '-0.0')
+        self.assertIs(interner.literal(-0.0, prov.XSD['float']), negative)
+
+    def test_literal_type_kept(self):
+        interner = Interner()
+        as_int = interner.literal(1, prov.XSD['float'])
+        as_float = interner.literal(1.0, prov.XSD['float'])
+        self.assertIsInstance(as_int.get_value(), int)
+        self.assertIsInstance(as_float.get_value(), float)
+
+    def test_disabled(self):
+        interner = Interner(max_entries=0)
+        interner.text('a')
+        interner.literal(1.5, prov.XSD['float'])
+        self.assertEqual(interner.stats()['entries'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+"""Tests of the direct stats triple emitter
+(run with python -m unittest test_stats_triples)
+"""
+
+from collections import Counter
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import prov.model as prov
+import rdflib
+from rdflib.compare import isomorphic
+
+import fs_upload_to_triplesore as fs_upload
+import query_convert_fs_stats as query_convert
+from stats_triples import PROV, XSD_FLOAT, XSD_INTEGER, stats_triples
+from synthetic_subjects import aparc_columns, aparc_measures, \
+    aseg_columns, write_synthetic_stats
+
+example_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'ttl_examples', 'fs_stats.ttl')
+# the association blank node of the example is written as a relative IRI
+example_base = 'http://example.org/fs_stats/'
+uuid_re = re.compile(r'[0-9a-f]{32}$')
+# the example was written by a prov version using these terms
+XSD_DATATYPES = rdflib.Namespace('http://www.w3.org/2001/XMLSchema-datatypes#')
+example_terms = {XSD_DATATYPES['float']: XSD_FLOAT,
+                 XSD_DATATYPES['integer']: XSD_INTEGER,
+                 PROV['label']: rdflib.RDFS['label']}
+
+
+def generated(term, id_namespace):
+    """Return whether a term is a blank node or an identifier made by uuid
+    (id_namespace may be a tuple of namespaces)
+    """
+    return isinstance(term, rdflib.BNode) or (
+        isinstance(term, rdflib.URIRef) and
+        term.startswith(id_namespace) and uuid_re.search(term))
+
+
+def comparable(triples, id_namespace):
+    """Return a graph of the triples with generated IRIs replaced by blank
+    nodes, without the activity start time
+    """
+    nodes = {}
+
+    def term(node):
+        if isinstance(node, rdflib.Literal) and node.datatype in example_terms:
+            return rdflib.Literal(node, datatype=example_terms[node.datatype])
+        if generated(node, id_namespace):
+            return nodes.setdefault(node, rdflib.BNode())
+        return example_terms.get(node, node)
+    graph = rdflib.Graph()
+    for subj, pred, obj in triples:
+        if pred != PROV['startTime']:
+            graph.add((term(subj), term(pred), term(obj)))
+    return graph
+
+
+def normalized(triples, id_namespace):
+    """Return the multiset of triples with generated IRIs and blank nodes
+    renamed after their content, without the activity start time
+
+    A generated node is labelled by its outgoing statements, with generated
+    objects labelled by their own outgoing statements first.
+    """
+    triples = set(triple for triple in triples
+                  if triple[1] != PROV['startTime'])
+    outgoing = {}
+    for subj, pred, obj in triples:
+        if generated(subj, id_namespace):
+            outgoing.setdefault(subj, []).append((pred, obj))
+
+    def label(term, labels=None):
+        if not generated(term, id_namespace):
+            return term
+        if labels is None:
+            return 'node(%s)' % sorted(
+                (pred, obj) for pred, obj in outgoing.get(term, [])
+                if not generated(obj, id_namespace))
+        return 'node(%s)' % sorted(
+            (pred, labels[obj] if generated(obj, id_namespace) else obj)
+            for pred, obj in outgoing.get(term, []))
+    nodes = set(term for triple in triples for term in triple[::2]
+                if generated(term, id_namespace))
+    labels = dict((node, label(node)) for node in nodes)
+    labels = dict((node, label(node, labels)) for node in nodes)
+    return Counter((labels.get(subj, subj), pred, labels.get(obj, obj))
+                   for subj, pred, obj in triples)
+
+
+def write_example_stats(example, filename):
+    """Write the .stats file the example collection was made from and return
+    the IRI of its file entity
+    """
+    fs = query_convert.stats_terms['fs']
+    nidm = query_convert.stats_terms['nidm']
+    collection = example.value(predicate=rdflib.RDF['type'],
+                               object=nidm['FreeSurferStatsCollection'])
+    header = example.value(predicate=rdflib.RDF['type'],
+                           object=fs['stat_header'])
+    structures = {}
+    for entity, struct_uri in example.subject_objects(
+            nidm['AnatomicalAnnotation']):
+        structures[struct_uri[len(fs):]] = dict(
+            (pred[len(fs):], obj) for pred, obj in example.predicate_objects(
+                entity) if pred.startswith(fs))
+    cortex = structures.pop('Cortex')
+    with open(filename, 'wt') as fp:
+        for pred, obj in sorted(example.predicate_objects(header)):
+            if pred.startswith(fs):
+                fp.write('# %s %s\n' % (pred[len(fs):], obj))
+        for structure, name, description, units in aparc_measures:
+            fp.write('# Measure %s, %s, %s, %s, %s\n' % (
+                structure, name, description, cortex[name], units))
+        for idx, (name, description, units, _) in enumerate(aparc_columns):
+            fp.write('# TableCol %2d ColHeader %s\n' % (idx + 1, name))
+            fp.write('# TableCol %2d FieldName %s\n' % (idx + 1, description))
+            fp.write('# TableCol %2d Units     %s\n' % (idx + 1, units))
+        fp.write('# ColHeaders %s\n' % ' '.join(
+            name for name, _, _, _ in aparc_columns))
+        for structure, values in sorted(structures.items()):
+            fp.write('%s\n' % ' '.join([structure] + [
+                values[name] for name, _, _, _ in aparc_columns[1:]]))
+    return example.value(collection, PROV['wasDerivedFrom'])
+
+
+def reference_triples(script, filename, entity_uri):
+    """Return the triples and measure graph of a script's parse_stats
+    """
+    if script is fs_upload:
+        bundle = fs_upload._new_bundle()
+        entity = bundle.entity(fs_upload.niiri[entity_uri.split('/')[-1]])
+        bundle, measure_graph = fs_upload.parse_stats(bundle, filename,
+                                                      entity)
+        entity_node = entity.get_identifier().rdf_representation()
+        triples = [triple for triple in bundle.rdf()
+                   if triple[0] != entity_node]
+    else:
+        bundle, measure_graph = query_convert.parse_stats(filename,
+                                                          entity_uri)
+        triples = list(bundle.rdf())
+    return triples, measure_graph
+
+
+
+class StatsTriplesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_matches_example(self):
+        example = rdflib.Graph().parse(example_file, format='turtle',
+                                       publicID=example_base)
+        filename = os.path.join(self.tmp_dir, 'rh.aparc.a2009s.stats')
+        entity_uri = write_example_stats(example, filename)
+        records, terms = stats_triples(filename, entity_uri,
+                                       query_convert.stats_terms,
+                                       username='satra')
+        id_namespace = query_convert.stats_terms['niiri']
+        direct = comparable((triple for _, record in records
+                             for triple in record), id_namespace)
+        self.assertEqual(len(direct), len(example) - 1)
+        self.assertTrue(isomorphic(direct, comparable(
+            example, (id_namespace, example_base))))
+        # type, label and units of each measure of the header and table
+        measures = set([measure[1] for measure in aparc_measures] +
+                       [column[0] for column in aparc_columns[1:]])
+        self.assertEqual(len(set(terms)), 3 * len(measures))
+
+    @unittest.skipUnless(hasattr(prov.ProvBundle, 'rdf'),
+                         'prov.model without ProvBundle.rdf')
+    def test_matches_parse_stats(self):
+        filenames = []
+        for n_rows in [1, 35, 500]:
+            for name, columns in [('aseg', aseg_columns),
+                                  ('aparc', aparc_columns)]:
+                filename = os.path.join(self.tmp_dir, '%s_%d.stats' % (
+                    name, n_rows))
+                write_synthetic_stats(filename, columns, n_rows)
+                filenames.append(filename)
+        for script in [fs_upload, query_convert]:
+            id_namespace = rdflib.URIRef(script.stats_terms['niiri'])
+            entity_uri = id_namespace + 'stats-file-entity'
+            for filename in filenames:
+                triples, measure_graph = reference_triples(script, filename,
+                                                           entity_uri)
+                records, terms = stats_triples(filename, entity_uri,
+                                               script.stats_terms)
+                direct = [triple for _, record in records
+                          for triple in record]
+                self.assertEqual(normalized(triples, id_namespace),
+                                 normalized(direct, id_namespace))
+                self.assertEqual(set(measure_graph), set(terms))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""Tests of resuming an interrupted subject upload from a ProgressJournal
+(run with python -m unittest test_upload_resume)
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import prov.model as prov
+import rdflib
+
+import fs_upload_to_triplesore as fs_upload
+from progress_journal import ProgressJournal
+from stub_sparql_endpoint import StubSparqlServer
+
+graph_iri = 'http://test.nidm.org/resume'
+
+
+def stats_records(n_records, tag):
+    """Return (identifier, triples) records with two statements each;
+    `tag` stands for what changes when a subject is encoded again
+    """
+    records = []
+    for idx in range(n_records):
+        node = rdflib.URIRef('http://test.nidm.org/%s/%d' % (tag, idx))
+        records.append((node, [
+            (node, rdflib.RDF.type, rdflib.URIRef('http://test.nidm.org/m')),
+            (node, rdflib.RDFS.label, rdflib.Literal('measure %d' % idx))]))
+    return records
+
+
+def upload(journal_file, upload_file, subject_dir, endpoint):
+    journal = ProgressJournal(journal_file)
+    fs_upload.upload_graph(upload_file, endpoint=endpoint, uri=graph_iri,
+                           max_stmts=10, max_in_flight=1, journal=journal,
+                           scope=fs_upload.upload_scope(
+                               graph_iri, subject_dir, upload_file))
+
+
+class UploadResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.journal_file = os.path.join(self.tmp_dir, 'run.journal')
+        self.subject_dir = os.path.join(self.tmp_dir, 'SUBJ00001')
+        self.ttl_file = os.path.join(self.tmp_dir, 'SUBJ00001_test.ttl')
+        self.endpoint = StubSparqlServer(latency=0.05).start()
+
+    def tearDown(self):
+        self.endpoint.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def encode(self, tag):
+        """Record the output of an encoding of the subject, or return the
+        one an interrupted run recorded
+        """
+        journal = ProgressJournal(self.journal_file)
+        output = fs_upload.reusable_output(journal, self.subject_dir)
+        if output is None:
+            output = fs_upload.journal_output(
+                journal, self.subject_dir, prov.ProvBundle(),
+                stats_records(300, tag), self.ttl_file)
+        return output
+
+    def test_resume_sends_remaining_batches(self):
+        upload_file = self.encode('first')
+        child = multiprocessing.Process(target=upload, args=(
+            self.journal_file, upload_file, self.subject_dir,
+            self.endpoint.url))
+        child.start()
+        journal = ProgressJournal(self.journal_file)
+        scope = fs_upload.upload_scope(graph_iri, self.subject_dir,
+                                       upload_file)
+        deadline = time.time() + 30
+        while not journal.ranges(scope) and time.time() < deadline:
+            time.sleep(0.005)
+            journal.refresh()
+        child.terminate()
+        child.join()
+        journal.refresh()
+        stored = sum(end - start for start, end in journal.ranges(scope))
+        self.assertTrue(0 < stored < 300)
+
+        # a new encoding would give other records: the recorded output is
+        # uploaded instead, in the same scope
+        self.assertEqual(self.encode('second'), upload_file)
+        stats = fs_upload.upload_graph(
+            upload_file, endpoint=self.endpoint.url, uri=graph_iri,
+            max_stmts=10, journal=journal,
+            scope=fs_upload.upload_scope(graph_iri, self.subject_dir,
+                                         upload_file))
+        self.assertEqual(stats['statements'], 2 * (300 - stored))
+        self.assertEqual(self.endpoint.n_triples(graph_iri), 600)
+        self.assertEqual(journal.ranges(scope), [[0, 300]])
+
+    def test_changed_output_starts_over(self):
+        upload_file = self.encode('first')
+        with open(upload_file, 'at') as fp:
+            fp.write('\n<http://a> <http://b> <http://c> .\n')
+        self.assertIsNone(fs_upload.reusable_output(
+            ProgressJournal(self.journal_file), self.subject_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()